@@ -0,0 +1,9 @@
+"""
+common
+Código compartido por user_service y file_service. Cada servicio lee su configuración del
+entorno y se la pasa a estas clases, de modo que los dos pueden importarse en el mismo
+proceso (pruebas y microbench) sin compartir estado.
+
+En Docker el paquete se copia junto al fichero del servicio; en local se ejecuta cada
+servicio con la raíz del repositorio en PYTHONPATH (ver README).
+"""
@@ -0,0 +1,98 @@
+import os
+import json
+import uuid
+import fcntl
+import threading
+
+"""
+changelog.py
+Registro de cambios de los usuarios compartido entre procesos.
+"""
+
+class ChangeLog:
+    """
+    Registro de cambios compartido entre procesos: una línea JSON {"op", "uid", "name"} por
+    cada alta, modificación o baja, añadida después del rename que la publica.
+
+    Cada lector recuerda hasta dónde ha leído (inodo y offset): comprobar si hay cambios
+    cuesta un stat y, si el registro ha crecido, leer solo lo nuevo. Cuando supera
+    `max_bytes`, un escritor lo sustituye por uno vacío (rename bajo flock); los lectores
+    ven otro inodo y vuelven a recorrer el directorio entero una vez.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'a').close()  # Así el primer cambio no parece una rotación
+        self._position = (None, 0)  # (inodo, offset) de lo ya leído
+        self._lock = threading.Lock()  # Se consulta desde el bucle de eventos y desde los pools
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def mark(self) -> None:
+        """
+        Da por leído todo lo que hay ahora en el registro. Se llama antes de recorrer el
+        directorio entero: los cambios posteriores llegan en changes().
+        """
+        with self._lock:
+            self._position = self._stat()
+
+    def append(self, op: str, uid: str, name: str) -> None:
+        """
+        Añade un cambio al registro, rotándolo si supera max_bytes.
+
+        Args:
+            op (str): 'save' o 'delete'.
+            uid (str): El ID único del usuario.
+            name (str): El nombre del usuario.
+        """
+        line = json.dumps({"op": op, "uid": uid, "name": name}) + "\n"
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(line)
+                    size = f.tell()
+                if size > self.max_bytes:
+                    tmp_file = f"{self.path}.{uuid.uuid4().hex}.tmp"
+                    open(tmp_file, 'w').close()
+                    os.replace(tmp_file, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def changes(self):
+        """
+        Lee los cambios añadidos desde la última consulta.
+
+        Returns:
+            list: Los cambios nuevos ({"op", "uid", "name"}), o None si el registro se ha
+            rotado (o ha aparecido) y hay que recorrer el directorio entero.
+        """
+        with self._lock:
+            ino, size = self._stat()
+            known_ino, offset = self._position
+            if ino != known_ino or size < offset:
+                self._position = (ino, size)
+                return None
+            if size == offset:
+                return []
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(size - offset)
+            # Una línea a medias se deja para la siguiente consulta
+            data = data[:data.rfind(b"\n") + 1]
+            self._position = (ino, offset + len(data))
+        changes = []
+        for line in data.splitlines():
+            try:
+                changes.append(json.loads(line))
+            except ValueError:
+                continue
+        return changes
@@ -0,0 +1,110 @@
+import os
+import time
+import threading
+from .metrics import Metrics, COUNT_BUCKETS
+
+"""
+durability.py
+fsync de las escrituras, uno por escritura o agrupados en lotes (WRITE_DURABILITY).
+"""
+
+def fsync_paths(paths) -> None:
+    """
+    Hace fsync de archivos y directorios; los que ya no existen se ignoran.
+
+    Args:
+        paths: Rutas a sincronizar.
+    """
+    for path in sorted(paths):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class GroupCommit:
+    """
+    Hace duraderas las escrituras agrupando los fsync de las peticiones concurrentes.
+
+    Con el modo 'group' solo hay un fsync en curso a la vez: las escrituras que llegan
+    mientras tanto forman el lote siguiente, que se sincroniza entero (cada ruta una sola
+    vez) en cuanto termina el anterior. Sin carga no se espera nada; con carga cada fsync
+    cubre a todas las escrituras que se han acumulado. `window` añade una espera opcional
+    para juntar más escrituras, hasta `max_batch` rutas. Con 'fsync' cada escritura
+    sincroniza lo suyo y con 'none' no se sincroniza nada.
+
+    sync() bloquea hasta que las rutas son duraderas: se llama desde los hilos de los
+    pools, nunca desde el bucle de eventos, y nunca con un lock tomado, para que las
+    escrituras que esperan ese lock puedan sumarse al mismo lote.
+    """
+
+    MODES = ("none", "fsync", "group")
+
+    def __init__(self, mode: str, window: float, max_batch: int, metrics: Metrics):
+        if mode not in self.MODES:
+            raise ValueError(f"WRITE_DURABILITY must be one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.window = window
+        self.max_batch = max_batch
+        self.metrics = metrics
+        metrics.describe("group_commit_batch_paths", "histogram", "Rutas sincronizadas con fsync en cada lote.", COUNT_BUCKETS)
+        metrics.describe("group_commit_flush_duration_seconds", "histogram", "Tiempo de los fsync de cada lote.")
+        self._cond = threading.Condition()
+        self._batch = None  # Lote abierto: {"paths", "done", "error"}
+        self._flushing = False  # Hay un fsync de lote en curso
+
+    def sync(self, *paths) -> None:
+        """
+        Espera a que las rutas estén en disco.
+
+        Args:
+            *paths: Archivos y directorios escritos por la operación.
+
+        Raises:
+            OSError: Si falla el fsync del lote.
+        """
+        if self.mode == "none" or not paths:
+            return
+        if self.mode == "fsync":
+            fsync_paths(set(paths))
+            return
+        with self._cond:
+            batch = self._batch
+            if batch is not None:
+                batch["paths"].update(paths)
+                if len(batch["paths"]) >= self.max_batch:
+                    self._cond.notify_all()
+                while not batch["done"]:
+                    self._cond.wait()
+                if batch["error"] is not None:
+                    raise batch["error"]
+                return
+            # Esta escritura es la líder: el lote se cierra cuando acaba el fsync anterior
+            # (y la ventana, si la hay), y las que lleguen entretanto se suman a él
+            batch = self._batch = {"paths": set(paths), "done": False, "error": None}
+            deadline = time.monotonic() + self.window
+            while len(batch["paths"]) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if not self._flushing and remaining <= 0:
+                    break
+                self._cond.wait(remaining if not self._flushing and remaining > 0 else None)
+            while self._flushing:
+                self._cond.wait()
+            self._batch = None
+            self._flushing = True
+        start = time.perf_counter()
+        try:
+            fsync_paths(batch["paths"])
+        except OSError as e:
+            batch["error"] = e
+        self.metrics.observe("group_commit_batch_paths", (), len(batch["paths"]))
+        self.metrics.observe("group_commit_flush_duration_seconds", (), time.perf_counter() - start)
+        with self._cond:
+            self._flushing = False
+            batch["done"] = True
+            self._cond.notify_all()
+        if batch["error"] is not None:
+            raise batch["error"]
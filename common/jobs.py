@@ -0,0 +1,237 @@
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+
+"""
+jobs.py
+Cola persistente de trabajos en segundo plano compartida por los dos servicios.
+"""
+
+class JobQueue:
+    """
+    Cola persistente de trabajos en una base de datos SQLite (modo WAL) compartida entre
+    procesos y entre los dos servicios: user_service encola y file_service los ejecuta.
+    El esquema solo se define aquí y lo crea el primero que abre la base de datos.
+
+    Cada trabajo pasa por queued -> running -> done o failed. Un worker lo reclama en una
+    transacción BEGIN IMMEDIATE, así que dos procesos nunca reclaman el mismo, y como mucho
+    hay `max_running` en ejecución entre todos. El worker mantiene un lease que renueva al
+    informar del progreso: si el proceso muere, el lease caduca y otro worker lo retoma. Los
+    fallos se reintentan con espera exponencial hasta `max_attempts`, de modo que los
+    trabajos deben poder repetirse sin efectos extra. La clave de un trabajo impide
+    encolarlo dos veces mientras sigue pendiente.
+    """
+
+    COLUMNS = ("id", "type", "payload", "status", "attempts", "max_attempts", "progress", "total",
+               "message", "error", "created_at", "updated_at", "finished_at")
+
+    def __init__(self, db_path: str, max_attempts: int, max_running: int = 1, lease: float = 300,
+                 retry_delay: float = 30):
+        self.db_path = db_path
+        self.wal_path = f"{db_path}-wal"
+        self.max_attempts = max_attempts
+        self.max_running = max_running
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self._ready = False  # Esquema comprobado en este proceso
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            # Perder los últimos cambios en una caída solo repite o reencola trabajos; quien
+            # necesite más sincroniza wal_path
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                with conn:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS jobs ("
+                        "id INTEGER PRIMARY KEY, type TEXT NOT NULL, key TEXT, payload TEXT NOT NULL, "
+                        "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, "
+                        "run_after REAL NOT NULL, lease_until REAL, worker TEXT, "
+                        "progress INTEGER NOT NULL DEFAULT 0, total INTEGER, message TEXT, error TEXT, "
+                        "created_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL)")
+                    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_after)")
+                    conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+                self._ready = True
+            yield conn
+        finally:
+            conn.close()
+
+    def _row_to_job(self, row) -> dict:
+        job = dict(zip(self.COLUMNS, row))
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def enqueue(self, job_type: str, payload: dict, key=None, max_attempts=None, min_interval: float = 0) -> tuple:
+        """
+        Añade un trabajo a la cola.
+
+        Args:
+            job_type (str): El tipo de trabajo (una clave de JOB_HANDLERS de file_service).
+            payload (dict): Los datos del trabajo.
+            key (str): Si hay un trabajo con la misma clave pendiente o en curso, no se encola otro.
+            max_attempts (int): Intentos antes de darlo por fallido (por defecto los de la cola).
+            min_interval (float): Tampoco se encola si el último con esa clave se creó hace menos.
+
+        Returns:
+            tuple: (id del trabajo, True si se ha creado o False si ya existía).
+        """
+        now = time.time()
+        with self.connect() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if key is not None:
+                row = conn.execute("SELECT id, status, created_at FROM jobs WHERE key = ? ORDER BY id DESC LIMIT 1",
+                                   (key,)).fetchone()
+                if row is not None and (row[1] in ("queued", "running") or now - row[2] < min_interval):
+                    return row[0], False
+            cursor = conn.execute(
+                "INSERT INTO jobs (type, key, payload, status, max_attempts, run_after, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_type, key, json.dumps(payload), max_attempts or self.max_attempts, now, now, now))
+            return cursor.lastrowid, True
+
+    def claim(self, worker: str):
+        """
+        Reclama el siguiente trabajo listo, o uno cuyo worker ha dejado caducar el lease.
+
+        Args:
+            worker (str): Identificador del worker.
+
+        Returns:
+            dict: El trabajo (ya en estado running), o None si no hay ninguno o ya se ha
+            alcanzado `max_running`.
+        """
+        now = time.time()
+        columns = ", ".join(self.COLUMNS)
+        with self.connect() as conn:
+            # Lectura sin lock de escritura: casi siempre la cola está vacía
+            if conn.execute("SELECT 1 FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                            "OR (status = 'running' AND lease_until <= ?) LIMIT 1", (now, now)).fetchone() is None:
+                return None
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running' AND lease_until > ?",
+                                       (now,)).fetchone()[0]
+                if running >= self.max_running:
+                    return None
+                while True:
+                    # Los trabajos abandonados van antes que los nuevos
+                    row = (conn.execute(f"SELECT {columns} FROM jobs WHERE status = 'running' AND lease_until <= ? "
+                                        "ORDER BY lease_until LIMIT 1", (now,)).fetchone()
+                           or conn.execute(f"SELECT {columns} FROM jobs WHERE status = 'queued' AND run_after <= ? "
+                                           "ORDER BY run_after, id LIMIT 1", (now,)).fetchone())
+                    if row is None:
+                        return None
+                    job = self._row_to_job(row)
+                    if job["status"] == "running" and job["attempts"] >= job["max_attempts"]:
+                        conn.execute("UPDATE jobs SET status = 'failed', error = COALESCE(error, 'Lease expired'), "
+                                     "worker = NULL, lease_until = NULL, updated_at = ?, finished_at = ? WHERE id = ?",
+                                     (now, now, job["id"]))
+                        continue
+                    conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, "
+                                 "lease_until = ?, updated_at = ? WHERE id = ?",
+                                 (worker, now + self.lease, now, job["id"]))
+                    job.update(status="running", attempts=job["attempts"] + 1, updated_at=now)
+                    return job
+
+    def _update(self, job_id: int, worker: str, assignments: str, params: tuple) -> bool:
+        # Solo el worker que tiene el trabajo puede cambiarlo
+        with self.connect() as conn, conn:
+            cursor = conn.execute(f"UPDATE jobs SET {assignments}, updated_at = ? "
+                                  "WHERE id = ? AND worker = ? AND status = 'running'",
+                                  params + (time.time(), job_id, worker))
+            return cursor.rowcount == 1
+
+    def report(self, job_id: int, worker: str, progress: int, total=None, message=None) -> bool:
+        """
+        Guarda el progreso de un trabajo y renueva su lease.
+
+        Returns:
+            bool: False si el trabajo ya no pertenece a este worker.
+        """
+        return self._update(job_id, worker, "progress = ?, total = ?, message = COALESCE(?, message), lease_until = ?",
+                            (progress, total, message, time.time() + self.lease))
+
+    def finish(self, job_id: int, worker: str, message=None) -> bool:
+        return self._update(job_id, worker, "status = 'done', message = COALESCE(?, message), error = NULL, "
+                            "worker = NULL, lease_until = NULL, finished_at = ?", (message, time.time()))
+
+    def release(self, job_id: int, worker: str) -> bool:
+        # Devolver un trabajo interrumpido no cuenta como intento
+        return self._update(job_id, worker, "status = 'queued', attempts = attempts - 1, worker = NULL, "
+                            "lease_until = NULL, run_after = ?", (time.time(),))
+
+    def fail(self, job_id: int, worker: str, error: str, retry: bool = True) -> str:
+        """
+        Registra el fallo de un intento y, si quedan intentos, lo vuelve a encolar con espera exponencial.
+
+        Returns:
+            str: 'retry', 'failed' o 'lost' (el trabajo ya no pertenece a este worker).
+        """
+        now = time.time()
+        with self.connect() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? AND status = 'running'",
+                               (job_id, worker)).fetchone()
+            if row is None:
+                return "lost"
+            if retry and row[0] < row[1]:
+                conn.execute("UPDATE jobs SET status = 'queued', error = ?, worker = NULL, lease_until = NULL, "
+                             "run_after = ?, updated_at = ? WHERE id = ?",
+                             (error, now + self.retry_delay * 2 ** (row[0] - 1), now, job_id))
+                return "retry"
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, worker = NULL, lease_until = NULL, "
+                         "updated_at = ?, finished_at = ? WHERE id = ?", (error, now, now, job_id))
+            return "failed"
+
+    def retry(self, job_id: int) -> bool:
+        """
+        Vuelve a encolar un trabajo fallido con todos sus intentos.
+
+        Returns:
+            bool: False si el trabajo no existe o no ha fallado.
+        """
+        now = time.time()
+        with self.connect() as conn, conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?, updated_at = ?, "
+                                  "finished_at = NULL WHERE id = ? AND status = 'failed'", (now, now, job_id))
+            return cursor.rowcount == 1
+
+    def get(self, job_id: int):
+        with self.connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row is not None else None
+
+    def list_jobs(self, status=None, job_type=None, limit: int = 100) -> list:
+        """
+        Devuelve los trabajos más recientes, opcionalmente filtrados por estado y tipo.
+        """
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE 1"
+        params = []
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        if job_type:
+            query += " AND type = ?"
+            params.append(job_type)
+        with self.connect() as conn:
+            rows = conn.execute(query + " ORDER BY id DESC LIMIT ?", params + [limit]).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def counts(self) -> dict:
+        with self.connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def prune(self, age: float) -> int:
+        """
+        Borra los trabajos terminados (done o failed) hace más de `age` segundos.
+
+        Returns:
+            int: Número de trabajos borrados.
+        """
+        with self.connect() as conn, conn:
+            return conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                                (time.time() - age,)).rowcount
@@ -0,0 +1,40 @@
+import asyncio
+from contextlib import asynccontextmanager
+from .metrics import Metrics
+
+"""
+locks.py
+Locks asyncio por clave.
+"""
+
+class KeyedLocks:
+    """
+    Locks asyncio por clave (un usuario, un archivo...), creados al pedirlos y eliminados
+    en cuanto nadie los usa. Las peticiones sobre claves distintas nunca se esperan entre
+    sí; las esperas sobre una clave ocupada se cuentan en lock_waits_total.
+    """
+
+    def __init__(self, name: str, metrics: Metrics):
+        self.name = name
+        self.metrics = metrics
+        metrics.describe("lock_waits_total", "counter", "Peticiones que han tenido que esperar un lock por clave.")
+        self._locks: dict = {}  # clave -> [lock, peticiones que lo usan o esperan]
+
+    @asynccontextmanager
+    async def lock(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.metrics.inc("lock_waits_total", (("lock", self.name),))
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import threading
+from contextlib import contextmanager
+from quart import request, g
+
+"""
+metrics.py
+Registro de métricas en el formato de texto de Prometheus y hooks que miden todas las peticiones.
+"""
+
+# Métricas en el formato de texto de Prometheus, expuestas en /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Segundos
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)  # Elementos recorridos
+
+class Metrics:
+    """
+    Registro de contadores, gauges e histogramas con salida en el formato de Prometheus.
+
+    Cada serie es una entrada de diccionario indexada por (nombre, etiquetas), donde las
+    etiquetas son una tupla de pares (clave, valor). Registrar un valor cuesta una búsqueda
+    y una suma bajo un lock, por lo que puede quedarse activo en producción.
+
+    Con varios workers cada proceso tiene su propio registro. Si se indica `directory`,
+    cada uno vuelca el suyo en <directory>/<pid>.json (cada `flush_interval` segundos y al
+    generar /metrics) y render() agrega los de todos: contadores e histogramas se suman,
+    también los de workers ya terminados para que no retrocedan, y los gauges se exponen
+    por worker (etiqueta `worker`) y solo los de procesos vivos.
+    """
+
+    def __init__(self, directory: str = None, flush_interval: float = 5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.families = {}    # nombre -> (tipo, descripción, buckets)
+        self.values = {}      # (nombre, etiquetas) -> valor de un contador o gauge
+        self.histograms = {}  # (nombre, etiquetas) -> [cuenta por bucket..., +Inf, suma, total]
+        self._lock = threading.Lock()  # Se registran valores desde los hilos de los pools
+        self._stop = threading.Event()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def describe(self, name: str, kind: str, text: str, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.families[name] = (kind, text, buckets)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        key = (name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, labels: tuple, value: float) -> None:
+        with self._lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        buckets = self.families[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(buckets) + 3)
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, labels: tuple = ()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - start)
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+    def _snapshot(self):
+        with self._lock:
+            values = list(self.values.items())
+            histograms = [(key, list(histogram)) for key, histogram in self.histograms.items()]
+        return values, histograms
+
+    def write_snapshot(self) -> None:
+        """
+        Vuelca las métricas de este proceso en <directory>/<pid>.json (temporal y rename).
+        """
+        values, histograms = self._snapshot()
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({"values": [[name, labels, value] for (name, labels), value in values],
+                       "histograms": [[name, labels, histogram] for (name, labels), histogram in histograms]}, f)
+        os.replace(tmp_file, path)
+
+    def clear_directory(self) -> None:
+        """
+        Borra los volcados de una ejecución anterior; se llama al arrancar, antes de los workers.
+        """
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json"):
+                os.remove(os.path.join(self.directory, filename))
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _collect(self):
+        # Agrega los volcados de todos los workers (ver la descripción de la clase)
+        self.write_snapshot()
+        values, histograms = {}, {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json") or not filename[:-len(".json")].isdigit():
+                continue
+            pid = int(filename[:-len(".json")])
+            try:
+                with open(os.path.join(self.directory, filename), 'r') as f:
+                    snapshot = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            alive = None
+            for name, labels, value in snapshot["values"]:
+                if name not in self.families:
+                    continue
+                labels = tuple(tuple(label) for label in labels)
+                if self.families[name][0] == "gauge":
+                    if alive is None:
+                        alive = self._alive(pid)
+                    if not alive:
+                        continue
+                    labels += (("worker", str(pid)),)
+                values[(name, labels)] = values.get((name, labels), 0) + value
+            for name, labels, histogram in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.get(key)
+                if total is None or len(total) != len(histogram):
+                    histograms[key] = list(histogram)
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, histogram)]
+        return list(values.items()), list(histograms.items())
+
+    def start_flushing(self) -> None:
+        """
+        Vuelca las métricas cada flush_interval segundos en un hilo, si hay directorio.
+        """
+        if not self.directory:
+            return
+
+        def flush():
+            while not self._stop.wait(self.flush_interval):
+                self.write_snapshot()
+
+        self._stop.clear()
+        threading.Thread(target=flush, name='metrics', daemon=True).start()
+
+    def stop_flushing(self) -> None:
+        if self.directory:
+            self._stop.set()
+            self.write_snapshot()
+
+    def render(self) -> str:
+        """
+        Genera la exposición en texto de todas las métricas (de todos los workers si hay directorio).
+
+        Returns:
+            str: Las métricas en el formato de texto de Prometheus.
+        """
+        values, histograms = self._collect() if self.directory else self._snapshot()
+        lines = []
+        for name, (kind, text, buckets) in self.families.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                lines.extend(f"{name}{self._labels(labels)} {value}" for (family, labels), value in values if family == name)
+                continue
+            for (family, labels), histogram in histograms:
+                if family != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram[-2]}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+def install_request_metrics(app, metrics: Metrics) -> None:
+    """
+    Registra en la aplicación los hooks que cuentan y miden todas las peticiones.
+
+    Args:
+        app (Quart): La aplicación del servicio.
+        metrics (Metrics): El registro de métricas del servicio.
+    """
+    metrics.describe("http_requests_total", "counter", "Peticiones atendidas por ruta, método y código de estado.")
+    metrics.describe("http_request_duration_seconds", "histogram", "Tiempo hasta generar la respuesta, por ruta, método y código de estado.")
+    metrics.describe("http_requests_in_flight", "gauge", "Peticiones en curso por ruta.")
+
+    @app.before_serving
+    async def start_metrics_flush():
+        metrics.start_flushing()
+
+    @app.after_serving
+    async def stop_metrics_flush():
+        metrics.stop_flushing()
+
+    @app.before_request
+    async def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        g.metrics_route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.inc("http_requests_in_flight", (("route", g.metrics_route),))
+
+    @app.after_request
+    async def record_request_metrics(response):
+        labels = (("route", g.metrics_route), ("method", request.method), ("status", str(response.status_code)))
+        metrics.inc("http_requests_total", labels)
+        metrics.observe("http_request_duration_seconds", labels, time.perf_counter() - g.metrics_start)
+        return response
+
+    @app.teardown_request
+    async def finish_request_metrics(exc) -> None:
+        route = g.get("metrics_route")
+        if route is not None:
+            metrics.inc("http_requests_in_flight", (("route", route),), -1)
@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import hmac
+import uuid
+import time
+import random
+import cProfile
+import threading
+from quart import request, jsonify, Response, g
+
+"""
+profiling.py
+Perfilado de peticiones bajo demanda (cProfile o muestreo de pilas) y sus endpoints.
+"""
+
+# Marcos en los que un hilo está esperando trabajo: no aportan nada a la gráfica
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("thread.py", "_worker"), ("queues.py", "get")}
+
+class StackSampler:
+    """
+    Perfilador por muestreo: un hilo toma cada `interval` segundos la pila de todos los
+    hilos del proceso, incluidos los pools de hashing y de E/S, que cProfile no ve.
+    El resultado está en formato de pilas colapsadas (flamegraph.pl, speedscope).
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self._thread.ident:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def enable(self) -> None:
+        self._thread.start()
+
+    def disable(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def dump_stats(self, path: str) -> None:
+        with open(path, 'w') as f:
+            for stack, count in self.counts.items():
+                f.write(f"{stack} {count}\n")
+
+class Profiling:
+    """
+    Perfilado de peticiones bajo demanda: se activa por configuración, con la cabecera
+    X-Profile (que debe contener `token`) o desde el endpoint /profiling. Los volcados
+    (.pstats de cProfile o .collapsed del muestreo) se guardan en `directory`.
+
+    Los workers comparten el directorio: /profiling/<name> sirve los volcados de todos, y
+    la configuración cambiada con POST /profiling se guarda en <directory>/settings.json,
+    que un hilo de cada worker comprueba cada `settings_interval` segundos.
+    """
+
+    def __init__(self, directory: str, token: str, max_dumps: int, sample_interval: float,
+                 mode: str, sample_rate: float, route: str, settings_interval: float = 1.0):
+        self.directory = directory
+        self.token = token  # Secreto para la cabecera y el endpoint (vacío los desactiva)
+        self.max_dumps = max_dumps
+        self.sample_interval = sample_interval
+        self.settings = {
+            "mode": mode,  # 'cprofile' (volcado pstats) o 'sample' (pilas colapsadas)
+            "sample_rate": sample_rate,  # Fracción de peticiones perfiladas
+            "route": route,  # Ruta que se perfila siempre, p. ej. /get_user_uid/<name>
+        }
+        self.settings_path = os.path.join(directory, "settings.json")
+        self._settings_stat = None  # (inodo, mtime_ns, size) de settings.json cuando se leyó
+        self.settings_interval = settings_interval
+        self._stop = threading.Event()
+        self._lock = threading.Lock()  # cProfile solo admite un perfilador activo a la vez
+
+    def authorized(self) -> bool:
+        return bool(self.token) and hmac.compare_digest(request.headers.get('X-Profile', ''), self.token)
+
+    def load_settings(self) -> None:
+        """
+        Aplica la configuración guardada por cualquier worker, si ha cambiado desde la última lectura.
+        """
+        try:
+            st = os.stat(self.settings_path)
+        except FileNotFoundError:
+            return
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stat == self._settings_stat:
+            return
+        try:
+            with open(self.settings_path, 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self.settings.update({key: saved[key] for key in self.settings if key in saved})
+        self._settings_stat = stat
+
+    def save_settings(self, settings: dict) -> None:
+        """
+        Guarda la configuración para todos los workers (temporal y rename) y la aplica.
+
+        Args:
+            settings (dict): mode, sample_rate y route.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_file = f"{self.settings_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(settings, f)
+        os.replace(tmp_file, self.settings_path)
+        self.settings.update(settings)
+
+    def should_profile(self, route: str) -> bool:
+        """
+        Decide si se perfila la petición actual.
+
+        Args:
+            route (str): La regla de la ruta de la petición.
+
+        Returns:
+            bool: True si hay que perfilarla.
+        """
+        if route.startswith('/profiling'):
+            return False
+        if self.authorized():
+            return True
+        if self.settings["route"] and self.settings["route"] == route:
+            return True
+        return self.settings["sample_rate"] > 0 and random.random() < self.settings["sample_rate"]
+
+    def dumps(self) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.endswith((".pstats", ".collapsed")))
+
+    def write(self, profiler, route: str, status: int, elapsed: float) -> None:
+        """
+        Guarda el resultado de un perfilado y elimina los volcados que sobran.
+
+        Args:
+            profiler (cProfile.Profile | StackSampler): El perfilador ya detenido.
+            route (str): La ruta perfilada.
+            status (int): El código de estado de la respuesta.
+            elapsed (float): Duración de la petición en segundos.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        extension = "collapsed" if isinstance(profiler, StackSampler) else "pstats"
+        name = "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
+        # Con microsegundos el orden alfabético es el de creación: la rotación borra los más antiguos
+        now = time.time()
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now % 1 * 1e6):06d}"
+        profiler.dump_stats(os.path.join(
+            self.directory,
+            f"{stamp}-{uuid.uuid4().hex[:8]}-{name}-{status}-{int(elapsed * 1000)}ms.{extension}"))
+        dumps = self.dumps()
+        for old in dumps[:max(len(dumps) - self.max_dumps, 0)]:
+            os.remove(os.path.join(self.directory, old))
+
+    def install(self, app) -> None:
+        """
+        Registra en la aplicación los hooks del perfilado y los endpoints /profiling y
+        /profiling/<name>.
+
+        Args:
+            app (Quart): La aplicación del servicio.
+        """
+
+        @app.before_serving
+        async def watch_profiling_settings():
+            # Fuera del bucle de eventos: las peticiones no hacen ningún stat por esto
+            def watch():
+                while not self._stop.wait(self.settings_interval):
+                    self.load_settings()
+
+            self.load_settings()
+            self._stop.clear()
+            threading.Thread(target=watch, name='profiling-settings', daemon=True).start()
+
+        @app.after_serving
+        async def stop_watching_profiling_settings():
+            self._stop.set()
+
+        @app.before_request
+        async def start_profiling():
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            if not self.should_profile(route) or not self._lock.acquire(blocking=False):
+                return
+            # Mientras dura el perfilado se registra todo lo que ejecuta el proceso, también
+            # otras peticiones que se atiendan a la vez
+            profiler = StackSampler(self.sample_interval) if self.settings["mode"] == "sample" else cProfile.Profile()
+            profiler.enable()
+            g.profiler = (profiler, route, time.perf_counter())
+
+        @app.after_request
+        async def stop_profiling(response):
+            if g.get("profiler") is None:
+                return response
+            profiler, route, start = g.profiler
+            g.profiler = None
+            try:
+                profiler.disable()
+                self.write(profiler, route, response.status_code, time.perf_counter() - start)
+            finally:
+                self._lock.release()
+            return response
+
+        @app.teardown_request
+        async def release_profiler(exc) -> None:
+            # Si la petición falla antes de after_request el perfilador se detiene sin volcarlo
+            if g.get("profiler") is not None:
+                g.profiler[0].disable()
+                g.profiler = None
+                self._lock.release()
+
+        @app.route('/profiling', methods=['GET', 'POST'])
+        async def profiling_settings():
+            """
+            Consulta o cambia el perfilado de peticiones sin reiniciar el servicio.
+
+            Request Headers:
+                - X-Profile: el token del perfilado.
+
+            Request JSON (POST, todos opcionales):
+                - mode (str): 'cprofile' o 'sample'.
+                - sample_rate (float): Fracción de peticiones perfiladas, entre 0 y 1.
+                - route (str): Ruta que se perfila siempre ('' para ninguna).
+
+            Returns:
+                JSON: La configuración actual y los volcados disponibles, o error.
+            """
+            if not self.authorized():
+                return jsonify({"Error": "Invalid profiling token"}), 403
+
+            self.load_settings()
+            if request.method == 'POST':
+                data = await request.get_json()
+                mode = data.get('mode', self.settings["mode"])
+                route = data.get('route', self.settings["route"])
+                try:
+                    sample_rate = float(data.get('sample_rate', self.settings["sample_rate"]))
+                except (TypeError, ValueError):
+                    return jsonify({"Error": "sample_rate must be a number"}), 400
+                if mode not in ("cprofile", "sample") or not 0 <= sample_rate <= 1 or not isinstance(route, str):
+                    return jsonify({"Error": "Invalid profiling settings"}), 400
+                self.save_settings({"mode": mode, "sample_rate": sample_rate, "route": route})
+
+            return jsonify({**self.settings, "dumps": self.dumps()}), 200
+
+        @app.get('/profiling/<name>')
+        async def get_profile(name: str):
+            """
+            Descarga un volcado (.pstats o .collapsed) del perfilado.
+
+            Request Headers:
+                - X-Profile: el token del perfilado.
+
+            Args:
+                name (str): El nombre del volcado.
+
+            Returns:
+                Response: El volcado o error.
+            """
+            if not self.authorized():
+                return jsonify({"Error": "Invalid profiling token"}), 403
+            if name not in self.dumps():
+                return jsonify({"Error": "Profile not found"}), 404
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return Response(f.read(), mimetype="application/octet-stream")
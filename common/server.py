@@ -0,0 +1,53 @@
+import os
+import importlib.util
+
+"""
+server.py
+Arranque de los servicios con Hypercorn.
+"""
+
+def server_config(application_path: str, port: int):
+    """
+    Configuración de Hypercorn a partir del entorno: SERVER_WORKERS procesos que comparten
+    el socket, uvloop si está disponible, HTTP/1.1 con keep-alive y HTTP/2 (h2c, o ALPN con
+    TLS). Con SIGTERM o SIGINT se dejan de aceptar conexiones y se esperan las peticiones en
+    curso hasta SERVER_GRACEFUL_TIMEOUT segundos antes de ejecutar after_serving.
+
+    Args:
+        application_path (str): El fichero del servicio; cada worker lo importa de nuevo y toma su `app`.
+        port (int): Puerto en el que escuchar.
+
+    Returns:
+        hypercorn.config.Config: La configuración.
+    """
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"0.0.0.0:{port}"]
+    config.application_path = f"{os.path.abspath(application_path)}:app"
+    config.workers = int(os.environ.get('SERVER_WORKERS', 1))  # Procesos worker (0 = en el propio proceso)
+    worker_class = os.environ.get('SERVER_WORKER_CLASS', 'auto')  # 'uvloop', 'asyncio' o 'auto' (uvloop si está instalado)
+    if worker_class == 'auto':
+        worker_class = 'uvloop' if importlib.util.find_spec('uvloop') else 'asyncio'
+    config.worker_class = worker_class
+    config.keep_alive_timeout = float(os.environ.get('SERVER_KEEP_ALIVE', 75))  # Segundos; mayor que el de un balanceador típico (60)
+    config.keep_alive_max_requests = int(os.environ.get('SERVER_KEEP_ALIVE_MAX_REQUESTS', 1000))  # Peticiones por conexión
+    config.graceful_timeout = float(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))  # Segundos para terminar las peticiones al parar
+    config.h2_max_concurrent_streams = int(os.environ.get('SERVER_H2_MAX_STREAMS', 100))  # Streams HTTP/2 simultáneos por conexión
+    config.backlog = int(os.environ.get('SERVER_BACKLOG', 1024))
+    config.certfile = os.environ.get('SERVER_CERTFILE')  # Con certificado se negocia HTTP/2 por ALPN; sin él, h2c
+    config.keyfile = os.environ.get('SERVER_KEYFILE')
+    config.accesslog = os.environ.get('SERVER_ACCESS_LOG', '') or None  # '-' para stdout, vacío para desactivarlo
+    config.errorlog = "-"
+    return config
+
+def serve(application_path: str, port: int) -> int:
+    """
+    Arranca un servicio con Hypercorn (ver server_config).
+
+    Returns:
+        int: Código de salida de Hypercorn.
+    """
+    from hypercorn.run import run
+
+    return run(server_config(application_path, port))
@@ -0,0 +1,80 @@
+import hmac
+import uuid
+import time
+import base64
+import hashlib
+
+"""
+tokens.py
+Tokens firmados con HMAC-SHA256 que emite user_service y validan los dos servicios.
+"""
+
+SECRET_UUID = uuid.UUID('00010203-0405-0607-0809-0a0b0c0d0e0f')  # UUID secreto
+
+# Tokens firmados "<kid>.<uid>.<exp>.<firma>": los emite user_service y los validan los dos
+# servicios con las mismas claves. SECRET_UUID es público, así que solo se usa como clave si
+# se pide explícitamente para desarrollo (ALLOW_DEV_TOKEN_KEY=1)
+
+def load_token_keys(spec: str, allow_dev_key: bool = False) -> dict:
+    """
+    Lee las claves HMAC de TOKEN_KEYS ("kid1=secreto1,kid2=secreto2").
+
+    Args:
+        spec (str): El valor de TOKEN_KEYS.
+        allow_dev_key (bool): Si no hay claves, usar SECRET_UUID en lugar de fallar.
+
+    Returns:
+        dict: kid -> secreto (bytes).
+
+    Raises:
+        RuntimeError: Si no hay claves y no se permite la clave de desarrollo.
+    """
+    keys = {}
+    for item in spec.split(','):
+        if '=' in item:
+            kid, secret = item.split('=', 1)
+            if kid.strip() and secret.strip():
+                keys[kid.strip()] = secret.strip().encode('utf-8')
+    if keys:
+        return keys
+    if not allow_dev_key:
+        raise RuntimeError("TOKEN_KEYS is required (set ALLOW_DEV_TOKEN_KEY=1 to use the public development key)")
+    return {"k1": SECRET_UUID.bytes}
+
+def sign_token(keys: dict, kid: str, uid: str, exp: int) -> str:
+    """
+    Calcula la firma HMAC-SHA256 de un token.
+
+    Args:
+        keys (dict): Las claves de load_token_keys.
+        kid (str): Identificador de la clave.
+        uid (str): El ID único del usuario.
+        exp (int): Instante de caducidad (segundos desde epoch).
+
+    Returns:
+        str: La firma en base64url sin relleno.
+    """
+    message = f"{kid}.{uid}.{exp}".encode('utf-8')
+    signature = hmac.new(keys[kid], message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(signature).rstrip(b'=').decode('ascii')
+
+def decode_token(keys: dict, token: str):
+    """
+    Comprueba la firma y la caducidad de un token.
+
+    Args:
+        keys (dict): Las claves de load_token_keys.
+        token (str): El token proporcionado.
+
+    Returns:
+        str: El UID del token si es válido, None si no lo es.
+    """
+    parts = token.split('.')
+    if len(parts) != 4:
+        return None
+    kid, uid, exp, signature = parts
+    if kid not in keys or not exp.isdigit() or int(exp) < time.time():
+        return None
+    if not hmac.compare_digest(signature, sign_token(keys, kid, uid, int(exp))):
+        return None
+    return uid
@@ -1,7 +1,43 @@
-from quart import Quart, request, jsonify, Response
+from quart import Quart, Request, request, jsonify, Response
+from werkzeug.http import parse_options_header, http_date
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
 import os
+import sys
 import uuid
 import json
+import hmac
+import base64
+import hashlib
+import time
+import asyncio
+import sqlite3
+import threading
+import mmap
+import codecs
+import heapq
+import math
+import unicodedata
+from array import array
+import shutil
+import re
+import gzip
+import zlib
+import mimetypes
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import aiofiles
+
+# Código compartido con user_service (paquete common; ver README)
+from common.metrics import COUNT_BUCKETS, Metrics, install_request_metrics
+from common.profiling import Profiling
+from common.durability import GroupCommit, fsync_paths
+from common.locks import KeyedLocks
+from common.tokens import load_token_keys, decode_token
+from common.jobs import JobQueue
+from common.changelog import ChangeLog
+from common.server import serve
 
 app = Quart(__name__)
 
@@ -14,186 +50,3255 @@ else:
     USER_DIR = "../user_service/users/" # Si se ejecuta en local la ruta de usuarios se encuentra en la carpeta user_service
 
 LIBRARY_DIR = "./libraries"  # Directorio donde se almacenan los archivos
-SECRET_UUID = uuid.UUID('00010203-0405-0607-0809-0a0b0c0d0e0f')  # UUID secreto
+# Tokens firmados por user_service: mismas claves ("kid1=secreto1,kid2=secreto2")
+ALLOW_DEV_TOKEN_KEY = os.environ.get('ALLOW_DEV_TOKEN_KEY', '') == '1'  # Sin TOKEN_KEYS, firmar con la clave pública de desarrollo
+TOKEN_KEYS = load_token_keys(os.environ.get('TOKEN_KEYS', ''), ALLOW_DEV_TOKEN_KEY)  # Sin claves no arranca
+REVOCATION_FILE = os.path.join(USER_DIR, ".revocations", "revoked_tokens")  # Lista de UID borrados que mantiene user_service
+REVOCATION_POLL_INTERVAL = float(os.environ.get('REVOCATION_POLL_INTERVAL', 2.0))  # Segundos entre relecturas
+USER_STORE = os.environ.get('USER_STORE', 'json')  # Backend de usuarios compartido con user_service: 'json' o 'sqlite'
+USER_DB = os.environ.get('USER_DB', os.path.join(USER_DIR, "users.db"))  # Base de datos del backend SQLite
+USER_CHANGE_LOG = os.path.join(USER_DIR, ".changes", "users.log")  # Altas, cambios y bajas que registra user_service (backend JSON)
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 1024 * 1024 * 1024))  # Tamaño máximo de un archivo subido (bytes)
+MAX_REQUEST_SIZE = int(os.environ.get('MAX_REQUEST_SIZE', 16 * 1024 * 1024))  # Cuerpo máximo de las peticiones JSON (bytes)
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 64 * 1024))  # Tamaño de bloque al enviar archivos
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 32))  # Hilos dedicados a operaciones de disco
+WRITE_DURABILITY = os.environ.get('WRITE_DURABILITY', 'none')  # 'none' (sin fsync), 'fsync' (uno por escritura) o 'group'
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW', 0))  # Espera extra (segundos) para juntar más escrituras
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))  # Rutas por lote; al llegar se sincroniza ya
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 100))  # Archivos por página de list_files por defecto
+LIST_MAX_PAGE_SIZE = int(os.environ.get('LIST_MAX_PAGE_SIZE', 1000))  # Máximo de archivos por página
+READ_MAX_LENGTH = int(os.environ.get('READ_MAX_LENGTH', 1024 * 1024))  # Tamaño máximo de una página de read_file
+CONTENT_CACHE_SIZE = int(os.environ.get('CONTENT_CACHE_SIZE', 64 * 1024 * 1024))  # Bytes de contenido en memoria (0 la desactiva)
+CONTENT_CACHE_MAX_ITEM = int(os.environ.get('CONTENT_CACHE_MAX_ITEM', 4 * 1024 * 1024))  # Los archivos mayores no se cachean
+UPLOAD_TMP_DIR = os.path.join(LIBRARY_DIR, ".uploads")  # Subidas en curso, se mueven a la biblioteca al terminar
+BLOB_DIR = os.path.join(LIBRARY_DIR, ".blobs")  # Contenido de los archivos, direccionado por su SHA-256
+SESSION_DIR = os.path.join(LIBRARY_DIR, ".sessions")  # Subidas por partes: <id>/session.json y <n>.part
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))  # Segundos sin actividad antes de expirar
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 300))  # Segundos entre limpiezas de sesiones
+MANIFEST_DIR = os.path.join(LIBRARY_DIR, ".manifests")  # <uid>.db: hash, codec, tamaño y versión de cada archivo, y uso de la biblioteca
+MANIFEST_CONNECTIONS = int(os.environ.get('MANIFEST_CONNECTIONS', 64))  # Bases de datos de manifiesto abiertas por hilo
+QUOTA_BYTES = int(os.environ.get('QUOTA_BYTES', 0))  # Bytes (sin comprimir) por usuario; 0 = sin límite
+QUOTA_FILES = int(os.environ.get('QUOTA_FILES', 0))  # Archivos por usuario; 0 = sin límite
+USAGE_RECONCILE_INTERVAL = float(os.environ.get('USAGE_RECONCILE_INTERVAL', 3600))  # Segundos entre recálculos del uso
+SEARCH_INDEX_DIR = os.path.join(LIBRARY_DIR, ".index")  # <uid>.db: índice invertido de cada biblioteca
+SEARCH_MAX_DOC_SIZE = int(os.environ.get('SEARCH_MAX_DOC_SIZE', 4 * 1024 * 1024))  # Los archivos mayores no se indexan
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))  # Resultados por página de /search por defecto
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE', 100))  # Máximo de resultados por página
+SEARCH_MAX_TERMS = int(os.environ.get('SEARCH_MAX_TERMS', 32))  # Términos por consulta como máximo
+JOB_DB = os.environ.get('JOB_DB', os.path.join(USER_DIR, ".jobs", "jobs.db"))  # Cola de trabajos compartida con user_service
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))  # Trabajos a la vez en cada proceso (0 = este proceso no ejecuta)
+JOB_MAX_RUNNING = int(os.environ.get('JOB_MAX_RUNNING', 2))  # Trabajos a la vez entre todos los procesos
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))  # Intentos antes de dar un trabajo por fallido
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', 30))  # Segundos tras el primer fallo; se duplica en cada intento
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 300))  # Segundos sin progreso antes de que otro worker retome el trabajo
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2.0))  # Segundos entre consultas con la cola vacía
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', 500))  # Archivos borrados entre dos informes de progreso
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 7 * 24 * 3600))  # Segundos que se conservan los trabajos terminados
+JOBS_TOKEN = os.environ.get('JOBS_TOKEN', '')  # Secreto de la cabecera X-Jobs-Token (vacío desactiva /jobs)
+ORPHAN_SWEEP_INTERVAL = float(os.environ.get('ORPHAN_SWEEP_INTERVAL', 24 * 3600))  # Segundos entre barridos (0 los desactiva)
+ORPHAN_MIN_AGE = float(os.environ.get('ORPHAN_MIN_AGE', 3600))  # Las bibliotecas modificadas hace menos no se barren
+COMPRESSION = os.environ.get('COMPRESSION', 'gzip')  # Códec para los blobs nuevos: 'gzip' o 'none'
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))  # Los archivos más pequeños no se comprimen
+COMPRESS_MIN_SAVING = float(os.environ.get('COMPRESS_MIN_SAVING', 0.1))  # Ahorro mínimo para guardar la versión comprimida
+GZIP_BLOCK_SIZE = int(os.environ.get('GZIP_BLOCK_SIZE', 64 * 1024))  # Bytes sin comprimir por miembro gzip (se descomprimen por separado)
+# Tipos que ya están comprimidos: no merece la pena intentarlo
+INCOMPRESSIBLE_TYPES = ("image/", "audio/", "video/", "application/zip", "application/gzip",
+                        "application/x-7z-compressed", "application/x-rar", "application/x-bzip2",
+                        "application/x-xz", "application/zstd", "application/pdf", "application/epub+zip")
+STREAM_CONTENT_TYPES = ("application/octet-stream", "multipart/form-data")
+
+# El límite de Quart se aplica a los cuerpos que se leen enteros en memoria (JSON); solo las
+# rutas que escriben el cuerpo en disco a medida que llega admiten hasta MAX_UPLOAD_SIZE
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_SIZE
+MULTIPART_OVERHEAD = 64 * 1024  # Margen para las cabeceras multipart sobre el tamaño del archivo
+
+class StreamingRequest(Request):
+    """
+    Petición con el límite de cuerpo de su ruta.
+
+    Quart fija el límite al crear la petición y empieza a acumular el cuerpo antes de que
+    se ejecute el manejador, así que el de las subidas en streaming (create_file con
+    application/octet-stream o multipart/form-data, y upload_part) se decide aquí.
+    """
+
+    def __init__(self, method, scheme, path, query_string, headers, *args, max_content_length=None, **kwargs):
+        if streamed_body(method, path, headers.get('Content-Type', '')):
+            max_content_length = MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD
+        super().__init__(method, scheme, path, query_string, headers, *args,
+                         max_content_length=max_content_length, **kwargs)
+
+def streamed_body(method: str, path: str, content_type: str) -> bool:
+    try:
+        endpoint, _ = app.url_map.bind("").match(path, method)
+    except HTTPException:
+        return False
+    if endpoint == "upload_part":
+        return True
+    return endpoint == "create_file" and parse_options_header(content_type)[0] in STREAM_CONTENT_TYPES
+
+app.request_class = StreamingRequest
 
 # Crear el directorio para las bibliotecas si no existe
 os.makedirs(LIBRARY_DIR, exist_ok=True)
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+os.makedirs(BLOB_DIR, exist_ok=True)
+os.makedirs(MANIFEST_DIR, exist_ok=True)
+os.makedirs(SESSION_DIR, exist_ok=True)
+os.makedirs(SEARCH_INDEX_DIR, exist_ok=True)
+os.makedirs(os.path.dirname(JOB_DB), exist_ok=True)
+
+# Métricas en el formato de texto de Prometheus, expuestas en /metrics
+JOB_BUCKETS = (0.1, 1.0, 10.0, 60.0, 300.0, 1800.0, 7200.0)  # Segundos de un trabajo en segundo plano
+
+METRICS_DIR = os.environ.get('METRICS_DIR', '')  # Volcados por worker que /metrics agrega (vacío: métricas del worker que responde)
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5.0))  # Segundos entre volcados de cada worker
+metrics = Metrics(METRICS_DIR or None, METRICS_FLUSH_INTERVAL)
+metrics.describe("file_io_duration_seconds", "histogram", "Tiempo de las operaciones de disco en el pool de E/S, incluida la espera.")
+metrics.describe("file_user_cache_refresh_duration_seconds", "histogram", "Tiempo de cada relectura del directorio de usuarios.")
+metrics.describe("file_user_cache_refresh_files", "histogram", "Ficheros recorridos en cada relectura del directorio de usuarios.", COUNT_BUCKETS)
+metrics.describe("file_library_scan_entries", "histogram", "Entradas recorridas por list_files en cada página.", COUNT_BUCKETS)
+metrics.describe("file_user_cache_events_total", "counter", "Aciertos, fallos y relecturas de la caché de usuarios.")
+metrics.describe("file_content_cache_events_total", "counter", "Aciertos, fallos, expulsiones e invalidaciones de la caché de contenido.")
+metrics.describe("file_content_cache_bytes", "gauge", "Bytes de contenido en la caché y su capacidad.")
+metrics.describe("file_usage_corrections_total", "counter", "Contadores de uso corregidos por la reconciliación periódica.")
+metrics.describe("file_quota_rejections_total", "counter", "Escrituras rechazadas por superar la cuota.")
+metrics.describe("file_search_index_duration_seconds", "histogram", "Tiempo de actualización del índice de búsqueda por archivo.")
+metrics.describe("file_search_query_duration_seconds", "histogram", "Tiempo de resolución de cada consulta de /search.")
+metrics.describe("file_jobs_total", "counter", "Trabajos en segundo plano ejecutados, por tipo y resultado.")
+metrics.describe("file_job_duration_seconds", "histogram", "Tiempo de cada ejecución de un trabajo en segundo plano.", JOB_BUCKETS)
+metrics.describe("file_jobs", "gauge", "Trabajos en la cola por estado.")
+
+install_request_metrics(app, metrics)
+
+# Perfilado de peticiones bajo demanda: se activa por configuración, con la cabecera
+# X-Profile (que debe contener PROFILE_TOKEN) o desde el endpoint /profiling
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')  # Directorio de los volcados
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')  # Secreto para la cabecera y el endpoint (vacío los desactiva)
+PROFILE_MAX_DUMPS = int(os.environ.get('PROFILE_MAX_DUMPS', 200))  # Se borran los volcados más antiguos
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))  # Segundos entre muestras (modo sample)
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')  # 'cprofile' (volcado pstats) o 'sample' (pilas colapsadas)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0))  # Fracción de peticiones perfiladas
+PROFILE_ROUTE = os.environ.get('PROFILE_ROUTE', '')  # Ruta que se perfila siempre, p. ej. /list_files
+
+profiling = Profiling(PROFILE_DIR, PROFILE_TOKEN, PROFILE_MAX_DUMPS, PROFILE_SAMPLE_INTERVAL,
+                      PROFILE_MODE, PROFILE_SAMPLE_RATE, PROFILE_ROUTE)
+profiling.install(app)
+
+# Todas las operaciones de disco de los endpoints se ejecutan en este pool para que una
+# escritura o lectura lenta no detenga el bucle de eventos
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='io')
+
+async def run_io(func, *args):
+    """
+    Ejecuta una operación de disco bloqueante en el pool de E/S.
+
+    Args:
+        func (callable): La función bloqueante (os.remove, os.listdir...).
+        *args: Argumentos de la función.
+
+    Returns:
+        El resultado de la función.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(io_executor, func, *args)
+    finally:
+        metrics.observe("file_io_duration_seconds", (("op", getattr(func, "__name__", "call")),),
+                        time.perf_counter() - start)
+
+durable_writes = GroupCommit(WRITE_DURABILITY, GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH, metrics)
+
+def open_async(file_path: str, mode: str):
+    """
+    Abre un archivo con aiofiles usando el pool de E/S.
+
+    Args:
+        file_path (str): Ruta del archivo.
+        mode (str): Modo de apertura.
+
+    Returns:
+        Contexto asíncrono que devuelve el archivo abierto.
+    """
+    return aiofiles.open(file_path, mode, executor=io_executor)
+
+class RevocationList:
+    """
+    UID borrados cuyos tokens todavía no han caducado.
+
+    Se lee del fichero que mantiene user_service desde una tarea en segundo plano, de
+    modo que comprobar un token no toca el disco.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.revoked: dict = {}  # uid -> instante en que caducan sus últimos tokens
+        self._mtime = None
+
+    def reload(self) -> None:
+        """
+        Vuelve a leer el fichero si ha cambiado desde la última lectura.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.revoked, self._mtime = {}, None
+            return
+        # user_service reescribe la lista con tmp + rename: cada versión es un inodo nuevo
+        mtime = (st.st_ino, st.st_mtime_ns)
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.revoked = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self._mtime = mtime
+
+    def is_revoked(self, uid: str) -> bool:
+        """
+        Indica si los tokens del usuario han sido revocados.
+
+        Args:
+            uid (str): El ID único del usuario.
+
+        Returns:
+            bool: True si el usuario fue borrado, False si no.
+        """
+        expires = self.revoked.get(uid)
+        return expires is not None and expires > time.time()
+
+revocations = RevocationList(REVOCATION_FILE)
+revocations.reload()
+
+def validate_token(token: str, uid: str) -> bool:
+    """
+    Valida en memoria un token "<kid>.<uid>.<exp>.<firma>" emitido por user_service.
+
+    Args:
+        token (str): Token proporcionado.
+        uid (str): El ID del usuario al que debe pertenecer el token.
+
+    Returns:
+        bool: True si la firma es correcta, el token no ha caducado, pertenece al usuario
+        y el usuario no ha sido borrado; False si no.
+    """
+    return decode_token(TOKEN_KEYS, token) == uid and not revocations.is_revoked(uid)
+
+async def poll_revocations():
+    while True:
+        await asyncio.sleep(REVOCATION_POLL_INTERVAL)
+        try:
+            await run_io(revocations.reload)
+        except OSError:
+            pass
+
+background_tasks = []
+
+@app.before_serving
+async def start_background_tasks():
+    background_tasks.append(asyncio.create_task(poll_revocations()))
+    background_tasks.append(asyncio.create_task(expire_upload_sessions()))
+    background_tasks.append(asyncio.create_task(reconcile_all_usage()))
+    background_tasks.append(asyncio.create_task(schedule_orphan_sweeps()))
+    for n in range(JOB_WORKERS):
+        background_tasks.append(asyncio.create_task(run_jobs(f"{os.getpid()}-{uuid.uuid4().hex[:8]}-{n}")))
+
+@app.after_serving
+async def stop_background_tasks():
+    # Los trabajos en curso se devuelven a la cola en su siguiente informe de progreso
+    jobs_stopping.set()
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+
+class UserCache:
+    """
+    Conjunto en memoria de los UID existentes en el directorio compartido de usuarios.
+
+    El directorio se lee entero al arrancar y cuando user_service rota su registro de
+    cambios (ChangeLog); el resto del tiempo cada consulta cuesta un stat del registro y,
+    si ha crecido, la lectura de los ficheros de usuario que aparecen en él. Un fallo se
+    resuelve con el conjunto en memoria, sin volver a recorrer el directorio.
+    """
+
+    def __init__(self, user_dir: str, change_log_path: str):
+        self.user_dir = user_dir
+        self.change_log = ChangeLog(change_log_path, 0)  # Solo se lee: lo escribe y lo rota user_service
+        self.uids: set = set()
+        self._files: dict = {}  # nombre de fichero -> ((inodo, mtime_ns, size), uid)
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._lock = threading.Lock()  # Se consulta desde los hilos del pool de E/S
+        # Lo que se escriba en el registro mientras se recorre el directorio se lee después
+        self.change_log.mark()
+        self.refresh()
+
+    def _read(self, filename: str, known=None):
+        # Con el inodo, una reescritura (tmp + rename) en el mismo tick del mtime no pasa desapercibida
+        user_file = os.path.join(self.user_dir, filename)
+        try:
+            st = os.stat(user_file)
+        except FileNotFoundError:
+            return None
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if known and known[0] == stat:
+            return known
+        try:
+            with open(user_file, 'r') as f:
+                return (stat, json.load(f)['uid'])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def refresh(self) -> None:
+        """
+        Sincroniza el conjunto de UID con el contenido del directorio de usuarios.
+        """
+        start = time.perf_counter()
+        try:
+            filenames = os.listdir(self.user_dir)
+        except FileNotFoundError:
+            filenames = []
+
+        files = {}
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            entry = self._read(filename, self._files.get(filename))
+            if entry is not None:
+                files[filename] = entry
+
+        self._files = files
+        self.uids = {uid for _, uid in files.values()}
+        self.refreshes += 1
+        metrics.observe("file_user_cache_refresh_duration_seconds", (), time.perf_counter() - start)
+        metrics.observe("file_user_cache_refresh_files", (), len(filenames))
+
+    def _sync(self) -> None:
+        # Un stat del registro; si user_service ha escrito, se releen solo esos ficheros
+        changes = self.change_log.changes()
+        if changes is None:
+            self.refresh()
+            return
+        for change in changes:
+            filename = f"{change['name']}.json"
+            known = self._files.pop(filename, None)
+            if known is not None:
+                self.uids.discard(known[1])
+            entry = self._read(filename, known)
+            if entry is not None:
+                self._files[filename] = entry
+                self.uids.add(entry[1])
+
+    def contains(self, uid: str) -> bool:
+        """
+        Indica si el UID pertenece a un usuario existente.
+
+        Args:
+            uid (str): El ID único del usuario.
+
+        Returns:
+            bool: True si el usuario existe, False si no.
+        """
+        with self._lock:
+            self._sync()
+            if uid in self.uids:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def count(self) -> int:
+        """
+        Cuenta los usuarios existentes, releyendo antes el directorio.
+
+        Returns:
+            int: Número de usuarios (0 si el directorio no existe).
+        """
+        with self._lock:
+            self.refresh()
+            return len(self.uids)
+
+    def stats(self) -> dict:
+        """
+        Devuelve los contadores de la caché.
+
+        Returns:
+            dict: Aciertos, fallos, relecturas y número de usuarios conocidos.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "users": len(self.uids),
+        }
+
+class SqliteUserCache:
+    """
+    Caché de UID existentes para el backend SQLite de user_service.
+
+    Guarda los UID ya comprobados y los descarta cuando `PRAGMA data_version` indica que
+    otra conexión (user_service) ha confirmado cambios en la base de datos. Los fallos se
+    resuelven con una consulta por el índice de `uid`.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.uids: set = set()
+        self.generation = None  # data_version de SQLite en la última comprobación
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._conn = None
+        self._lock = threading.Lock()  # Se consulta desde los hilos del pool de E/S
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Solo lectura: el esquema lo crea user_service
+            self._conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True,
+                                         timeout=30, check_same_thread=False)
+        return self._conn
+
+    def refresh(self) -> None:
+        """
+        Vacía la caché de UID conocidos.
+        """
+        self.uids = set()
+        self.refreshes += 1
+
+    def contains(self, uid: str) -> bool:
+        """
+        Indica si el UID pertenece a un usuario existente.
+
+        Args:
+            uid (str): El ID único del usuario.
+
+        Returns:
+            bool: True si el usuario existe, False si no.
+        """
+        with self._lock:
+            try:
+                conn = self._connect()
+                generation = conn.execute("PRAGMA data_version").fetchone()[0]
+            except sqlite3.OperationalError:
+                # La base de datos todavía no existe: no hay usuarios
+                self._conn = None
+                self.misses += 1
+                return False
+            if generation != self.generation:
+                self.refresh()
+                self.generation = generation
+
+            if uid in self.uids:
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            try:
+                found = conn.execute("SELECT 1 FROM users WHERE uid = ?", (uid,)).fetchone() is not None
+            except sqlite3.OperationalError:
+                return False
+            if found:
+                self.uids.add(uid)
+            return found
+
+    def count(self) -> int:
+        """
+        Cuenta los usuarios existentes.
+
+        Returns:
+            int: Número de usuarios (0 si la base de datos aún no existe).
+        """
+        with self._lock:
+            try:
+                return self._connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            except sqlite3.OperationalError:
+                self._conn = None
+                return 0
+
+    def stats(self) -> dict:
+        """
+        Devuelve los contadores de la caché.
+
+        Returns:
+            dict: Aciertos, fallos, invalidaciones y número de UID en caché.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "users": len(self.uids),
+        }
+
+if USER_STORE == 'sqlite':
+    user_cache = SqliteUserCache(USER_DB)
+else:
+    user_cache = UserCache(USER_DIR, USER_CHANGE_LOG)
+
+async def get_user(uid: str) -> bool:
+    """
+    Verifica si existe un usuario con el UID proporcionado en el directorio de usuarios.
+
+    Args:
+        uid (str): El ID único del usuario.
+
+    Returns:
+        bool: True si el usuario existe, False si no.
+    """
+    return await run_io(user_cache.contains, uid)
+
+class UploadTooLarge(Exception):
+    """
+    Se lanza cuando un archivo subido supera MAX_UPLOAD_SIZE.
+    """
+
+async def stream_upload(limit: int = MAX_UPLOAD_SIZE) -> tuple:
+    """
+    Escribe en disco el cuerpo de la petición a medida que llega, sin cargarlo en memoria.
+
+    Acepta un cuerpo `application/octet-stream` (el archivo tal cual) o `multipart/form-data`
+    (se guarda la primera parte de tipo archivo). Los datos se escriben en un archivo temporal
+    de UPLOAD_TMP_DIR mientras se calcula su SHA-256.
+
+    Args:
+        limit (int): Tamaño máximo del archivo (MAX_UPLOAD_SIZE, o menos si la cuota no da
+            para más). Si Content-Length ya lo supera no se escribe nada.
+
+    Returns:
+        tuple: (ruta del archivo temporal, número de bytes escritos, hash SHA-256 en hex).
+
+    Raises:
+        UploadTooLarge: Si el archivo supera `limit`.
+        ValueError: Si el cuerpo multipart no es válido o no contiene ningún archivo.
+    """
+    overhead = MULTIPART_OVERHEAD if request.mimetype == "multipart/form-data" else 0
+    if request.content_length is not None and request.content_length > limit + overhead:
+        raise UploadTooLarge()
+
+    tmp_path = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        async with open_async(tmp_path, 'wb') as f:
+            if request.mimetype == "multipart/form-data":
+                boundary = parse_options_header(request.headers.get('Content-Type', ''))[1].get('boundary')
+                if not boundary:
+                    raise ValueError("Missing multipart boundary")
+                decoder = MultipartDecoder(boundary.encode('latin-1'))
+                in_file = False
+                found_file = False
+                finished = False
+
+                def file_data():
+                    # Procesa los eventos pendientes y devuelve los datos de la parte de archivo
+                    nonlocal in_file, found_file, finished
+                    pieces = []
+                    event = decoder.next_event()
+                    while not isinstance(event, NeedData):
+                        if isinstance(event, Epilogue):
+                            finished = True
+                            break
+                        if isinstance(event, File):
+                            # Solo se guarda la primera parte de tipo archivo
+                            in_file = not found_file
+                            found_file = True
+                        elif isinstance(event, Field):
+                            in_file = False
+                        elif isinstance(event, Data) and in_file:
+                            pieces.append(event.data)
+                        event = decoder.next_event()
+                    return b"".join(pieces)
+
+                async for chunk in request.body:
+                    decoder.receive_data(chunk)
+                    piece = file_data()
+                    size += len(piece)
+                    if size > limit:
+                        raise UploadTooLarge()
+                    digest.update(piece)
+                    await f.write(piece)
+                decoder.receive_data(None)
+                piece = file_data()
+                size += len(piece)
+                if size > limit:
+                    raise UploadTooLarge()
+                digest.update(piece)
+                await f.write(piece)
+                if not found_file or not finished:
+                    raise ValueError("Multipart body without a complete file part")
+            else:
+                async for chunk in request.body:
+                    size += len(chunk)
+                    if size > limit:
+                        raise UploadTooLarge()
+                    digest.update(chunk)
+                    await f.write(chunk)
+    except BaseException:
+        await run_io(remove_if_exists, tmp_path)
+        raise
+    return tmp_path, size, digest.hexdigest()
+
+def remove_if_exists(file_path: str) -> bool:
+    """
+    Elimina un archivo si existe.
+
+    Args:
+        file_path (str): Ruta del archivo.
+
+    Returns:
+        bool: True si se ha eliminado, False si no existía.
+    """
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def valid_name(name) -> bool:
+    """
+    Indica si un nombre de archivo o UID es un único componente de ruta seguro dentro de
+    LIBRARY_DIR: sin separadores, sin '.' ni '..' y sin empezar por '.', porque los
+    directorios internos (.blobs, .manifests...) empiezan por punto.
+
+    Args:
+        name: El nombre recibido en la petición.
+
+    Returns:
+        bool: True si se puede usar en una ruta.
+    """
+    return (isinstance(name, str) and bool(name) and not name.startswith(".") and "/" not in name
+            and os.sep not in name and (os.altsep is None or os.altsep not in name) and "\0" not in name)
+
+# Almacén de blobs: cada contenido distinto se guarda una sola vez en BLOB_DIR y los archivos
+# de las bibliotecas son enlaces duros a su blob. El número de enlaces del blob es su contador
+# de referencias (lo mantiene el sistema de archivos) y el manifiesto guarda qué blob
+# corresponde a cada nombre para poder liberarlo al borrar o sobrescribir.
+
+# Las escrituras sobre un mismo archivo (uid, nombre) se ordenan entre sí, pero las de archivos
+# distintos, aunque sean de la misma biblioteca, no se esperan. Los lectores nunca toman estos
+# locks: las escrituras se publican con un rename atómico
+file_locks = KeyedLocks("file", metrics)
+upload_locks = KeyedLocks("upload", metrics)  # Commits de una misma sesión de subida
+
+def blob_path(digest: str, codec=None) -> str:
+    name = f"{digest}.gz" if codec == "gzip" else digest
+    return os.path.join(BLOB_DIR, digest[:2], name)
+
+# Los blobs gzip son una serie de miembros independientes de GZIP_BLOCK_SIZE bytes sin comprimir
+# (un gzip válido para cualquier cliente) y un índice "<blob>.idx" con el tamaño de bloque, el
+# tamaño sin comprimir y el offset comprimido de cada miembro: leer desde un offset solo obliga a
+# descomprimir el bloque que lo contiene. Los blobs anteriores no tienen índice y se leen desde
+# el principio
+def gzip_index_path(digest: str) -> str:
+    return blob_path(digest, "gzip") + ".idx"
+
+def find_blob(digest: str):
+    """
+    Busca el blob de un contenido, guardado sin comprimir o comprimido.
+
+    Args:
+        digest (str): Hash SHA-256 del contenido sin comprimir.
+
+    Returns:
+        tuple: (ruta, códec) del blob, o None si no existe.
+    """
+    for codec in (None, "gzip"):
+        path = blob_path(digest, codec)
+        if os.path.exists(path):
+            return path, codec
+    return None
+
+def choose_codec(filename: str, size: int):
+    """
+    Decide si merece la pena comprimir un archivo según su tamaño y su tipo.
+
+    Args:
+        filename (str): El nombre del archivo.
+        size (int): Tamaño del contenido en bytes.
+
+    Returns:
+        str: 'gzip' o None.
+    """
+    if COMPRESSION != "gzip" or size < COMPRESS_MIN_SIZE:
+        return None
+    mimetype = mimetypes.guess_type(filename)[0] or ""
+    if mimetype.startswith(INCOMPRESSIBLE_TYPES):
+        return None
+    return "gzip"
+
+def compress_file(source: str, size: int):
+    """
+    Comprime un archivo en miembros gzip de GZIP_BLOCK_SIZE bytes y se queda con el resultado
+    solo si ahorra espacio.
+
+    Args:
+        source (str): Ruta del archivo sin comprimir.
+        size (int): Tamaño del archivo.
+
+    Returns:
+        tuple: (ruta del archivo comprimido, índice de sus miembros), o None si no compensa.
+    """
+    target = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+    index = array('Q', (GZIP_BLOCK_SIZE, size))
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        while True:
+            block = src.read(GZIP_BLOCK_SIZE)
+            if not block:
+                break
+            index.append(dst.tell())
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: cabecera gzip, mtime 0
+            dst.write(compressor.compress(block) + compressor.flush())
+    if os.path.getsize(target) > size * (1 - COMPRESS_MIN_SAVING):
+        os.remove(target)
+        return None
+    return target, index
+
+def write_gzip_index(digest: str, index: array) -> None:
+    tmp_file = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+    with open(tmp_file, 'wb') as f:
+        index.tofile(f)
+    os.chmod(tmp_file, 0o444)
+    os.replace(tmp_file, gzip_index_path(digest))
+
+def gzip_member_at(file_path: str, digest: str, offset: int) -> tuple:
+    """
+    Busca en el índice del blob el miembro gzip que contiene un byte del contenido.
+
+    Args:
+        file_path (str): Ruta del archivo en la biblioteca (un enlace al blob).
+        digest (str): Hash del contenido.
+        offset (int): Byte del contenido sin comprimir.
+
+    Returns:
+        tuple: (offset comprimido, offset sin comprimir) del principio del miembro; (0, 0) si
+        el blob no tiene índice.
+    """
+    if digest is None or offset <= 0:
+        return 0, 0
+    try:
+        with open(gzip_index_path(digest), 'rb') as f:
+            header = array('Q')
+            header.fromfile(f, 2)
+            block_size, size = header
+            block = min(offset, max(size - 1, 0)) // block_size
+            f.seek((2 + block) * header.itemsize)
+            entry = array('Q')
+            entry.fromfile(f, 1)
+        with open(file_path, 'rb') as f:
+            # El índice solo describe el blob que enlaza ahora este archivo
+            if os.fstat(f.fileno()).st_ino != os.stat(blob_path(digest, "gzip")).st_ino:
+                return 0, 0
+            f.seek(entry[0])
+            if f.read(2) != b"\x1f\x8b":
+                return 0, 0
+    except (FileNotFoundError, EOFError, ValueError, ZeroDivisionError):
+        return 0, 0
+    return entry[0], block * block_size
+
+def gzip_content_size(digest: str, path: str) -> int:
+    """
+    Tamaño sin comprimir de un blob gzip: el de su índice o, en los blobs sin índice, el
+    que guarda el final del gzip (módulo 2**32).
+    """
+    try:
+        with open(gzip_index_path(digest), 'rb') as f:
+            header = array('Q')
+            header.fromfile(f, 2)
+            return header[1]
+    except (FileNotFoundError, EOFError):
+        pass
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), 'little')
+
+class ManifestStore:
+    """
+    Manifiesto de cada biblioteca en su propia base de datos SQLite (modo WAL),
+    MANIFEST_DIR/<uid>.db, compartida entre procesos: una fila por archivo (hash, codec, size,
+    version) y otra con el uso de la biblioteca (bytes y archivos).
+
+    Una escritura solo toca las filas del archivo y del uso, en una transacción BEGIN
+    IMMEDIATE que contiene la comprobación de versión y de cuota y el rename que publica el
+    archivo. Como cada biblioteca tiene su base de datos, las escrituras de usuarios distintos
+    nunca se esperan entre sí; los recorridos de la biblioteca (compute_usage) y los fsync se
+    hacen fuera de la transacción. Cada hilo mantiene abiertas las conexiones de las
+    `max_connections` bibliotecas usadas más recientemente y los lectores no se bloquean.
+    """
+
+    def __init__(self, directory: str, max_connections: int):
+        self.directory = directory
+        self.max_connections = max_connections
+        self._local = threading.local()
+        # Dentro de un proceso las transacciones de una biblioteca se ordenan aquí, sin los
+        # reintentos con espera de SQLite; entre procesos las ordena el lock de su base de datos
+        self._write_locks = {}  # uid -> [lock, hilos que lo usan o esperan]
+        self._write_locks_guard = threading.Lock()
+
+    def db_path(self, uid: str) -> str:
+        if not valid_name(uid):
+            raise ValueError(f"Invalid uid {uid!r}")
+        return os.path.join(self.directory, f"{uid}.db")
+
+    def wal_path(self, uid: str) -> str:
+        return f"{self.db_path(uid)}-wal"
+
+    def _connections(self) -> OrderedDict:
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = OrderedDict()  # uid -> (conexión, inodo)
+        return connections
+
+    def connection(self, uid: str, create: bool = False):
+        """
+        Devuelve la conexión del hilo con la base de datos de una biblioteca.
+
+        Args:
+            uid (str): El ID del usuario.
+            create (bool): Crear la base de datos si no existe (solo al escribir).
+
+        Returns:
+            sqlite3.Connection: La conexión, o None si la biblioteca no tiene manifiesto.
+        """
+        connections = self._connections()
+        entry = connections.get(uid)
+        if entry is not None:
+            connections.move_to_end(uid)
+            return entry[0]
+        if not valid_name(uid):
+            if create:
+                raise ValueError(f"Invalid uid {uid!r}")
+            return None
+        path = self.db_path(uid)
+        legacy = self._legacy_paths(uid)
+        exists = os.path.exists(path)
+        if not create and not exists and not legacy:
+            return None
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        # La durabilidad la da durable_writes sincronizando el WAL tras cada transacción
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "name TEXT PRIMARY KEY, hash TEXT, codec TEXT, size INTEGER, version INTEGER NOT NULL) WITHOUT ROWID")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL, files INTEGER NOT NULL)")
+        if legacy:
+            self._migrate(conn, legacy)
+        if not exists:
+            fsync_paths([self.directory])  # La entrada de la base de datos nueva
+        connections[uid] = (conn, os.stat(path).st_ino)
+        while len(connections) > self.max_connections:
+            connections.popitem(last=False)[1][0].close()
+        return conn
+
+    def _close(self, uid: str) -> None:
+        entry = self._connections().pop(uid, None)
+        if entry is not None:
+            entry[0].close()
+
+    def _current(self, uid: str) -> bool:
+        # drop() borra la base de datos con su lock tomado: una conexión abierta antes en
+        # otro hilo o proceso la ve desaparecer al empezar su siguiente transacción
+        try:
+            return os.stat(self.db_path(uid)).st_ino == self._connections()[uid][1]
+        except FileNotFoundError:
+            return False
+
+    def _legacy_paths(self, uid: str) -> list:
+        # Las versiones anteriores guardaban el manifiesto en MANIFEST_DIR/<uid>.json (a veces
+        # solo con el hash) y el uso en .usage/<uid>.json, protegidos por un flock
+        paths = (os.path.join(self.directory, f"{uid}.json"), os.path.join(LIBRARY_DIR, ".usage", f"{uid}.json"))
+        return [path for path in paths if os.path.exists(path)]
+
+    def _migrate(self, conn: sqlite3.Connection, legacy: list) -> None:
+        with self._transaction(conn):
+            for path in legacy:
+                try:
+                    with open(path, 'r') as f:
+                        data = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue  # Otro worker ya lo ha migrado
+                if os.path.dirname(path) != self.directory:
+                    conn.execute("INSERT OR IGNORE INTO usage (id, bytes, files) VALUES (0, ?, ?)",
+                                 (data["bytes"], data["files"]))
+                    continue
+                for name, entry in data.items():
+                    if isinstance(entry, str):
+                        entry = {"hash": entry, "codec": None, "size": None}
+                    conn.execute(
+                        "INSERT OR IGNORE INTO files (name, hash, codec, size, version) VALUES (?, ?, ?, ?, ?)",
+                        (name, entry["hash"], entry["codec"], entry["size"], entry.get("version", 1)))
+        for path in legacy:
+            remove_if_exists(path)
+
+    @contextmanager
+    def _write_lock(self, uid: str):
+        with self._write_locks_guard:
+            entry = self._write_locks.get(uid)
+            if entry is None:
+                entry = self._write_locks[uid] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._write_locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._write_locks[uid]
+
+    @contextmanager
+    def write(self, uid: str):
+        """
+        Abre una transacción de escritura en el manifiesto de una biblioteca; se confirma al
+        salir y se deshace si hay excepción.
+
+        Yields:
+            sqlite3.Connection: La conexión del hilo, para pasarla a get, put, remove...
+        """
+        with self._write_lock(uid):
+            while True:
+                conn = self.connection(uid, create=True)
+                conn.execute("BEGIN IMMEDIATE")
+                if self._current(uid):
+                    break
+                conn.execute("ROLLBACK")
+                self._close(uid)
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            if getattr(self._local, "dropped", None) == uid:
+                self._local.dropped = None
+                self._close(uid)
+
+    @contextmanager
+    def _transaction(self, conn: sqlite3.Connection):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, uid: str, name: str, conn=None):
+        """
+        Devuelve la entrada de un archivo: {hash, codec, size, version}, o None si no está.
+        """
+        conn = conn or self.connection(uid)
+        if conn is None:
+            return None
+        row = conn.execute("SELECT hash, codec, size, version FROM files WHERE name = ?", (name,)).fetchone()
+        return dict(zip(("hash", "codec", "size", "version"), row)) if row is not None else None
+
+    def entries(self, uid: str, conn=None) -> dict:
+        """
+        Devuelve el manifiesto de una biblioteca: nombre de archivo -> {hash, codec, size, version}.
+        """
+        conn = conn or self.connection(uid)
+        if conn is None:
+            return {}
+        rows = conn.execute("SELECT name, hash, codec, size, version FROM files")
+        return {row[0]: dict(zip(("hash", "codec", "size", "version"), row[1:])) for row in rows}
+
+    def put(self, conn: sqlite3.Connection, uid: str, name: str, entry: dict) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO files (name, hash, codec, size, version) VALUES (?, ?, ?, ?, ?)",
+            (name, entry["hash"], entry["codec"], entry["size"], entry["version"]))
+
+    def remove(self, conn: sqlite3.Connection, uid: str, names) -> list:
+        """
+        Quita archivos del manifiesto.
+
+        Returns:
+            list: Los hashes que nombraban (para liberar sus blobs).
+        """
+        released = []
+        for name in names:
+            entry = self.get(uid, name, conn)
+            if entry is not None:
+                conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                if entry["hash"]:
+                    released.append(entry["hash"])
+        return released
+
+    def usage(self, uid: str, conn=None):
+        """
+        Devuelve el uso guardado de una biblioteca: {bytes, files}, o None si aún no se ha calculado.
+        """
+        conn = conn or self.connection(uid)
+        if conn is None:
+            return None
+        row = conn.execute("SELECT bytes, files FROM usage WHERE id = 0").fetchone()
+        return {"bytes": row[0], "files": row[1]} if row is not None else None
+
+    def set_usage(self, conn: sqlite3.Connection, uid: str, usage: dict) -> None:
+        conn.execute("INSERT OR REPLACE INTO usage (id, bytes, files) VALUES (0, ?, ?)",
+                     (usage["bytes"], usage["files"]))
+
+    def drop(self, conn: sqlite3.Connection, uid: str) -> list:
+        """
+        Quita una biblioteca entera y borra su base de datos. Se llama dentro de write(uid):
+        los ficheros se borran con el lock de escritura tomado.
+
+        Returns:
+            list: Los hashes que nombraban sus archivos.
+        """
+        released = [row[0] for row in conn.execute("SELECT hash FROM files WHERE hash IS NOT NULL")]
+        conn.execute("DELETE FROM files")
+        conn.execute("DELETE FROM usage")
+        path = self.db_path(uid)
+        for suffix in ("", "-wal", "-shm"):
+            remove_if_exists(path + suffix)
+        self._local.dropped = uid
+        return released
+
+    def uids(self) -> set:
+        return {name.rsplit(".", 1)[0] for name in os.listdir(self.directory) if name.endswith((".db", ".json"))}
+
+manifests = ManifestStore(MANIFEST_DIR, MANIFEST_CONNECTIONS)
+
+def stored_file(uid: str, filename: str):
+    """
+    Localiza un archivo de la biblioteca y cómo está guardado.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+
+    Returns:
+        dict: path, codec (None o 'gzip'), size (tamaño sin comprimir), mtime, etag
+        (el hash del contenido, o inodo/mtime/tamaño si no está en el manifiesto), version
+        y hash (None si no está en el manifiesto), o None si no existe.
+    """
+    file_path = os.path.join(LIBRARY_DIR, uid, filename)
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    entry = manifests.get(uid, filename) or {"hash": None, "codec": None, "size": None, "version": 1}
+    if entry["hash"]:
+        etag = entry["hash"]
+    else:
+        etag = f"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"
+    size = st.st_size if entry["codec"] is None else entry["size"]
+    return {"path": file_path, "codec": entry["codec"], "size": size, "mtime": st.st_mtime, "etag": etag,
+            "version": entry["version"], "hash": entry["hash"]}
+
+class ContentCache:
+    """
+    Caché LRU en memoria del contenido (sin comprimir) de los archivos más leídos.
+
+    Las entradas se identifican por (uid, nombre, versión), donde la versión es el ETag del
+    archivo: si otro proceso lo modifica, la versión cambia y la entrada vieja deja de
+    servirse. De cada archivo se guarda solo una versión. La suma de los tamaños nunca
+    supera `capacity` bytes.
+    """
+
+    def __init__(self, capacity: int, max_item: int):
+        self.capacity = capacity
+        self.max_item = min(max_item, capacity)
+        self.entries: OrderedDict = OrderedDict()  # (uid, nombre) -> (versión, contenido)
+        self.resident = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()  # Se usa desde el bucle de eventos y desde el pool de E/S
+
+    def cacheable(self, size: int) -> bool:
+        return 0 < size <= self.max_item
+
+    def get(self, uid: str, filename: str, version: str):
+        """
+        Devuelve el contenido cacheado de una versión de un archivo.
+
+        Returns:
+            bytes: El contenido, o None si no está en la caché.
+        """
+        with self._lock:
+            entry = self.entries.get((uid, filename))
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((uid, filename))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, uid: str, filename: str, version: str, content: bytes) -> None:
+        """
+        Guarda una versión de un archivo, expulsando las entradas menos usadas si hace falta.
+        """
+        if not self.cacheable(len(content)):
+            return
+        with self._lock:
+            old = self.entries.pop((uid, filename), None)
+            if old is not None:
+                self.resident -= len(old[1])
+            while self.resident + len(content) > self.capacity:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.resident -= len(evicted)
+                self.evictions += 1
+            self.entries[(uid, filename)] = (version, content)
+            self.resident += len(content)
+
+    def invalidate(self, uid: str, filename: str) -> None:
+        with self._lock:
+            old = self.entries.pop((uid, filename), None)
+            if old is not None:
+                self.resident -= len(old[1])
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        """
+        Devuelve los contadores de la caché.
+
+        Returns:
+            dict: Aciertos, fallos, tasa de aciertos, expulsiones, invalidaciones, entradas y
+            bytes ocupados frente a la capacidad.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+                "resident_bytes": self.resident,
+                "capacity_bytes": self.capacity,
+            }
+
+content_cache = ContentCache(CONTENT_CACHE_SIZE, CONTENT_CACHE_MAX_ITEM)
+
+def load_content(uid: str, filename: str, info: dict):
+    """
+    Lee del disco el contenido sin comprimir de un archivo y lo guarda en la caché.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+        info (dict): Resultado de stored_file.
+
+    Returns:
+        bytes: El contenido, o None si el archivo es demasiado grande para cachearse.
+    """
+    if not content_cache.cacheable(info["size"]):
+        return None
+    try:
+        with open(info["path"], 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    if info["codec"] == "gzip":
+        content = gzip.decompress(content)
+    # Si el archivo cambió mientras se leía, el tamaño ya no coincide y no se cachea
+    if len(content) == info["size"]:
+        content_cache.put(uid, filename, info["etag"], content)
+    return content
+
+def release_blob(digest: str) -> None:
+    """
+    Elimina un blob si ya ninguna biblioteca lo referencia (solo queda su propio enlace).
+
+    Args:
+        digest (str): Hash del blob.
+    """
+    found = find_blob(digest)
+    if found is None:
+        return
+    try:
+        if os.stat(found[0]).st_nlink <= 1:
+            os.remove(found[0])
+            if found[1] == "gzip":
+                os.remove(gzip_index_path(digest))
+    except FileNotFoundError:
+        pass
+
+# Versiones: cada escritura de un archivo incrementa su versión en el manifiesto y los
+# clientes pueden condicionar una escritura o un borrado a ella (If-Match / If-None-Match)
+NEW_RECORD = 0  # Versión esperada de un archivo que aún no debe existir
+ANY_VERSION = "*"  # Basta con que el archivo exista
+
+class VersionConflict(Exception):
+    """
+    Se lanza cuando la versión actual de un archivo no es la que exige la petición.
+    """
+
+    def __init__(self, current):
+        super().__init__(current)
+        self.current = current  # Versión actual, None si el archivo no existe
+
+def check_version(current, expected) -> None:
+    """
+    Comprueba una condición de versión antes de escribir o borrar.
+
+    Args:
+        current (int): Versión actual, None si el archivo no existe.
+        expected: None (sin condición), NEW_RECORD, ANY_VERSION o la versión exacta.
+
+    Raises:
+        VersionConflict: Si la condición no se cumple.
+    """
+    if expected is None:
+        return
+    if expected == NEW_RECORD:
+        ok = current is None
+    elif expected == ANY_VERSION:
+        ok = current is not None
+    else:
+        ok = current == expected
+    if not ok:
+        raise VersionConflict(current)
+
+def current_version(uid: str, filename: str, entry):
+    """
+    Devuelve la versión actual de un archivo (1 para los que no están en el manifiesto).
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+        entry (dict): Su entrada del manifiesto, o None.
+
+    Returns:
+        int: La versión, o None si el archivo no existe.
+    """
+    if entry is not None:
+        return entry["version"]
+    return 1 if os.path.exists(os.path.join(LIBRARY_DIR, uid, filename)) else None
+
+# Uso de almacenamiento: la tabla usage del manifiesto guarda los bytes (sin comprimir) y
+# archivos de cada biblioteca. Se actualiza en la misma transacción que cada escritura y
+# borrado, y una pasada periódica lo recalcula desde el disco por si algo lo ha desviado
+
+class QuotaExceeded(Exception):
+    """
+    Se lanza cuando una escritura haría superar QUOTA_BYTES o QUOTA_FILES.
+    """
+
+    def __init__(self, usage: dict):
+        super().__init__(usage)
+        self.usage = usage  # Uso actual: {"bytes", "files"}
+
+def stored_size(uid: str, filename: str, entry):
+    """
+    Devuelve el tamaño sin comprimir de un archivo de la biblioteca.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+        entry (dict): Su entrada del manifiesto, o None.
+
+    Returns:
+        int: El tamaño, o None si el archivo no existe.
+    """
+    if entry is not None and entry["size"] is not None:
+        return entry["size"]
+    try:
+        return os.stat(os.path.join(LIBRARY_DIR, uid, filename)).st_size
+    except FileNotFoundError:
+        return None
+
+def compute_usage(uid: str) -> dict:
+    """
+    Calcula el uso de una biblioteca recorriéndola.
+
+    Args:
+        uid (str): El ID del usuario.
+
+    Returns:
+        dict: {"bytes", "files"}.
+    """
+    manifest = manifests.entries(uid)
+    usage = {"bytes": 0, "files": 0}
+    try:
+        entries = os.scandir(os.path.join(LIBRARY_DIR, uid))
+    except FileNotFoundError:
+        return usage
+    with entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            size = manifest[entry.name]["size"] if entry.name in manifest else None
+            usage["bytes"] += size if size is not None else entry.stat().st_size
+            usage["files"] += 1
+    return usage
+
+def current_usage(uid: str) -> dict:
+    """
+    Devuelve el uso de una biblioteca, calculándolo la primera vez.
+
+    Args:
+        uid (str): El ID del usuario.
+
+    Returns:
+        dict: {"bytes", "files"}.
+    """
+    usage = manifests.usage(uid)
+    if usage is None:
+        # El recorrido se hace fuera de la transacción; si entretanto otra escritura ya ha
+        # guardado el uso, gana el suyo
+        computed = compute_usage(uid)
+        with manifests.write(uid) as conn:
+            usage = manifests.usage(uid, conn)
+            if usage is None:
+                manifests.set_usage(conn, uid, computed)
+                usage = computed
+    return usage
+
+def check_quota(usage: dict, added_bytes: int, added_files: int) -> None:
+    """
+    Comprueba que una escritura cabe en la cuota. Las que no hacen crecer el uso siempre se
+    permiten, aunque la biblioteca ya esté por encima (por ejemplo, tras bajar la cuota).
+
+    Raises:
+        QuotaExceeded: Si la escritura haría superar QUOTA_BYTES o QUOTA_FILES.
+    """
+    if ((QUOTA_BYTES and added_bytes > 0 and usage["bytes"] + added_bytes > QUOTA_BYTES)
+            or (QUOTA_FILES and added_files > 0 and usage["files"] + added_files > QUOTA_FILES)):
+        raise QuotaExceeded(usage)
+
+def quota_allowance(uid: str, filename: str) -> tuple:
+    """
+    Calcula cuántos bytes puede ocupar `filename` sin superar la cuota, para rechazar una
+    subida antes de escribir nada. La comprobación definitiva se hace en store_blob.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El archivo que se va a escribir (lo que ya ocupa se descuenta).
+
+    Returns:
+        tuple: (bytes permitidos, o None si no hay cuota de bytes; uso actual).
+
+    Raises:
+        QuotaExceeded: Si el archivo es nuevo y ya no caben más archivos.
+    """
+    if not QUOTA_BYTES and not QUOTA_FILES:
+        return None, None
+    usage = current_usage(uid)
+    current = stored_size(uid, filename, manifests.get(uid, filename))
+    check_quota(usage, 0, 1 if current is None else 0)
+    if not QUOTA_BYTES:
+        return None, usage
+    return max(QUOTA_BYTES - usage["bytes"] + (current or 0), 0), usage
+
+def reconcile_usage(uid: str) -> bool:
+    """
+    Recalcula el uso de una biblioteca desde el disco y corrige el guardado si no coincide.
+
+    Returns:
+        bool: True si se ha corregido.
+    """
+    saved = manifests.usage(uid)
+    usage = compute_usage(uid)
+    if saved == usage:
+        return False
+    with manifests.write(uid) as conn:
+        # Si una escritura ha cambiado el uso mientras se recorría la biblioteca, el
+        # recuento puede estar a medias: se deja para la siguiente pasada
+        if manifests.usage(uid, conn) != saved:
+            return False
+        manifests.set_usage(conn, uid, usage)
+    metrics.inc("file_usage_corrections_total")
+    return True
+
+def store_blob(uid: str, filename: str, digest: str, tmp_path, size: int, expected_version=None) -> int:
+    """
+    Enlaza un archivo de la biblioteca con su blob, creando el blob si no existía.
+
+    Los blobs nuevos se comprimen con gzip cuando choose_codec lo indica y el resultado
+    ahorra al menos COMPRESS_MIN_SAVING; si el contenido ya existe se reutiliza tal como
+    esté guardado.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+        digest (str): Hash SHA-256 del contenido.
+        tmp_path (str): Archivo temporal con el contenido, o None si el blob ya existía.
+        size (int): Tamaño del contenido sin comprimir.
+        expected_version: Condición de versión (ver check_version), o None.
+
+    Returns:
+        int: La nueva versión del archivo.
+
+    Raises:
+        FileNotFoundError: Si tmp_path es None y el blob ha desaparecido entretanto.
+        VersionConflict: Si la versión actual no es la esperada (no se modifica nada).
+        QuotaExceeded: Si el archivo no cabe en la cuota del usuario (no se modifica nada).
+        ValueError: Si el UID o el nombre del archivo no son válidos (ver valid_name).
+    """
+    # Última barrera: ningún llamador puede escribir fuera de la biblioteca del usuario
+    if not valid_name(uid) or not valid_name(filename):
+        if tmp_path is not None:
+            remove_if_exists(tmp_path)
+        raise ValueError(f"Invalid filename {filename!r}")
+    os.makedirs(os.path.join(BLOB_DIR, digest[:2]), exist_ok=True)
+    user_library_dir = os.path.join(LIBRARY_DIR, uid)
+    os.makedirs(user_library_dir, exist_ok=True)
+    link_tmp = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+    compressed_tmp = None
+    compressed_index = None
+
+    def release_temporaries():
+        remove_if_exists(link_tmp)
+        if tmp_path is not None:
+            remove_if_exists(tmp_path)
+        if compressed_tmp is not None:
+            remove_if_exists(compressed_tmp)
+
+    try:
+        while True:
+            found = find_blob(digest)
+            if found is None and tmp_path is not None:
+                codec = None
+                source = tmp_path
+                if choose_codec(filename, size) == "gzip":
+                    if compressed_tmp is None:
+                        compressed_tmp, compressed_index = compress_file(tmp_path, size) or (None, None)
+                    if compressed_tmp is not None:
+                        codec, source = "gzip", compressed_tmp
+                try:
+                    os.link(source, blob_path(digest, codec))
+                    os.chmod(blob_path(digest, codec), 0o444)  # Los blobs son compartidos: nunca se modifican
+                    if codec == "gzip":
+                        # Hasta que aparece el índice el blob se lee desde el principio
+                        write_gzip_index(digest, compressed_index)
+                except FileExistsError:
+                    pass
+                found = (blob_path(digest, codec), codec)
+            if found is None:
+                raise FileNotFoundError(blob_path(digest))
+            try:
+                # El enlace temporal mantiene vivo el blob aunque otra biblioteca lo libere
+                os.link(found[0], link_tmp)
+                break
+            except FileNotFoundError:
+                # El blob se ha liberado entre medias: se vuelve a crear desde tmp_path
+                if tmp_path is None:
+                    raise
+        # El contenido es duradero antes de publicarlo; el fsync se comparte con las demás
+        # subidas en curso y se hace antes de la transacción
+        durable_writes.sync(found[0], os.path.dirname(found[0]))
+
+        # Una biblioteca sin uso guardado se recorre antes, fuera de la transacción
+        current_usage(uid)
+
+        # La transacción ordena la publicación entre hilos y procesos, y solo toca la fila
+        # del archivo y la del uso de la biblioteca; dentro solo queda el rename que la publica
+        with manifests.write(uid) as conn:
+            entry = manifests.get(uid, filename, conn)
+            version = current_version(uid, filename, entry)
+            check_version(version, expected_version)
+            # Sin uso guardado, la biblioteca se acaba de borrar entera y está vacía
+            usage = manifests.usage(uid, conn) or {"bytes": 0, "files": 0}
+            current_size = stored_size(uid, filename, entry)
+            added_bytes = size - (current_size or 0)
+            added_files = 1 if current_size is None else 0
+            check_quota(usage, added_bytes, added_files)
+            previous = entry["hash"] if entry is not None else None
+            os.replace(link_tmp, os.path.join(user_library_dir, filename))
+            version = (version or 0) + 1
+            manifests.put(conn, uid, filename, {"hash": digest, "codec": found[1], "size": size, "version": version})
+            manifests.set_usage(conn, uid, {"bytes": usage["bytes"] + added_bytes,
+                                            "files": usage["files"] + added_files})
+        # El rename y la transacción (en el WAL), ya fuera de ella
+        durable_writes.sync(user_library_dir, manifests.wal_path(uid))
+    except (VersionConflict, QuotaExceeded):
+        # Sin los temporales, que comparten inodo con él, el blob recién creado se libera
+        release_temporaries()
+        release_blob(digest)
+        raise
+    finally:
+        release_temporaries()
+
+    content_cache.invalidate(uid, filename)
+    if previous and previous != digest:
+        release_blob(previous)
+    return version
+
+def store_content(uid: str, filename: str, content: bytes, expected_version=None) -> int:
+    """
+    Guarda un contenido ya cargado en memoria; si su blob existe no se escribe nada en disco.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+        content (bytes): El contenido.
+        expected_version: Condición de versión (ver check_version), o None.
+
+    Returns:
+        int: La nueva versión del archivo.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    while True:
+        tmp_path = None
+        if find_blob(digest) is None:
+            tmp_path = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+        try:
+            return store_blob(uid, filename, digest, tmp_path, len(content), expected_version)
+        except FileNotFoundError:
+            continue
+
+def delete_stored_file(uid: str, filename: str, expected_version=None) -> bool:
+    """
+    Borra un archivo de la biblioteca y libera su blob si nadie más lo usa.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+        expected_version: Condición de versión (ver check_version), o None.
+
+    Returns:
+        bool: True si se ha borrado, False si no existía.
+
+    Raises:
+        VersionConflict: Si la versión actual no es la esperada.
+    """
+    # Como en store_blob, el recorrido de la biblioteca se hace antes y la transacción ordena
+    # la modificación entre hilos y procesos
+    current_usage(uid)
+    with manifests.write(uid) as conn:
+        entry = manifests.get(uid, filename, conn)
+        if expected_version is not None:
+            check_version(current_version(uid, filename, entry), expected_version)
+        usage = manifests.usage(uid, conn) or {"bytes": 0, "files": 0}
+        size = stored_size(uid, filename, entry)
+        if not remove_if_exists(os.path.join(LIBRARY_DIR, uid, filename)):
+            return False
+        released = manifests.remove(conn, uid, [filename])
+        manifests.set_usage(conn, uid, {"bytes": max(usage["bytes"] - (size or 0), 0),
+                                        "files": max(usage["files"] - 1, 0)})
+    durable_writes.sync(os.path.join(LIBRARY_DIR, uid), manifests.wal_path(uid))
+    content_cache.invalidate(uid, filename)
+    for digest in released:
+        release_blob(digest)
+    return True
+
+def blob_stats() -> dict:
+    """
+    Calcula el espacio ocupado por los blobs y el que ocuparían sin deduplicar ni comprimir.
+
+    Returns:
+        dict: Número de blobs; physical_bytes (en disco, con los índices gzip), unique_bytes
+        (contenidos distintos sin comprimir), logical_bytes (lo que ocuparían las bibliotecas
+        sin deduplicar ni comprimir), dedup_ratio (lógicos / únicos) y compression_ratio
+        (únicos / físicos).
+    """
+    blobs = physical = unique = logical = 0
+    with os.scandir(BLOB_DIR) as prefixes:
+        for prefix in prefixes:
+            if not prefix.is_dir():
+                continue
+            with os.scandir(prefix.path) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat()
+                        physical += st.st_size
+                        if entry.name.endswith(".idx"):
+                            continue
+                        if entry.name.endswith(".gz"):
+                            size = gzip_content_size(entry.name[:-len(".gz")], entry.path)
+                        else:
+                            size = st.st_size
+                    except FileNotFoundError:
+                        continue  # Liberado mientras se recorría
+                    blobs += 1
+                    unique += size
+                    logical += size * max(st.st_nlink - 1, 0)
+    return {
+        "blobs": blobs,
+        "physical_bytes": physical,
+        "unique_bytes": unique,
+        "logical_bytes": logical,
+        "dedup_ratio": logical / unique if unique else 1.0,
+        "compression_ratio": unique / physical if physical else 1.0,
+    }
+
+def variant_etag(etag: str, *params) -> str:
+    """
+    Deriva el ETag de una respuesta que depende de los parámetros de la petición.
+
+    Args:
+        etag (str): ETag del recurso.
+        *params: Parámetros que cambian el contenido de la respuesta.
+
+    Returns:
+        str: El ETag de la variante.
+    """
+    if not params:
+        return etag
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f"{etag}-{digest[:12]}"
+
+def validator_headers(etag: str, mtime=None) -> dict:
+    headers = {"ETag": f'"{etag}"'}
+    if mtime is not None:
+        headers["Last-Modified"] = http_date(mtime)
+    return headers
+
+def not_modified(etag: str, mtime=None) -> bool:
+    """
+    Evalúa If-None-Match e If-Modified-Since de la petición.
+
+    Args:
+        etag (str): ETag actual de la respuesta.
+        mtime (float): Fecha de modificación del recurso, si la tiene.
+
+    Returns:
+        bool: True si el cliente ya tiene la versión actual (se debe responder 304).
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if mtime is not None and request.if_modified_since is not None:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+def library_generation(uid: str) -> str:
+    """
+    Devuelve un identificador que cambia cada vez que se añade, sustituye o borra un archivo
+    de la biblioteca (el mtime de su directorio).
+
+    Args:
+        uid (str): El ID del usuario.
+
+    Returns:
+        str: La generación de la biblioteca.
+    """
+    try:
+        st = os.stat(os.path.join(LIBRARY_DIR, uid))
+    except FileNotFoundError:
+        return "empty"
+    return f"{st.st_ino:x}-{st.st_mtime_ns:x}"
+
+# Endpoint con las estadísticas del almacén de blobs
+@app.get('/storage_stats')
+async def storage_stats():
+    """
+    Devuelve el uso de disco del almacén de blobs y sus ratios de deduplicación y compresión.
+
+    Returns:
+        JSON: Estadísticas del almacén.
+    """
+    return jsonify(await run_io(blob_stats)), 200
+
+# Endpoint con las estadísticas de las cachés
+@app.get('/cache_stats')
+async def cache_stats():
+    """
+    Devuelve los contadores de la caché de usuarios y de la caché de contenido.
+
+    Returns:
+        JSON: Estadísticas de la caché.
+    """
+    return jsonify({"user_cache": user_cache.stats(), "content_cache": content_cache.stats()}), 200
+
+# Endpoint con las métricas del servicio
+@app.get('/metrics')
+async def get_metrics():
+    """
+    Devuelve las métricas del servicio en el formato de texto de Prometheus.
+
+    Returns:
+        Response: Las métricas (text/plain).
+    """
+    for event, value in user_cache.stats().items():
+        if event != "users":
+            metrics.set("file_user_cache_events_total", (("event", event),), value)
+    content_stats = content_cache.stats()
+    for event in ("hits", "misses", "evictions", "invalidations"):
+        metrics.set("file_content_cache_events_total", (("event", event),), content_stats[event])
+    metrics.set("file_content_cache_bytes", (("kind", "resident"),), content_stats["resident_bytes"])
+    metrics.set("file_content_cache_bytes", (("kind", "capacity"),), content_stats["capacity_bytes"])
+    try:
+        job_counts = await run_io(job_queue.counts)
+    except sqlite3.Error:
+        job_counts = {}
+    for status in ("queued", "running", "done", "failed"):
+        metrics.set("file_jobs", (("status", status),), job_counts.get(status, 0))
+    return Response(await run_io(metrics.render), mimetype="text/plain; version=0.0.4")
+
+def requested_version():
+    """
+    Lee la condición de versión de la petición.
+
+    Returns:
+        NEW_RECORD con `If-None-Match: *`, ANY_VERSION con `If-Match: *`, la versión de
+        `If-Match: <n>`, o None si no hay condición.
+
+    Raises:
+        ValueError: Si la cabecera If-Match no es un número ni '*'.
+    """
+    if request.headers.get('If-None-Match', '').strip() == '*':
+        return NEW_RECORD
+    value = request.headers.get('If-Match', '').strip().strip('"')
+    if not value:
+        return None
+    if value == ANY_VERSION:
+        return ANY_VERSION
+    if not value.isdigit() or int(value) < 1:
+        raise ValueError("Invalid If-Match header")
+    return int(value)
+
+@app.errorhandler(VersionConflict)
+async def version_conflict(error: VersionConflict):
+    return jsonify({"Error": "Version mismatch", "version": error.current}), 412
+
+def quota_limits() -> dict:
+    return {"bytes": QUOTA_BYTES or None, "files": QUOTA_FILES or None}
+
+@app.errorhandler(RequestEntityTooLarge)
+async def request_too_large(error: RequestEntityTooLarge):
+    return jsonify({"Error": f"Request body exceeds the maximum size of {MAX_REQUEST_SIZE} bytes"}), 413
+
+@app.errorhandler(QuotaExceeded)
+async def quota_exceeded(error: QuotaExceeded):
+    metrics.inc("file_quota_rejections_total")
+    return jsonify({"Error": "Storage quota exceeded", "usage": error.usage, "quota": quota_limits()}), 413
+
+# Endpoint para crear o actualizar un archivo
+@app.post('/create_file/<filename>')
+async def create_file(filename: str):
+    """
+    Crea o actualiza un archivo en la biblioteca del usuario.
+
+    Request Headers:
+        - Authorization: Bearer <token>
+        - If-Match (opcional): Solo escribe si la versión actual es esa ('*': si existe).
+        - If-None-Match (opcional): '*' para crear el archivo solo si no existe.
+
+    Request JSON:
+        - uid (str): El ID del usuario.
+        - content (str): El contenido del archivo.
+
+    Subida en streaming (cuerpo `application/octet-stream` o `multipart/form-data`):
+        - uid (str): El ID del usuario, en la query string (`?uid=`).
+        El cuerpo se escribe en disco a medida que llega, hasta MAX_UPLOAD_SIZE bytes.
+
+    Args:
+        filename (str): El nombre del archivo a crear.
+
+    Returns:
+        JSON: Mensaje de éxito con la nueva versión, o error (412 si la versión no coincide,
+        413 si el archivo no cabe en MAX_UPLOAD_SIZE o en la cuota del usuario).
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+
+    streaming = request.mimetype in STREAM_CONTENT_TYPES
+    if streaming:
+        uid = request.args.get('uid')
+        content = None
+    else:
+        data = await request.get_json()
+        uid = data.get('uid')
+        content = data.get('content')
+    
+    if not filename or not uid or (not streaming and not content):
+        return jsonify({"Error": "Filename, uid and content required"}), 400
+
+    if not valid_name(filename):
+        return jsonify({"Error": "Invalid filename"}), 400
+    
+    # El token firmado basta para autorizar: no hace falta consultar los usuarios
+    if not validate_token(token, uid):
+        return jsonify({"Error": "Invalid token"}), 403
+
+    try:
+        expected_version = requested_version()
+    except ValueError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    # La cuota se comprueba antes de escribir nada; store_blob la vuelve a comprobar al publicar
+    allowance, usage = await run_io(quota_allowance, uid, filename)
+    
+    # Guardar el archivo en el almacén de blobs
+    if streaming:
+        limit = MAX_UPLOAD_SIZE if allowance is None else min(MAX_UPLOAD_SIZE, allowance)
+        try:
+            tmp_path, size, digest = await stream_upload(limit)
+        except UploadTooLarge:
+            if limit < MAX_UPLOAD_SIZE:
+                raise QuotaExceeded(usage)
+            return jsonify({"Error": f"File exceeds the maximum size of {MAX_UPLOAD_SIZE} bytes"}), 413
+        except ValueError as e:
+            return jsonify({"Error": str(e)}), 400
+        async with file_locks.lock((uid, filename)):
+            version = await run_io(store_blob, uid, filename, digest, tmp_path, size, expected_version)
+            await run_io(update_search_index, uid, filename)
+    else:
+        content = content.encode('utf-8')
+        if allowance is not None and len(content) > allowance:
+            raise QuotaExceeded(usage)
+        async with file_locks.lock((uid, filename)):
+            version = await run_io(store_content, uid, filename, content, expected_version)
+            await run_io(update_search_index, uid, filename)
+    
+    return jsonify({"message": f"File '{filename}' uploaded successfully", "version": version}), 200
+
+# Subidas por partes: cada sesión es un directorio en SESSION_DIR con su descripción
+# (session.json) y una parte por archivo, de modo que sobreviven a un reinicio
+
+SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+def session_path(upload_id: str, name: str = "") -> str:
+    return os.path.join(SESSION_DIR, upload_id, name)
+
+def load_session(upload_id: str):
+    """
+    Lee la descripción de una sesión de subida.
+
+    Args:
+        upload_id (str): El ID de la sesión.
+
+    Returns:
+        dict: uid, filename y expires_at de la sesión, o None si no existe o ha expirado.
+    """
+    if not SESSION_ID_RE.match(upload_id):
+        return None
+    try:
+        with open(session_path(upload_id, "session.json"), 'r') as f:
+            session = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if session["expires_at"] < time.time():
+        shutil.rmtree(session_path(upload_id), ignore_errors=True)
+        return None
+    return session
+
+def save_session(upload_id: str, session: dict) -> None:
+    tmp_file = session_path(upload_id, "session.json.tmp")
+    with open(tmp_file, 'w') as f:
+        f.write(json.dumps(session))
+    os.replace(tmp_file, session_path(upload_id, "session.json"))
+
+def claim_session(upload_id: str) -> bool:
+    """
+    Marca una sesión como en proceso de commit, también frente a los demás procesos.
+
+    Args:
+        upload_id (str): El ID de la sesión.
+
+    Returns:
+        bool: True si se ha marcado, False si otro commit la tiene marcada.
+
+    Raises:
+        FileNotFoundError: Si la sesión ya no existe.
+    """
+    try:
+        os.mkdir(session_path(upload_id, "committing"))
+    except FileExistsError:
+        return False
+    return True
+
+def release_session(upload_id: str) -> None:
+    try:
+        os.rmdir(session_path(upload_id, "committing"))
+    except FileNotFoundError:
+        pass  # La sesión se ha completado y ya no existe
+
+def session_parts(upload_id: str) -> dict:
+    """
+    Devuelve las partes recibidas de una sesión.
+
+    Args:
+        upload_id (str): El ID de la sesión.
+
+    Returns:
+        dict: Índice de la parte -> tamaño en bytes.
+    """
+    parts = {}
+    with os.scandir(session_path(upload_id)) as entries:
+        for entry in entries:
+            if entry.name.endswith(".part") and entry.name[:-len(".part")].isdigit():
+                parts[int(entry.name[:-len(".part")])] = entry.stat().st_size
+    return parts
+
+def assemble_session(upload_id: str, count: int) -> tuple:
+    """
+    Concatena las partes de una sesión en un archivo temporal, por bloques.
+
+    Args:
+        upload_id (str): El ID de la sesión.
+        count (int): Número de partes (deben estar las 0..count-1).
+
+    Returns:
+        tuple: (ruta del archivo temporal, tamaño, hash SHA-256 en hex).
+    """
+    tmp_path = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            for index in range(count):
+                with open(session_path(upload_id, f"{index}.part"), 'rb') as part:
+                    while True:
+                        chunk = part.read(DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        size += len(chunk)
+                        out.write(chunk)
+    except BaseException:
+        remove_if_exists(tmp_path)
+        raise
+    return tmp_path, size, digest.hexdigest()
+
+def sweep_sessions() -> int:
+    """
+    Elimina las sesiones de subida expiradas.
+
+    Returns:
+        int: Número de sesiones eliminadas.
+    """
+    removed = 0
+    with os.scandir(SESSION_DIR) as entries:
+        for entry in entries:
+            # Una sesión recién creada puede no tener aún su session.json
+            if (entry.is_dir() and SESSION_ID_RE.match(entry.name)
+                    and entry.stat().st_mtime + UPLOAD_SESSION_TTL < time.time()
+                    and load_session(entry.name) is None):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+    return removed
+
+async def reconcile_all_usage():
+    # Cada worker recorre las bibliotecas de una en una para no ocupar el pool de E/S
+    while True:
+        await asyncio.sleep(USAGE_RECONCILE_INTERVAL)
+        try:
+            uids = [name for name in await run_io(os.listdir, LIBRARY_DIR) if not name.startswith(".")]
+            for uid in uids:
+                await run_io(reconcile_usage, uid)
+        except (OSError, sqlite3.Error):
+            pass
+
+async def expire_upload_sessions():
+    while True:
+        try:
+            await run_io(sweep_sessions)
+        except OSError:
+            pass
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+
+# Endpoint para iniciar una subida por partes
+@app.post('/uploads')
+async def create_upload():
+    """
+    Crea una sesión de subida por partes.
+
+    Request Headers:
+        - Authorization: Bearer <token>
+
+    Request JSON:
+        - uid (str): El ID del usuario.
+        - filename (str): El nombre que tendrá el archivo en la biblioteca.
+
+    Returns:
+        JSON: upload_id y fecha de expiración de la sesión, o error.
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+
+    data = await request.get_json()
+    uid = data.get('uid')
+    filename = data.get('filename')
+
+    if not filename or not uid:
+        return jsonify({"Error": "Filename and uid required"}), 400
+
+    # El nombre se guarda en la sesión y acaba en una ruta al completar la subida
+    if not valid_name(filename):
+        return jsonify({"Error": "Invalid filename"}), 400
+
+    if not validate_token(token, uid):
+        return jsonify({"Error": "Invalid token"}), 403
+
+    upload_id = uuid.uuid4().hex
+    session = {"uid": uid, "filename": filename, "expires_at": time.time() + UPLOAD_SESSION_TTL}
+    await run_io(os.makedirs, session_path(upload_id))
+    await run_io(save_session, upload_id, session)
+
+    return jsonify({"upload_id": upload_id, "expires_at": session["expires_at"]}), 200
+
+# Endpoint para enviar una parte
+@app.put('/uploads/<upload_id>/<int:index>')
+async def upload_part(upload_id: str, index: int):
+    """
+    Guarda la parte `index` de una subida. Las partes pueden llegar en cualquier orden y en
+    paralelo; reenviar una parte la sustituye.
+
+    Request Headers:
+        - Authorization: Bearer <token>
+
+    Request Body:
+        Los bytes de la parte, que se escriben en disco a medida que llegan.
+
+    Args:
+        upload_id (str): El ID de la sesión.
+        index (int): El número de parte, empezando en 0.
+
+    Returns:
+        JSON: Tamaño recibido o error.
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+
+    session = await run_io(load_session, upload_id)
+    if session is None:
+        return jsonify({"Error": "Upload session not found"}), 404
+
+    if not validate_token(token, session["uid"]):
+        return jsonify({"Error": "Invalid token"}), 403
+
+    # Lo que la cuota permite, descontando las demás partes ya recibidas
+    limit = MAX_UPLOAD_SIZE
+    allowance, usage = await run_io(quota_allowance, session["uid"], session["filename"])
+    if allowance is not None:
+        parts = await run_io(session_parts, upload_id)
+        limit = min(limit, allowance - sum(size for other, size in parts.items() if other != index))
+        if limit < 0 or (request.content_length is not None and request.content_length > limit):
+            raise QuotaExceeded(usage)
+
+    tmp_path = session_path(upload_id, f"{index}.part.{uuid.uuid4().hex}")
+    size = 0
+    try:
+        async with open_async(tmp_path, 'wb') as f:
+            async for chunk in request.body:
+                size += len(chunk)
+                if size > limit:
+                    raise UploadTooLarge()
+                await f.write(chunk)
+        await run_io(os.replace, tmp_path, session_path(upload_id, f"{index}.part"))
+    except UploadTooLarge:
+        await run_io(remove_if_exists, tmp_path)
+        if limit < MAX_UPLOAD_SIZE:
+            raise QuotaExceeded(usage)
+        return jsonify({"Error": f"File exceeds the maximum size of {MAX_UPLOAD_SIZE} bytes"}), 413
+    except BaseException:
+        await run_io(remove_if_exists, tmp_path)
+        raise
+
+    # Cada parte recibida prolonga la vida de la sesión
+    session["expires_at"] = time.time() + UPLOAD_SESSION_TTL
+    await run_io(save_session, upload_id, session)
+
+    return jsonify({"index": index, "size": size}), 200
+
+# Endpoint para consultar una subida
+@app.get('/uploads/<upload_id>')
+async def upload_status(upload_id: str):
+    """
+    Devuelve las partes ya recibidas de una subida, para poder reanudarla.
+
+    Request Headers:
+        - Authorization: Bearer <token>
+
+    Args:
+        upload_id (str): El ID de la sesión.
+
+    Returns:
+        JSON: Archivo destino, partes recibidas con su tamaño y expiración, o error.
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+
+    session = await run_io(load_session, upload_id)
+    if session is None:
+        return jsonify({"Error": "Upload session not found"}), 404
+
+    if not validate_token(token, session["uid"]):
+        return jsonify({"Error": "Invalid token"}), 403
+
+    parts = await run_io(session_parts, upload_id)
+    return jsonify({
+        "upload_id": upload_id,
+        "filename": session["filename"],
+        "parts": {str(index): size for index, size in sorted(parts.items())},
+        "expires_at": session["expires_at"],
+    }), 200
+
+# Endpoint para completar una subida
+@app.post('/uploads/<upload_id>/commit')
+async def commit_upload(upload_id: str):
+    """
+    Une las partes de una subida y guarda el archivo en la biblioteca.
+
+    El archivo se ensambla por bloques, sin cargarlo en memoria, y se comprueba su SHA-256
+    antes de guardarlo. La sesión se elimina al terminar.
+
+    Request Headers:
+        - Authorization: Bearer <token>
+        - If-Match / If-None-Match (opcionales): Condición de versión, como en create_file.
+
+    Request JSON:
+        - parts (int): Número total de partes (0..parts-1).
+        - sha256 (str): Hash SHA-256 del archivo completo, en hexadecimal.
+
+    Args:
+        upload_id (str): El ID de la sesión.
+
+    Returns:
+        JSON: Mensaje de éxito o error (404 si la sesión no existe o ya la ha completado otro
+        commit, 409 si faltan partes u otro proceso la está completando).
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+
+    data = await request.get_json()
+    checksum = (data.get('sha256') or '').lower()
+    count = data.get('parts')
+
+    if not checksum or not isinstance(count, int) or count < 1:
+        return jsonify({"Error": "Parts and sha256 required"}), 400
+
+    try:
+        expected_version = requested_version()
+    except ValueError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    # Dos commits de la misma sesión se ordenan; el segundo la recarga y ve que ya no existe
+    async with upload_locks.lock(upload_id):
+        session = await run_io(load_session, upload_id)
+        if session is None:
+            return jsonify({"Error": "Upload session not found"}), 404
+
+        if not validate_token(token, session["uid"]):
+            return jsonify({"Error": "Invalid token"}), 403
+
+        # Sesiones creadas antes de validar el nombre en create_upload
+        if not valid_name(session["filename"]):
+            return jsonify({"Error": "Invalid filename"}), 400
+
+        # Otro worker puede estar completando la misma sesión
+        try:
+            claimed = await run_io(claim_session, upload_id)
+        except FileNotFoundError:
+            return jsonify({"Error": "Upload session not found"}), 404
+        if not claimed:
+            return jsonify({"Error": "Upload is already being committed"}), 409
+        try:
+            return await commit_session(upload_id, session, count, checksum, expected_version)
+        finally:
+            await run_io(release_session, upload_id)
+
+async def commit_session(upload_id: str, session: dict, count: int, checksum: str, expected_version):
+    """
+    Une las partes de una sesión marcada con claim_session y guarda el archivo.
+
+    Returns:
+        tuple: La respuesta de commit_upload.
+    """
+    uid = session["uid"]
+    parts = await run_io(session_parts, upload_id)
+    missing = [index for index in range(count) if index not in parts]
+    if missing:
+        return jsonify({"Error": "Missing parts", "missing": missing[:100]}), 409
+    total = sum(parts[index] for index in range(count))
+    if total > MAX_UPLOAD_SIZE:
+        return jsonify({"Error": f"File exceeds the maximum size of {MAX_UPLOAD_SIZE} bytes"}), 413
+    allowance, usage = await run_io(quota_allowance, uid, session["filename"])
+    if allowance is not None and total > allowance:
+        raise QuotaExceeded(usage)
+
+    tmp_path, size, digest = await run_io(assemble_session, upload_id, count)
+    if digest != checksum:
+        await run_io(remove_if_exists, tmp_path)
+        return jsonify({"Error": "Checksum mismatch", "sha256": digest}), 422
+
+    async with file_locks.lock((uid, session["filename"])):
+        version = await run_io(store_blob, uid, session["filename"], digest, tmp_path, size, expected_version)
+        await run_io(update_search_index, uid, session["filename"])
+    await run_io(shutil.rmtree, session_path(upload_id), True)
+
+    return jsonify({"message": f"File '{session['filename']}' uploaded successfully", "size": size,
+                    "version": version}), 200
+
+# Endpoint para cancelar una subida
+@app.delete('/uploads/<upload_id>')
+async def abort_upload(upload_id: str):
+    """
+    Cancela una subida por partes y borra lo recibido.
+
+    Request Headers:
+        - Authorization: Bearer <token>
+
+    Args:
+        upload_id (str): El ID de la sesión.
+
+    Returns:
+        JSON: Mensaje de éxito o error.
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+
+    session = await run_io(load_session, upload_id)
+    if session is None:
+        return jsonify({"Error": "Upload session not found"}), 404
+
+    if not validate_token(token, session["uid"]):
+        return jsonify({"Error": "Invalid token"}), 403
+
+    await run_io(shutil.rmtree, session_path(upload_id), True)
+    return jsonify({"message": "Upload aborted"}), 200
+
+# Endpoint para consultar el uso de almacenamiento
+@app.get('/usage')
+async def get_usage():
+    """
+    Devuelve el espacio y el número de archivos que ocupa la biblioteca del usuario.
+
+    Los contadores se mantienen en cada escritura y borrado, así que la consulta no recorre
+    la biblioteca (salvo la primera vez, si aún no se habían calculado).
+
+    Request Headers:
+        - Authorization: Bearer <token>
+
+    Request Query / JSON:
+        - uid (str): El ID del usuario.
+
+    Returns:
+        JSON: `usage` (bytes sin comprimir y files) y `quota` (None si no hay límite), o error.
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+
+    uid = request.args.get('uid')
+    if not uid:
+        data = await request.get_json(silent=True) or {}
+        uid = data.get('uid')
+
+    if not uid:
+        return jsonify({"Error": "Uid required"}), 400
+
+    # El token firmado basta para autorizar: no hace falta consultar los usuarios
+    if not validate_token(token, uid):
+        return jsonify({"Error": "Invalid token"}), 403
+
+    usage = await run_io(current_usage, uid)
+    return jsonify({"uid": uid, "usage": usage, "quota": quota_limits()}), 200
+
+# Endpoint para borrar un archivo
+@app.post('/delete_file/<filename>')
+async def delete_file(filename: str):
+    """
+    Elimina un archivo en la biblioteca del usuario.
+
+    Request Headers:
+        - Authorization: Bearer <token>
+        - If-Match (opcional): Solo borra si la versión actual es esa.
+
+    Request JSON:
+        - uid (str): El ID del usuario.
+
+    Args:
+        filename (str): El nombre del archivo a eliminar.
+
+    Returns:
+        JSON: Mensaje de éxito o error.
+    """
+    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
+        token = request.headers.get('Authorization', '').split(' ')[-1]
+    else:
+        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
+    
+    data = await request.get_json()
+    uid = data.get('uid')
+    
+    if not filename or not uid or not token:
+        return jsonify({"Error": "Filename, uid and token required"}), 400
+    
+    # El token firmado basta para autorizar: no hace falta consultar los usuarios
+    if not validate_token(token, uid):
+        return jsonify({"Error": "Invalid token"}), 403
+    
+    try:
+        expected_version = requested_version()
+    except ValueError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    async with file_locks.lock((uid, filename)):
+        deleted = await run_io(delete_stored_file, uid, filename, expected_version)
+        if deleted:
+            await run_io(update_search_index, uid, filename)
+    if deleted:
+        return jsonify({"message": f"File '{filename}' deleted successfully"}), 200
+    else:
+        return jsonify({"Error": "File not found"}), 404
+
+# Cola de trabajos en segundo plano: las tareas largas (borrar la biblioteca de un usuario
+# dado de baja, barrer bibliotecas huérfanas) se encolan en una base de datos SQLite del
+# volumen compartido y las ejecutan los workers de file_service fuera de las peticiones
+
+class InvalidJob(Exception):
+    """
+    Se lanza cuando un trabajo no se puede ejecutar nunca (tipo o datos no válidos): no se reintenta.
+    """
+
+class JobInterrupted(Exception):
+    """
+    Se lanza dentro de un trabajo cuando el servicio se detiene: el trabajo vuelve a la cola.
+    """
+
+class JobLeaseLost(Exception):
+    """
+    Se lanza dentro de un trabajo cuando su lease ha caducado y otro worker lo ha retomado.
+    """
+
+job_queue = JobQueue(JOB_DB, JOB_MAX_ATTEMPTS, JOB_MAX_RUNNING, JOB_LEASE, JOB_RETRY_DELAY)
+job_executor = ThreadPoolExecutor(max_workers=max(JOB_WORKERS, 1), thread_name_prefix='job')
+jobs_stopping = threading.Event()  # Se activa al detener el servicio
+
+def job_uid(payload: dict) -> str:
+    # El UID forma parte de rutas: no puede salir de LIBRARY_DIR ni nombrar sus directorios internos
+    uid = payload.get("uid") if isinstance(payload, dict) else None
+    if not valid_name(uid):
+        raise InvalidJob(f"Invalid uid {uid!r}")
+    return uid
+
+def delete_library(payload: dict, progress) -> str:
+    """
+    Borra la biblioteca de un usuario dado de baja: sus archivos, los blobs que solo usaba
+    ella, sus filas del manifiesto y del uso y el índice de búsqueda.
+
+    Los archivos se borran por lotes de JOB_BATCH_SIZE, cada uno con una transacción corta
+    que los quita del manifiesto: un reintento sigue donde se quedó el anterior y repetir
+    el borrado de una biblioteca ya borrada no hace nada.
+
+    Args:
+        payload (dict): {"uid": <uid>}.
+        progress (callable): progress(hechos, total, mensaje) para informar del avance.
+
+    Returns:
+        str: Resumen del resultado.
+
+    Raises:
+        InvalidJob: Si el UID no es válido o el usuario existe.
+    """
+    uid = job_uid(payload)
+    # Un trabajo encolado por error nunca borra la biblioteca de un usuario que existe
+    if user_cache.contains(uid):
+        raise InvalidJob(f"User {uid} exists")
+
+    library = os.path.join(LIBRARY_DIR, uid)
+    try:
+        names = set(os.listdir(library))
+    except FileNotFoundError:
+        names = set()
+    names = sorted(names | set(manifests.entries(uid)))
+    total = len(names)
+    progress(0, total, "Deleting files")
+    for i in range(0, total, JOB_BATCH_SIZE):
+        batch = names[i:i + JOB_BATCH_SIZE]
+        with manifests.write(uid) as conn:
+            released = manifests.remove(conn, uid, batch)
+        # Los archivos se borran fuera de la transacción; si una escritura tardía vuelve a
+        # crear uno, su fila la recoge el paso final
+        for name in batch:
+            remove_if_exists(os.path.join(library, name))
+            content_cache.invalidate(uid, name)
+        durable_writes.sync(library, manifests.wal_path(uid))
+        # Como en delete_stored_file: los blobs se liberan cuando el manifiesto ya no los nombra
+        for digest in released:
+            release_blob(digest)
+        progress(i + len(batch), total, "Deleting files")
+
+    with manifests.write(uid) as conn:
+        # Una escritura que comprobó el usuario justo antes de la baja puede haber creado
+        # archivos después de listar la biblioteca: los borra el siguiente intento
+        try:
+            os.rmdir(library)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            raise RuntimeError("Library changed while deleting")
+        released = manifests.drop(conn, uid)
+    for path in (index_path(uid), index_path(uid, ".db-wal"), index_path(uid, ".db-shm"), index_path(uid, ".stale")):
+        remove_if_exists(path)
+    durable_writes.sync(LIBRARY_DIR, MANIFEST_DIR, SEARCH_INDEX_DIR)
+    for digest in released:
+        release_blob(digest)
+    return f"Deleted {total} files"
+
+def library_uids() -> set:
+    """
+    Reúne los UID que tienen algo guardado: biblioteca, filas en el manifiesto o índice de búsqueda.
+    """
+    uids = {name for name in os.listdir(LIBRARY_DIR) if not name.startswith(".")}
+    uids.update(manifests.uids())
+    uids.update(name[:-len(".db")] for name in os.listdir(SEARCH_INDEX_DIR) if name.endswith(".db"))
+    return uids
+
+def last_modified(uid: str) -> float:
+    # Cada escritura y borrado cambia el mtime del directorio de la biblioteca
+    try:
+        return os.stat(os.path.join(LIBRARY_DIR, uid)).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+def sweep_orphans(payload: dict, progress) -> str:
+    """
+    Encola el borrado de las bibliotecas cuyo usuario ya no existe: bajas anteriores a la
+    cola de trabajos o cuyo trabajo se perdió. Las modificadas hace menos de ORPHAN_MIN_AGE
+    se dejan para el siguiente barrido.
+
+    Args:
+        payload (dict): Sin datos.
+        progress (callable): progress(hechos, total, mensaje) para informar del avance.
+
+    Returns:
+        str: Resumen del resultado.
+    """
+    # Sin ningún usuario lo más probable es que el almacén de usuarios no esté montado:
+    # el barrido borraría todas las bibliotecas
+    if user_cache.count() == 0:
+        return "No users found, sweep skipped"
+    uids = sorted(library_uids())
+    now = time.time()
+    queued = 0
+    for i, uid in enumerate(uids, 1):
+        if not user_cache.contains(uid) and now - last_modified(uid) >= ORPHAN_MIN_AGE:
+            queued += job_queue.enqueue("delete_library", {"uid": uid}, f"delete_library:{uid}")[1]
+        if i % JOB_BATCH_SIZE == 0:
+            progress(i, len(uids), f"{queued} orphan libraries queued")
+    return f"{queued} orphan libraries queued, {len(uids)} libraries checked"
+
+JOB_HANDLERS = {
+    "delete_library": delete_library,
+    "sweep_orphans": sweep_orphans,
+}
+
+def execute_job(job: dict, worker: str) -> str:
+    """
+    Ejecuta un trabajo reclamado y guarda su resultado en la cola.
+
+    Args:
+        job (dict): El trabajo devuelto por JobQueue.claim.
+        worker (str): Identificador del worker.
+
+    Returns:
+        str: 'done', 'retry', 'failed', 'released' (devuelto a la cola al parar) o 'lost'.
+    """
+    def progress(done: int, total=None, message=None) -> None:
+        if jobs_stopping.is_set():
+            raise JobInterrupted()
+        if not job_queue.report(job["id"], worker, done, total, message):
+            raise JobLeaseLost()
+
+    start = time.perf_counter()
+    try:
+        handler = JOB_HANDLERS.get(job["type"])
+        if handler is None:
+            raise InvalidJob(f"Unknown job type {job['type']}")
+        message = handler(job["payload"], progress)
+    except JobInterrupted:
+        outcome = "released" if job_queue.release(job["id"], worker) else "lost"
+    except JobLeaseLost:
+        outcome = "lost"
+    except InvalidJob as e:
+        outcome = job_queue.fail(job["id"], worker, str(e), retry=False)
+    except Exception as e:
+        outcome = job_queue.fail(job["id"], worker, f"{type(e).__name__}: {e}")
+    else:
+        outcome = "done" if job_queue.finish(job["id"], worker, message) else "lost"
+    metrics.inc("file_jobs_total", (("type", job["type"]), ("outcome", outcome)))
+    metrics.observe("file_job_duration_seconds", (("type", job["type"]),), time.perf_counter() - start)
+    return outcome
+
+async def run_jobs(worker: str):
+    # Cada worker ejecuta un trabajo a la vez en job_executor; JOB_MAX_RUNNING limita el total
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            job = await loop.run_in_executor(job_executor, job_queue.claim, worker)
+            if job is not None:
+                await loop.run_in_executor(job_executor, execute_job, job, worker)
+                continue
+        except (sqlite3.Error, OSError):
+            pass
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+async def schedule_orphan_sweeps():
+    # Todos los workers lo intentan; min_interval deja un solo barrido por intervalo
+    while True:
+        try:
+            if ORPHAN_SWEEP_INTERVAL > 0:
+                await run_io(job_queue.enqueue, "sweep_orphans", {}, "sweep_orphans",
+                             JOB_MAX_ATTEMPTS, ORPHAN_SWEEP_INTERVAL)
+            await run_io(job_queue.prune, JOB_RETENTION)
+        except (sqlite3.Error, OSError):
+            pass
+        await asyncio.sleep(min(ORPHAN_SWEEP_INTERVAL, 600) if ORPHAN_SWEEP_INTERVAL > 0 else 600)
+
+def jobs_authorized() -> bool:
+    return bool(JOBS_TOKEN) and hmac.compare_digest(request.headers.get('X-Jobs-Token', ''), JOBS_TOKEN)
+
+# Endpoint para consultar la cola de trabajos
+@app.get('/jobs')
+async def get_jobs():
+    """
+    Lista los trabajos más recientes de la cola y cuántos hay en cada estado.
+
+    Request Headers:
+        - X-Jobs-Token: JOBS_TOKEN
+
+    Request Query (opcionales):
+        - status (str): queued, running, done o failed.
+        - type (str): Tipo de trabajo.
+        - limit (int): Número de trabajos (100 por defecto, 1000 como máximo).
+
+    Returns:
+        JSON: `jobs` (del más reciente al más antiguo) y `counts` por estado, o error.
+    """
+    if not jobs_authorized():
+        return jsonify({"Error": "Invalid jobs token"}), 403
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"Error": "limit must be an integer"}), 400
+    if not 1 <= limit <= 1000:
+        return jsonify({"Error": "limit must be between 1 and 1000"}), 400
+    jobs = await run_io(job_queue.list_jobs, request.args.get('status'), request.args.get('type'), limit)
+    return jsonify({"jobs": jobs, "counts": await run_io(job_queue.counts)}), 200
+
+# Endpoint para consultar un trabajo
+@app.get('/jobs/<int:job_id>')
+async def get_job(job_id: int):
+    """
+    Devuelve el estado, los intentos y el progreso de un trabajo.
+
+    Request Headers:
+        - X-Jobs-Token: JOBS_TOKEN
+
+    Args:
+        job_id (int): El ID del trabajo.
+
+    Returns:
+        JSON: El trabajo o error.
+    """
+    if not jobs_authorized():
+        return jsonify({"Error": "Invalid jobs token"}), 403
+    job = await run_io(job_queue.get, job_id)
+    if job is None:
+        return jsonify({"Error": "Job not found"}), 404
+    return jsonify(job), 200
 
-def create_token(uid: str, secret: uuid.UUID) -> str:
+# Endpoint para encolar un trabajo
+@app.post('/jobs')
+async def create_job():
     """
-    Genera un token basado en el UUID del usuario y un UUID secreto.
+    Encola un trabajo a mano, por ejemplo un barrido de bibliotecas huérfanas.
 
-    Args:
-        uid (str): El ID único del usuario.
-        secret (UUID): El UUID secreto para generar el token.
+    Request Headers:
+        - X-Jobs-Token: JOBS_TOKEN
+
+    Request JSON:
+        - type (str): 'delete_library' o 'sweep_orphans'.
+        - payload (dict): Datos del trabajo ({"uid": ...} para delete_library).
 
     Returns:
-        str: Token generado.
+        JSON: El ID del trabajo y si se ha creado (False si ya había uno pendiente), o error.
     """
-    token_hash = uuid.uuid5(secret, uid)
-    return f"{token_hash}"
+    if not jobs_authorized():
+        return jsonify({"Error": "Invalid jobs token"}), 403
+    data = await request.get_json(silent=True) or {}
+    job_type = data.get('type')
+    payload = data.get('payload') or {}
+    if job_type not in JOB_HANDLERS or not isinstance(payload, dict):
+        return jsonify({"Error": f"type must be one of {', '.join(JOB_HANDLERS)}"}), 400
+    if job_type == "delete_library":
+        try:
+            key = f"delete_library:{job_uid(payload)}"
+        except InvalidJob as e:
+            return jsonify({"Error": str(e)}), 400
+    else:
+        key = job_type
+    job_id, created = await run_io(job_queue.enqueue, job_type, payload, key)
+    return jsonify({"id": job_id, "created": created}), 202
 
-def validate_token(token: str, expected_token: str) -> bool:
+# Endpoint para reintentar un trabajo fallido
+@app.post('/jobs/<int:job_id>/retry')
+async def retry_job(job_id: int):
     """
-    Valida si el token proporcionado coincide con el token esperado.
+    Vuelve a encolar un trabajo fallido con todos sus intentos.
+
+    Request Headers:
+        - X-Jobs-Token: JOBS_TOKEN
 
     Args:
-        token (str): Token proporcionado.
-        expected_token (str): Token esperado para validación.
+        job_id (int): El ID del trabajo.
 
     Returns:
-        bool: True si los tokens coinciden, False si no.
+        JSON: El trabajo o error.
     """
-    return token == expected_token
+    if not jobs_authorized():
+        return jsonify({"Error": "Invalid jobs token"}), 403
+    if not await run_io(job_queue.retry, job_id):
+        return jsonify({"Error": "Job not found or not failed"}), 409
+    return jsonify(await run_io(job_queue.get, job_id)), 202
+
+LIST_SORT_KEYS = ("name", "size", "mtime")
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode('ascii'))))
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
 
-def get_user(uid: str) -> bool:
+def scan_library(uid: str, prefix: str, sort: str, descending: bool, after, limit: int) -> tuple:
     """
-    Verifica si existe un usuario con el UID proporcionado en el directorio de usuarios.
+    Obtiene una página de la biblioteca en una sola pasada de os.scandir.
+
+    Solo se guardan en memoria las `limit` mejores entradas (un montículo), y al ordenar por
+    nombre solo se hace stat de las entradas de la página.
 
     Args:
-        uid (str): El ID único del usuario.
+        uid (str): El ID del usuario.
+        prefix (str): Prefijo que deben tener los nombres ('' para todos).
+        sort (str): Campo de ordenación: 'name', 'size' o 'mtime'.
+        descending (bool): Orden descendente.
+        after (tuple): Clave de ordenación de la última entrada de la página anterior, o None.
+        limit (int): Número máximo de entradas.
 
     Returns:
-        bool: True si el usuario existe, False si no.
+        tuple: (lista de entradas {name, size, mtime, version}, clave de la última entrada o None si no hay más).
     """
-    for filename in os.listdir(USER_DIR):
-        if filename.endswith(".json"):
-            user_file = os.path.join(USER_DIR, filename)
-            with open(user_file, 'r') as f:
-                user_data = json.load(f)
-                if user_data['uid'] == uid:
-                    return True
-    return False
+    user_library_dir = os.path.join(LIBRARY_DIR, uid)
+    manifest = manifests.entries(uid)
+    # Los archivos comprimidos ocupan menos en disco: se usa su tamaño real
+    sizes = {name: entry["size"] for name, entry in manifest.items() if entry["codec"] is not None}
 
-# Endpoint para crear o actualizar un archivo
-@app.post('/create_file/<filename>')
-async def create_file(filename: str):
+    scanned = 0
+
+    def candidates():
+        nonlocal scanned
+        try:
+            entries = os.scandir(user_library_dir)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                scanned += 1
+                if prefix and not entry.name.startswith(prefix):
+                    continue
+                if not entry.is_file():
+                    continue
+                if sort == "name":
+                    key = (entry.name,)
+                else:
+                    st = entry.stat()
+                    key = (sizes.get(entry.name, st.st_size) if sort == "size" else st.st_mtime_ns, entry.name)
+                if after is not None and (key <= after if not descending else key >= after):
+                    continue
+                yield key, entry
+
+    select = heapq.nlargest if descending else heapq.nsmallest
+    page = select(limit + 1, candidates(), key=lambda item: item[0])
+    metrics.observe("file_library_scan_entries", (), scanned)
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    entries = []
+    for key, entry in page:
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append({"name": entry.name, "size": sizes.get(entry.name, st.st_size), "mtime": st.st_mtime,
+                         "version": manifest[entry.name]["version"] if entry.name in manifest else 1})
+    last_key = page[-1][0] if page and has_more else None
+    return entries, last_key
+
+# Endpoint para listar los archivos de un usuario
+@app.post('/list_files')
+async def list_files():
     """
-    Crea o actualiza un archivo en la biblioteca del usuario.
+    Lista los archivos en la biblioteca del usuario.
 
     Request Headers:
         - Authorization: Bearer <token>
 
     Request JSON:
         - uid (str): El ID del usuario.
-        - content (str): El contenido del archivo.
+        - limit (int, opcional): Archivos por página (LIST_PAGE_SIZE por defecto).
+        - cursor (str, opcional): `next_cursor` de la página anterior.
+        - prefix (str, opcional): Solo archivos cuyo nombre empieza por este prefijo.
+        - sort (str, opcional): 'name' (por defecto), 'size' o 'mtime'.
+        - order (str, opcional): 'asc' (por defecto) o 'desc'.
 
-    Args:
-        filename (str): El nombre del archivo a crear.
+    Request Headers:
+        - If-None-Match (opcional): ETag de una respuesta anterior; si la biblioteca no ha
+          cambiado se responde 304 sin recorrerla.
 
     Returns:
-        JSON: Mensaje de éxito o error.
+        JSON: Nombres de la página (`files`), tamaño y fecha de cada uno (`entries`) y
+        `next_cursor` (None en la última página), o error.
     """
     if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
         token = request.headers.get('Authorization', '').split(' ')[-1]
     else:
         return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
-
+    
     data = await request.get_json()
     uid = data.get('uid')
-    content = data.get('content')
-    
-    if not filename or not uid or not content:
-        return jsonify({"Error": "Filename, uid and content required"}), 400
-    
-    if not get_user(uid):
-        return jsonify({"Error": "User not found"}), 404
+
+    if not uid:
+        return jsonify({"Error": "Uid required"}), 400
     
-    if not validate_token(token, create_token(uid, SECRET_UUID)):
+    # El token firmado basta para autorizar: no hace falta consultar los usuarios
+    if not validate_token(token, uid):
         return jsonify({"Error": "Invalid token"}), 403
     
-    # Crear directorio del usuario si no existe
-    user_library_dir = os.path.join(LIBRARY_DIR, uid)
-    os.makedirs(user_library_dir, exist_ok=True)
+    sort = data.get('sort', 'name')
+    order = data.get('order', 'asc')
+    prefix = data.get('prefix') or ''
+    try:
+        limit = int(data.get('limit', LIST_PAGE_SIZE))
+        after = decode_cursor(data['cursor']) if data.get('cursor') else None
+    except (TypeError, ValueError) as e:
+        return jsonify({"Error": str(e)}), 400
+    if sort not in LIST_SORT_KEYS or order not in ("asc", "desc") or limit < 1:
+        return jsonify({"Error": "Invalid sort, order or limit"}), 400
+    if after is not None and [type(k) for k in after] != ([str] if sort == "name" else [int, str]):
+        return jsonify({"Error": "Cursor does not match the sort order"}), 400
+    limit = min(limit, LIST_MAX_PAGE_SIZE)
 
-    # Guardar el archivo
-    file_path = os.path.join(user_library_dir, filename)
-    with open(file_path, 'wb') as f:
-        f.write(content.encode('utf-8'))
-    
-    return jsonify({"message": f"File '{filename}' uploaded successfully"}), 200
+    # Si la biblioteca no ha cambiado no hace falta recorrerla
+    etag = variant_etag(await run_io(library_generation, uid), prefix, sort, order, limit, data.get('cursor'))
+    headers = validator_headers(etag)
+    if not_modified(etag):
+        return Response(b"", status=304, headers=headers)
 
-# Endpoint para borrar un archivo
-@app.post('/delete_file/<filename>')
-async def delete_file(filename: str):
+    # Listar una página del directorio de la biblioteca del usuario
+    entries, last_key = await run_io(scan_library, uid, prefix, sort, order == "desc", after, limit)
+
+    return jsonify({
+        "files": [entry["name"] for entry in entries],
+        "entries": entries,
+        "next_cursor": encode_cursor(last_key) if last_key is not None else None,
+    }), 200, headers
+
+# Búsqueda de texto: cada biblioteca tiene un índice invertido en SQLite
+# (SEARCH_INDEX_DIR/<uid>.db) que se actualiza al crear o borrar cada archivo. El índice se
+# deriva de la biblioteca: si falta, o si una actualización falló y quedó marcado como
+# desfasado (<uid>.stale), se reconcilia con ella en la siguiente búsqueda
+
+TOKEN_RE = re.compile(r"\w+")
+COMBINING_RE = re.compile(r"[\u0300-\u036f]")  # Tildes y diacríticos tras la normalización NFKD
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')  # Frases entre comillas o palabras sueltas
+MAX_TERM_LENGTH = 64  # Los tokens más largos (hashes, base64...) no se indexan
+SEARCH_REBUILD_BATCH = 200  # Archivos por transacción al reconciliar un índice
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def tokenize(text: str) -> list:
     """
-    Elimina un archivo en la biblioteca del usuario.
+    Divide un texto en términos normalizados (sin mayúsculas ni tildes).
 
-    Request Headers:
-        - Authorization: Bearer <token>
+    Args:
+        text (str): El texto.
 
-    Request JSON:
-        - uid (str): El ID del usuario.
+    Returns:
+        list: Los términos en orden; su posición en la lista es la que se indexa.
+    """
+    text = COMBINING_RE.sub("", unicodedata.normalize("NFKD", text)).casefold()
+    return [term for term in TOKEN_RE.findall(text) if len(term) <= MAX_TERM_LENGTH]
+
+def extract_text(content: bytes):
+    """
+    Decodifica el contenido de un archivo si parece texto.
+
+    Returns:
+        str: El texto (UTF-8, o Latin-1 si no es UTF-8 válido), o None si es binario.
+    """
+    if b"\x00" in content[:8192]:
+        return None
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('latin-1')
+
+def read_text(info: dict):
+    """
+    Lee el texto de un archivo de la biblioteca para indexarlo.
 
     Args:
-        filename (str): El nombre del archivo a eliminar.
+        info (dict): Resultado de stored_file.
 
     Returns:
-        JSON: Mensaje de éxito o error.
+        str: El texto, o None si es binario, mayor que SEARCH_MAX_DOC_SIZE o ya no existe.
     """
-    if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
-        token = request.headers.get('Authorization', '').split(' ')[-1]
-    else:
-        return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
-    
-    data = await request.get_json()
-    uid = data.get('uid')
-    
-    if not filename or not uid or not token:
-        return jsonify({"Error": "Filename, uid and token required"}), 400
-    
-    if not get_user(uid):
-        return jsonify({"Error": "User not found"}), 404
-    
-    if not validate_token(token, create_token(uid, SECRET_UUID)):
-        return jsonify({"Error": "Invalid token"}), 403
-    
-    user_library_dir = os.path.join(LIBRARY_DIR, uid)
-    file_path = os.path.join(user_library_dir, filename)
-    
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        return jsonify({"message": f"File '{filename}' deleted successfully"}), 200
-    else:
-        return jsonify({"Error": "File not found"}), 404
+    if info["size"] > SEARCH_MAX_DOC_SIZE:
+        return None
+    try:
+        with open(info["path"], 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    if info["codec"] == "gzip":
+        content = gzip.decompress(content)
+    return extract_text(content)
 
-# Endpoint para listar los archivos de un usuario
-@app.post('/list_files')
-async def list_files():
+def index_path(uid: str, suffix: str = ".db") -> str:
+    return os.path.join(SEARCH_INDEX_DIR, f"{uid}{suffix}")
+
+def connect_index(uid: str) -> sqlite3.Connection:
     """
-    Lista los archivos en la biblioteca del usuario.
+    Abre el índice de búsqueda de una biblioteca, creándolo si no existe.
+
+    Un índice nuevo o marcado como desfasado se reconcilia con la biblioteca antes de
+    devolverlo.
+
+    Args:
+        uid (str): El ID del usuario.
+
+    Returns:
+        sqlite3.Connection: La conexión abierta; la cierra quien llama.
+    """
+    path = index_path(uid)
+    new = not os.path.exists(path)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        if new:
+            conn.execute("PRAGMA journal_mode=WAL")
+        # El índice se puede reconstruir: no hace falta un fsync por transacción
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-16384")  # 16 MB: las inserciones tocan páginas dispersas
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                "id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, etag TEXT NOT NULL, length INTEGER NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "term TEXT NOT NULL, doc INTEGER NOT NULL, tf INTEGER NOT NULL, positions BLOB NOT NULL, "
+                "PRIMARY KEY (term, doc)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)")
+        # La marca se quita antes de reconciliar: un fallo posterior la vuelve a poner
+        if remove_if_exists(index_path(uid, ".stale")) or new:
+            reconcile_index(conn, uid)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+def remove_document(conn: sqlite3.Connection, name: str) -> None:
+    conn.execute("DELETE FROM postings WHERE doc IN (SELECT id FROM docs WHERE name = ?)", (name,))
+    conn.execute("DELETE FROM docs WHERE name = ?", (name,))
+
+def indexed_etag(conn: sqlite3.Connection, name: str):
+    row = conn.execute("SELECT etag FROM docs WHERE name = ?", (name,)).fetchone()
+    return row[0] if row is not None else None
+
+def document_terms(info: dict) -> list:
+    # Los archivos binarios o demasiado grandes se registran sin términos, para no volver a
+    # leerlos hasta que cambien
+    text = read_text(info)
+    return tokenize(text) if text else []
+
+def write_document(conn: sqlite3.Connection, name: str, etag: str, terms: list) -> None:
+    """
+    Sustituye la entrada de un archivo en el índice, dentro de la transacción de quien llama.
+
+    Args:
+        conn (sqlite3.Connection): El índice de la biblioteca.
+        name (str): El nombre del archivo.
+        etag (str): ETag del contenido indexado.
+        terms (list): Resultado de tokenize.
+    """
+    positions: dict = {}
+    for position, term in enumerate(terms):
+        positions.setdefault(term, []).append(position)
+    remove_document(conn, name)
+    doc = conn.execute("INSERT INTO docs (name, etag, length) VALUES (?, ?, ?)", (name, etag, len(terms))).lastrowid
+    conn.executemany("INSERT INTO postings (term, doc, tf, positions) VALUES (?, ?, ?, ?)",
+                     ((term, doc, len(found), array("I", found).tobytes()) for term, found in positions.items()))
+
+def index_document(conn: sqlite3.Connection, name: str, info: dict) -> None:
+    """
+    Indexa un archivo, sustituyendo su entrada anterior, salvo que su ETag ya esté indexado.
+
+    Args:
+        conn (sqlite3.Connection): El índice de la biblioteca.
+        name (str): El nombre del archivo.
+        info (dict): Resultado de stored_file.
+    """
+    if indexed_etag(conn, name) == info["etag"]:
+        return
+    # El texto se lee y se tokeniza antes de abrir la transacción
+    terms = document_terms(info)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        write_document(conn, name, info["etag"], terms)
+
+def reconcile_index(conn: sqlite3.Connection, uid: str) -> None:
+    """
+    Pone el índice al día con la biblioteca: indexa lo que falta o ha cambiado y quita lo borrado.
+
+    Args:
+        conn (sqlite3.Connection): El índice de la biblioteca.
+        uid (str): El ID del usuario.
+    """
+    try:
+        with os.scandir(os.path.join(LIBRARY_DIR, uid)) as entries:
+            names = {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        names = set()
+    indexed = dict(conn.execute("SELECT name, etag FROM docs"))
+    with conn:
+        for name in indexed.keys() - names:
+            remove_document(conn, name)
+    # Cada archivo toca una página del índice por término: agrupar muchos archivos por
+    # transacción reduce mucho las páginas escritas en el WAL
+    changed = []
+    for name in sorted(names):
+        info = stored_file(uid, name)
+        if info is not None and indexed.get(name) != info["etag"]:
+            changed.append(info)
+    for i in range(0, len(changed), SEARCH_REBUILD_BATCH):
+        batch = [(os.path.basename(info["path"]), info["etag"], document_terms(info))
+                 for info in changed[i:i + SEARCH_REBUILD_BATCH]]
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for name, etag, terms in batch:
+                write_document(conn, name, etag, terms)
+
+def update_search_index(uid: str, filename: str) -> None:
+    """
+    Refleja en el índice de búsqueda el estado actual de un archivo (creado, cambiado o borrado).
+
+    Se indexa lo que hay en disco en este momento, no lo que escribió la petición, así que
+    dos escrituras del mismo archivo en workers distintos dejan el índice con la última. Si
+    la biblioteca aún no tiene índice no se hace nada: se construye en la primera búsqueda.
+    Un fallo no afecta a la escritura: el índice queda marcado para reconciliarlo.
+
+    Args:
+        uid (str): El ID del usuario.
+        filename (str): El nombre del archivo.
+    """
+    if not os.path.exists(index_path(uid)):
+        return
+    start = time.perf_counter()
+    try:
+        conn = connect_index(uid)
+        try:
+            info = stored_file(uid, filename)
+            if info is None:
+                with conn:
+                    remove_document(conn, filename)
+            else:
+                index_document(conn, filename, info)
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError, EOFError, zlib.error):
+        with open(index_path(uid, ".stale"), 'w'):
+            pass
+    metrics.observe("file_search_index_duration_seconds", (), time.perf_counter() - start)
+
+def parse_query(query: str) -> list:
+    """
+    Divide una consulta en cláusulas: palabras sueltas y frases entre comillas.
+
+    Args:
+        query (str): La consulta.
+
+    Returns:
+        list: Una lista de términos por cláusula; las de más de un término son frases.
+    """
+    clauses = []
+    for phrase, word in QUERY_RE.findall(query):
+        terms = tokenize(phrase or word)
+        if terms and terms not in clauses:
+            clauses.append(terms)
+    return clauses
+
+def phrase_count(clause: list, postings: dict, doc: int) -> int:
+    # Apariciones de la frase: posiciones del primer término seguidas de los demás en orden
+    first = array("I", postings[clause[0]][doc][1])
+    following = [set(array("I", postings[term][doc][1])) for term in clause[1:]]
+    return sum(1 for position in first
+               if all(position + offset in found for offset, found in enumerate(following, 1)))
+
+def search_library(uid: str, clauses: list, limit: int, after) -> tuple:
+    """
+    Resuelve una consulta sobre el índice de una biblioteca.
+
+    Se devuelven los archivos que contienen todas las cláusulas, ordenados por su
+    puntuación BM25 (la suma de la de cada cláusula; una frase cuenta como un término con
+    sus apariciones y el df de su término más raro) y por nombre.
+
+    Args:
+        uid (str): El ID del usuario.
+        clauses (list): Resultado de parse_query.
+        limit (int): Número máximo de resultados.
+        after (tuple): (puntuación, nombre) del último resultado de la página anterior, o None.
+
+    Returns:
+        tuple: (resultados {name, score, matches}, total de archivos que cumplen la
+        consulta, clave del último resultado o None si no hay más).
+    """
+    phrase_terms = {term for clause in clauses if len(clause) > 1 for term in clause}
+    conn = connect_index(uid)
+    try:
+        doc_count, total_length = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+        # doc -> (tf, posiciones); las posiciones solo se leen para los términos de frases
+        postings = {}
+        for term in {term for clause in clauses for term in clause}:
+            if term in phrase_terms:
+                rows = conn.execute("SELECT doc, tf, positions FROM postings WHERE term = ?", (term,))
+                postings[term] = {doc: (tf, positions) for doc, tf, positions in rows}
+            else:
+                rows = conn.execute("SELECT doc, tf FROM postings WHERE term = ?", (term,))
+                postings[term] = {doc: (tf, None) for doc, tf in rows}
+        # Intersección empezando por el término más raro
+        candidates = None
+        for term in sorted(postings, key=lambda term: len(postings[term])):
+            candidates = set(postings[term]) if candidates is None else candidates & postings[term].keys()
+            if not candidates:
+                return [], 0, None
+        docs = {}
+        ids = sorted(candidates)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = conn.execute(f"SELECT id, name, length FROM docs WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            docs.update((doc, (name, length)) for doc, name, length in rows)
+    finally:
+        conn.close()
+
+    average_length = total_length / doc_count if total_length else 1.0
+    hits = []
+    for doc, (name, length) in docs.items():
+        score = 0.0
+        matches = 0
+        for clause in clauses:
+            if len(clause) == 1:
+                tf = postings[clause[0]][doc][0]
+                df = len(postings[clause[0]])
+            else:
+                tf = phrase_count(clause, postings, doc)
+                if tf == 0:
+                    break
+                df = min(len(postings[term]) for term in clause)
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+            matches += tf
+        else:
+            # Se redondea para que el cursor (JSON) reproduzca exactamente el orden
+            hits.append((-round(score, 6), name, matches))
+
+    total = len(hits)
+    if after is not None:
+        hits = [hit for hit in hits if (hit[0], hit[1]) > (-after[0], after[1])]
+    page = heapq.nsmallest(limit + 1, hits)
+    has_more = len(page) > limit
+    page = page[:limit]
+    results = [{"name": name, "score": -score, "matches": matches} for score, name, matches in page]
+    last_key = (-page[-1][0], page[-1][1]) if page and has_more else None
+    return results, total, last_key
+
+# Endpoint para buscar en el contenido de la biblioteca
+@app.post('/search')
+async def search_files():
+    """
+    Busca archivos de la biblioteca del usuario por su contenido.
+
+    La consulta son palabras y frases entre comillas; se devuelven los archivos que las
+    contienen todas, ordenados por relevancia (BM25). No se distinguen mayúsculas ni tildes.
+    Solo se indexa el texto de los archivos de hasta SEARCH_MAX_DOC_SIZE bytes.
 
     Request Headers:
         - Authorization: Bearer <token>
 
     Request JSON:
         - uid (str): El ID del usuario.
+        - q (str): La consulta, p. ej. `hidalgo "lugar de la mancha"`.
+        - limit (int, opcional): Resultados por página (SEARCH_PAGE_SIZE por defecto).
+        - cursor (str, opcional): `next_cursor` de la página anterior.
 
     Returns:
-        JSON: Lista de archivos o error.
+        JSON: `results` (name, score y matches, el número de apariciones), `total` y
+        `next_cursor` (None en la última página), o error.
     """
     if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
         token = request.headers.get('Authorization', '').split(' ')[-1]
     else:
         return jsonify({"Error": "Format must be \"Authorization Bearer <token>\""}), 405
-    
+
     data = await request.get_json()
     uid = data.get('uid')
+    query = data.get('q')
 
-    if not uid:
-        return jsonify({"Error": "Uid required"}), 400
-    
-    if not get_user(uid):
-        return jsonify({"Error": "User not found"}), 404
-    
-    if not validate_token(token, create_token(uid, SECRET_UUID)):
+    if not uid or not isinstance(query, str) or not query.strip():
+        return jsonify({"Error": "Uid and q required"}), 400
+
+    # El token firmado basta para autorizar: no hace falta consultar los usuarios
+    if not validate_token(token, uid):
         return jsonify({"Error": "Invalid token"}), 403
-    
-    # Listar archivos en el directorio de la biblioteca del usuario
-    user_library_dir = os.path.join(LIBRARY_DIR, uid)
-    files = os.listdir(user_library_dir)
 
-    return jsonify({"files": files}), 200
+    try:
+        limit = int(data.get('limit', SEARCH_PAGE_SIZE))
+        after = decode_cursor(data['cursor']) if data.get('cursor') else None
+    except (TypeError, ValueError) as e:
+        return jsonify({"Error": str(e)}), 400
+    if limit < 1:
+        return jsonify({"Error": "Invalid limit"}), 400
+    if after is not None and [type(k) for k in after] not in ([float, str], [int, str]):
+        return jsonify({"Error": "Invalid cursor"}), 400
+    limit = min(limit, SEARCH_MAX_PAGE_SIZE)
+
+    clauses = parse_query(query)
+    if not clauses:
+        return jsonify({"Error": "Query has no searchable terms"}), 400
+    if sum(len(clause) for clause in clauses) > SEARCH_MAX_TERMS:
+        return jsonify({"Error": f"Query exceeds {SEARCH_MAX_TERMS} terms"}), 400
+
+    start = time.perf_counter()
+    results, total, last_key = await run_io(search_library, uid, clauses, limit, after)
+    metrics.observe("file_search_query_duration_seconds", (), time.perf_counter() - start)
+
+    return jsonify({
+        "results": results,
+        "total": total,
+        "next_cursor": encode_cursor(last_key) if last_key is not None else None,
+    }), 200
+
+def resolve_ranges(file_size: int) -> list:
+    """
+    Traduce la cabecera Range de la petición a intervalos concretos del archivo.
+
+    Args:
+        file_size (int): Tamaño del archivo en bytes.
+
+    Returns:
+        list: Lista de tuplas (inicio, fin) con fin exclusivo; vacía si no se pidió
+        ningún rango y None si ninguno de los rangos pedidos es satisfacible.
+    """
+    requested = request.range
+    if requested is None or requested.units != "bytes":
+        return []
+    ranges = []
+    for start, stop in requested.ranges:
+        if start < 0:
+            # Sufijo: los últimos -start bytes
+            start = max(file_size + start, 0)
+            stop = file_size
+        else:
+            stop = file_size if stop is None else min(stop, file_size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges or None
+
+async def iter_file(file_path: str, start: int, stop: int):
+    """
+    Lee un intervalo de un archivo por bloques de DOWNLOAD_CHUNK_SIZE bytes.
+
+    Args:
+        file_path (str): Ruta del archivo.
+        start (int): Primer byte a leer.
+        stop (int): Byte en el que termina la lectura (exclusivo).
+
+    Yields:
+        bytes: Bloques del archivo.
+    """
+    async with open_async(file_path, 'rb') as f:
+        await f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = await f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+async def iter_stored(info: dict, start: int, stop: int):
+    """
+    Lee un intervalo del contenido sin comprimir de un archivo de la biblioteca.
+
+    Los archivos comprimidos se descomprimen desde el miembro gzip que contiene `start`
+    (desde el principio en los blobs sin índice), descartando lo que queda antes.
+
+    Args:
+        info (dict): Resultado de stored_file.
+        start (int): Primer byte a leer.
+        stop (int): Byte en el que termina la lectura (exclusivo).
+
+    Yields:
+        bytes: Bloques del contenido.
+    """
+    if info["codec"] is None:
+        async for chunk in iter_file(info["path"], start, stop):
+            yield chunk
+        return
+    compressed_start, position, compressed_size = await run_io(gzip_range_start, info, start)
+    decompressor = zlib.decompressobj(wbits=31)
+    async for compressed in iter_file(info["path"], compressed_start, compressed_size):
+        while compressed:
+            data = decompressor.decompress(compressed)
+            compressed = b""
+            if decompressor.eof:
+                # Fin de un miembro: lo que sobra es el principio del siguiente
+                compressed = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+            if data:
+                chunk_start, chunk_stop = position, position + len(data)
+                position = chunk_stop
+                if chunk_stop > start:
+                    yield data[max(start - chunk_start, 0):min(stop, chunk_stop) - chunk_start]
+                if position >= stop:
+                    return
+
+def gzip_range_start(info: dict, start: int) -> tuple:
+    """
+    Returns:
+        tuple: (offset comprimido y sin comprimir del miembro que contiene `start`, tamaño
+        del archivo comprimido).
+    """
+    compressed_start, position = gzip_member_at(info["path"], info["hash"], start)
+    return compressed_start, position, os.path.getsize(info["path"])
+
+async def get_content(uid: str, filename: str, info: dict):
+    """
+    Devuelve el contenido de un archivo desde la caché; los fallos se cargan en el pool de E/S.
+
+    Returns:
+        bytes: El contenido, o None si el archivo es demasiado grande para cachearse.
+    """
+    if not content_cache.cacheable(info["size"]):
+        return None
+    content = content_cache.get(uid, filename, info["etag"])
+    if content is None:
+        content = await run_io(load_content, uid, filename, info)
+    return content
+
+async def iter_content(content: bytes, start: int, stop: int):
+    """
+    Envía un intervalo de un contenido ya en memoria por bloques de DOWNLOAD_CHUNK_SIZE bytes.
+    """
+    for position in range(start, stop, DOWNLOAD_CHUNK_SIZE):
+        yield content[position:min(position + DOWNLOAD_CHUNK_SIZE, stop)]
 
 # Endpoint para descargar un archivo
 @app.get('/download_file/<filename>')
@@ -201,37 +3306,268 @@ async def download_file(filename: str):
     """
     Descarga un archivo de la biblioteca del usuario.
 
-    Request JSON:
+    El archivo se envía al cliente por bloques, sin cargarlo entero en memoria. Se admite la
+    cabecera Range (uno o varios rangos) para reanudar descargas o pedir partes en paralelo.
+    Si el archivo está guardado con gzip y el cliente lo acepta (Accept-Encoding), se envía
+    tal cual con Content-Encoding: gzip, sin descomprimir ni volver a comprimir.
+
+    Request Query / JSON:
         - uid (str): El ID del usuario.
 
+    Request Headers:
+        - Range (opcional): bytes=<inicio>-<fin>[, ...]
+        - If-Range (opcional): los rangos solo se aplican si el ETag coincide.
+        - If-None-Match / If-Modified-Since (opcionales): 304 si el archivo no ha cambiado.
+
     Args:
         filename (str): El nombre del archivo a descargar.
 
     Returns:
-        JSON: Mensaje de éxito o error.
+        Response: El contenido del archivo (200), los rangos pedidos (206) o error.
     """
-    data = await request.get_json()
-    uid = data.get('uid')
+    uid = request.args.get('uid')
+    if not uid:
+        data = await request.get_json(silent=True) or {}
+        uid = data.get('uid')
 
     if not filename or not uid:
         return jsonify({"Error": "Filename and uid of the library required"}), 400
     
-    if not get_user(uid):
+    if not await get_user(uid):
         return jsonify({"Error": "Library not found"}), 404
     
-    user_library_dir = os.path.join(LIBRARY_DIR, uid)
-    file_path = os.path.join(user_library_dir, filename)
+    info = await run_io(stored_file, uid, filename)
+    if info is None:
+        return jsonify({"Error": "File not found"}), 404
+    file_size = info["size"]
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range.strip() != f'"{info["etag"]}"':
+        # El cliente tiene una versión antigua: se envía el archivo completo
+        ranges = []
+    else:
+        ranges = resolve_ranges(file_size)
 
-    if os.path.exists(file_path):
-        os.makedirs('../downloads', exist_ok=True)
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-        file_path = os.path.join('../downloads', filename)
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
-        return jsonify({"message": f"File '{filename}' downloaded successfully"}), 200
+    # Los rangos se sirven siempre sin comprimir, así que solo el archivo completo puede ir con gzip
+    send_gzip = ranges == [] and info["codec"] == "gzip" and request.accept_encodings.quality("gzip") > 0
+    # La versión comprimida es otra representación: necesita su propio ETag
+    etag = f"{info['etag']}-gz" if send_gzip else info["etag"]
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename=\"{filename}\"",
+        "Vary": "Accept-Encoding",
+        **validator_headers(etag, info["mtime"]),
+        "X-Version": str(info["version"]),
+    }
+    if not_modified(etag, info["mtime"]):
+        return Response(b"", status=304, headers=headers)
+
+    if ranges is None:
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return Response(b"", status=416, headers=headers)
+
+    # Los archivos pequeños se sirven desde la caché de contenido
+    content = None if send_gzip and not ranges else await get_content(uid, filename, info)
+
+    def iter_range(start: int, stop: int):
+        if content is not None:
+            return iter_content(content, start, stop)
+        return iter_stored(info, start, stop)
+
+    if not ranges:
+        if send_gzip:
+            # Se envía el blob comprimido tal cual
+            compressed_size = (await run_io(os.stat, info["path"])).st_size
+            headers["Content-Encoding"] = "gzip"
+            headers["Content-Length"] = str(compressed_size)
+            return Response(iter_file(info["path"], 0, compressed_size), status=200,
+                            mimetype="application/octet-stream", headers=headers)
+        headers["Content-Length"] = str(file_size)
+        return Response(iter_range(0, file_size), status=200,
+                        mimetype="application/octet-stream", headers=headers)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{file_size}"
+        headers["Content-Length"] = str(stop - start)
+        return Response(iter_range(start, stop), status=206,
+                        mimetype="application/octet-stream", headers=headers)
+
+    # Varios rangos: respuesta multipart/byteranges
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{file_size}\r\n\r\n").encode('latin-1')
+        for start, stop in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode('latin-1')
+    headers["Content-Length"] = str(
+        sum(len(h) + (stop - start) for h, (start, stop) in zip(part_headers, ranges))
+        + 2 * (len(ranges) - 1) + len(closing)
+    )
+
+    async def iter_parts():
+        for i, (start, stop) in enumerate(ranges):
+            yield (b"\r\n" if i else b"") + part_headers[i]
+            async for chunk in iter_range(start, stop):
+                yield chunk
+        yield closing
+
+    return Response(iter_parts(), status=206,
+                    content_type=f"multipart/byteranges; boundary={boundary}", headers=headers)
+
+READ_PAGE_KEYS = ("offset", "length", "start_line", "line_count", "format")
+
+def read_gzip_page(file_path: str, options: dict, size: int, offset: int, length: int, digest=None) -> tuple:
+    """
+    Equivalente de la lectura con mmap para archivos guardados con gzip.
+
+    Las páginas por bytes empiezan en el miembro gzip que contiene `offset` (ver
+    gzip_member_at). Las páginas por líneas, y las de los blobs sin índice, se descomprimen
+    desde el principio; la memoria usada no depende del tamaño del archivo.
+
+    Returns:
+        tuple: (offset, bytes de la página).
+    """
+    if 'start_line' not in options:
+        offset = min(offset, size)
+        compressed_start, position = gzip_member_at(file_path, digest, offset)
+        with open(file_path, 'rb') as raw:
+            raw.seek(compressed_start)
+            with gzip.GzipFile(fileobj=raw, mode='rb') as g:
+                g.seek(offset - position)
+                return offset, g.read(length)
+
+    with gzip.open(file_path, 'rb') as g:
+        start_line = int(options['start_line'])
+        line_count = int(options.get('line_count', 1))
+        if start_line < 0 or line_count < 0:
+            raise ValueError("start_line and line_count must be non-negative")
+        offset = 0
+        lines = 0
+        while lines < start_line:
+            piece = g.readline(DOWNLOAD_CHUNK_SIZE)
+            if not piece:
+                break
+            offset += len(piece)
+            if piece.endswith(b"\n"):
+                lines += 1
+        chunk = b""
+        lines = 0
+        while lines < line_count and len(chunk) < READ_MAX_LENGTH:
+            piece = g.readline(READ_MAX_LENGTH - len(chunk))
+            if not piece:
+                break
+            chunk += piece
+            if piece.endswith(b"\n"):
+                lines += 1
+        return offset, chunk
+
+def read_buffer_page(buffer, options: dict, offset: int, length: int) -> tuple:
+    """
+    Extrae una página de un contenido ya accesible en memoria (un mmap o unos bytes).
+
+    Returns:
+        tuple: (offset, bytes de la página).
+    """
+    size = len(buffer)
+    if 'start_line' in options:
+        start_line = int(options['start_line'])
+        line_count = int(options.get('line_count', 1))
+        if start_line < 0 or line_count < 0:
+            raise ValueError("start_line and line_count must be non-negative")
+        offset = 0
+        for _ in range(start_line):
+            newline = buffer.find(b"\n", offset)
+            if newline == -1:
+                offset = size
+                break
+            offset = newline + 1
+        stop = offset
+        for _ in range(line_count):
+            if stop >= size:
+                break
+            newline = buffer.find(b"\n", stop)
+            stop = size if newline == -1 else newline + 1
+        length = min(stop - offset, READ_MAX_LENGTH)
+
+    offset = min(offset, size)
+    return offset, buffer[offset:offset + length]
+
+def read_mmap_page(file_path: str, options: dict, offset: int, length: int) -> tuple:
+    """
+    Lee una página de un archivo sin comprimir a través de mmap.
+
+    Returns:
+        tuple: (offset, bytes de la página, tamaño del archivo).
+    """
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0, b"", 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset, chunk = read_buffer_page(mm, options, offset, length)
+    return offset, chunk, size
+
+def read_page(file_path: str, options: dict, codec=None, size=None, digest=None) -> dict:
+    """
+    Lee una página de un archivo proyectándolo en memoria (mmap), sin copiarlo entero.
+
+    La página se indica por bytes (`offset`/`length`) o por líneas (`start_line`/`line_count`,
+    empezando en 0). En modo texto se decodifica con `encoding` y nunca se corta un carácter
+    multibyte a la mitad: `length` y `next_offset` reflejan los bytes realmente devueltos.
+
+    Args:
+        file_path (str): Ruta del archivo.
+        options (dict): Parámetros de la petición.
+        codec (str): 'gzip' si el archivo está comprimido, None si no.
+        size (int): Tamaño sin comprimir (solo para archivos comprimidos).
+        digest (str): Hash del contenido, para buscar el índice de los archivos comprimidos.
+
+    Returns:
+        dict: offset, length, size, next_offset (None al llegar al final), data (bytes)
+        y text (el texto decodificado, None en modo raw).
+
+    Raises:
+        ValueError: Si los parámetros no son válidos o `encoding` no es una codificación de texto.
+        LookupError: Si `encoding` no existe.
+    """
+    offset = int(options.get('offset', 0))
+    length = int(options.get('length', READ_MAX_LENGTH))
+    if offset < 0 or length < 0:
+        raise ValueError("Offset and length must be non-negative")
+    length = min(length, READ_MAX_LENGTH)
+    text_mode = options.get('format', 'text') == 'text'
+    encoding = options.get('encoding', 'utf-8')
+    # Solo codificaciones de texto: hex, base64, zlib... convierten bytes en bytes
+    if text_mode and not codecs.lookup(encoding)._is_text_encoding:
+        raise ValueError(f"{encoding} is not a text encoding")
+
+    if codec == "gzip":
+        offset, chunk = read_gzip_page(file_path, options, size, offset, length, digest)
     else:
-        return jsonify({"Error": "File not found"}), 404
+        offset, chunk, size = read_mmap_page(file_path, options, offset, length)
+    if size == 0:
+        return {"offset": 0, "length": 0, "size": 0, "next_offset": None, "data": b"",
+                "text": "" if text_mode else None}
+
+    if text_mode:
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        text = decoder.decode(chunk, final=offset + len(chunk) >= size)
+        pending = decoder.getstate()[0]
+        if pending:
+            chunk = chunk[:len(chunk) - len(pending)]
+    else:
+        text = None
+
+    next_offset = offset + len(chunk)
+    return {
+        "offset": offset,
+        "length": len(chunk),
+        "size": size,
+        "next_offset": next_offset if next_offset < size else None,
+        "data": chunk,
+        "text": text,
+    }
 
 # Endpoint para leer el contenido de un archivo
 @app.post('/read_file/<filename>')
@@ -241,6 +3577,18 @@ async def read_file(filename: str):
 
     Request JSON:
         - uid (str): El ID del usuario.
+        - offset, length (int, opcionales): Página en bytes (como mucho READ_MAX_LENGTH).
+        - start_line, line_count (int, opcionales): Página en líneas.
+        - format (str, opcional): 'text' (por defecto, decodificado con `encoding`) o 'raw'.
+        - encoding (str, opcional): Codificación de texto del archivo ('utf-8' por defecto).
+
+    Las respuestas llevan ETag y Last-Modified; con If-None-Match o If-Modified-Since se
+    responde 304 sin leer el archivo si no ha cambiado.
+
+    Sin parámetros de página se devuelve el archivo completo con el formato clásico. Con
+    ellos solo se lee la página pedida: en modo 'text' se devuelve JSON con el texto y
+    `next_offset`, y en modo 'raw' los bytes tal cual con las cabeceras X-File-Size,
+    X-Offset y X-Next-Offset.
 
     Args:
         filename (str): El nombre del archivo a leer.
@@ -254,28 +3602,82 @@ async def read_file(filename: str):
     if not filename or not uid:
         return jsonify({"Error": "Filename and uid of the library required"}), 400
     
-    if not get_user(uid):
+    if not await get_user(uid):
         return jsonify({"Error": "Library not found"}), 404
     
-    user_library_dir = os.path.join(LIBRARY_DIR, uid)
-    file_path = os.path.join(user_library_dir, filename)
-
-    if os.path.exists(file_path):
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-        return jsonify({f"Reading file '{filename}'":  f"    {file_content}    "}), 200
-    else:
+    info = await run_io(stored_file, uid, filename)
+    if info is None:
         return jsonify({"Error": "File not found"}), 404
 
+    # Cada página es una variante distinta del archivo
+    etag = variant_etag(info["etag"], *[data.get(key) for key in READ_PAGE_KEYS + ("encoding",)])
+    headers = validator_headers(etag, info["mtime"])
+    headers["X-Version"] = str(info["version"])
+    if not_modified(etag, info["mtime"]):
+        return Response(b"", status=304, headers=headers)
+
+    if not any(key in data for key in READ_PAGE_KEYS):
+        content = await get_content(uid, filename, info)
+        if content is None:
+            async with open_async(info["path"], 'rb') as f:
+                content = await f.read()
+            if info["codec"] == "gzip":
+                content = gzip.decompress(content)
+        return jsonify({f"Reading file '{filename}'":  f"    {content}    "}), 200, headers
+
+    # Las páginas se leen con mmap (o seek en los comprimidos) sea cual sea el tamaño del
+    # archivo: pedir una página no debe cargarlo entero en memoria ni en la caché
+    try:
+        page = await run_io(read_page, info["path"], data, info["codec"], info["size"], info["hash"])
+    except (ValueError, TypeError, LookupError) as e:
+        return jsonify({"Error": str(e)}), 400
+
+    if page["text"] is None:
+        headers.update({
+            "X-File-Size": str(page["size"]),
+            "X-Offset": str(page["offset"]),
+            "X-Next-Offset": "" if page["next_offset"] is None else str(page["next_offset"]),
+        })
+        return Response(page["data"], status=200, mimetype="application/octet-stream", headers=headers)
+
+    return jsonify({
+        "filename": filename,
+        "offset": page["offset"],
+        "length": page["length"],
+        "size": page["size"],
+        "next_offset": page["next_offset"],
+        "content": page["text"],
+    }), 200, headers
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5051)
+    if sys.argv[1:] == ["dev"]:
+        # Servidor de desarrollo de Quart (un solo proceso)
+        app.run(host="0.0.0.0", port=5051)
+    else:
+        if METRICS_DIR:
+            metrics.clear_directory()
+        sys.exit(serve(__file__, 5051))
 
 """
 Comprobacion
 
 curl -X POST http://127.0.0.1:5051/create_file/prueba.txt -H 'Content-Type: application/json'  -H 'Authorization: Bearer' -d '{"uid": "", "content": "texto de prueba del fichero"}'
+curl -X POST "http://127.0.0.1:5051/create_file/libro.pdf?uid=" -H 'Content-Type: application/octet-stream' -H 'Authorization: Bearer ' --data-binary @libro.pdf
+curl -X POST "http://127.0.0.1:5051/create_file/libro.pdf?uid=" -H 'Authorization: Bearer ' -F 'file=@libro.pdf'
+curl -X POST http://127.0.0.1:5051/uploads -H 'Content-Type: application/json' -H 'Authorization: Bearer ' -d '{"uid": "", "filename": "libro.pdf"}'
+curl -X PUT http://127.0.0.1:5051/uploads/<upload_id>/0 -H 'Authorization: Bearer ' --data-binary @libro.pdf.part0
+curl -X POST http://127.0.0.1:5051/uploads/<upload_id>/commit -H 'Content-Type: application/json' -H 'Authorization: Bearer ' -d '{"parts": 1, "sha256": ""}'
 curl -X POST http://127.0.0.1:5051/delete_file/prueba.txt -H 'Content-Type: application/json' -H 'Authorization: Bearer ' -d '{"uid": ""}'
 curl -X POST http://127.0.0.1:5051/list_files -H 'Content-Type: application/json' -H 'Authorization: Bearer ' -d '{"uid": ""}'
+curl -X POST http://127.0.0.1:5051/search -H 'Content-Type: application/json' -H 'Authorization: Bearer ' -d '{"uid": "", "q": "hidalgo \"lugar de la mancha\""}'
+curl -X GET "http://127.0.0.1:5051/usage?uid=" -H 'Authorization: Bearer '
 curl -X GET http://127.0.0.1:5051/download_file/prueba.txt -H 'Content-Type: application/json' -d '{"uid": ""}'
+curl -X POST http://127.0.0.1:5051/read_file/prueba.txt -H 'Content-Type: application/json' -d '{"uid": "", "offset": 0, "length": 4096}'
+curl -X GET "http://127.0.0.1:5051/download_file/prueba.txt?uid=" -H 'Range: bytes=0-9,20-' -o prueba.parts
+curl http://127.0.0.1:5051/metrics
+curl -X POST http://127.0.0.1:5051/profiling -H 'X-Profile: secreto' -H 'Content-Type: application/json' -d '{"route": "/list_files"}'
+curl "http://127.0.0.1:5051/jobs?status=failed" -H 'X-Jobs-Token: secreto'
+curl -X POST http://127.0.0.1:5051/jobs -H 'X-Jobs-Token: secreto' -H 'Content-Type: application/json' -d '{"type": "sweep_orphans"}'
+curl -X POST http://127.0.0.1:5051/jobs/1/retry -H 'X-Jobs-Token: secreto'
 
 """
\ No newline at end of file
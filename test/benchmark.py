@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+benchmark.py
+Prueba de carga concurrente de user.py y file.py.
+
+Siembra un conjunto reproducible de N usuarios con M archivos cada uno (mismos nombres y
+contenidos para la misma semilla), lanza una mezcla de operaciones (alta, login, crear,
+listar, leer y borrar archivos) desde varios hilos con conexiones reutilizadas y escribe
+un informe JSON con el rendimiento y las latencias p50/p95/p99 de cada operación.
+
+Uso:
+    python benchmark.py --users 20 --files 50 --concurrency 16 --duration 30 --output actual.json
+    python benchmark.py --users 20 --files 50 --compare base.json --output actual.json
+"""
+
+URL_USER = os.environ.get("URL_USER", "http://localhost:5050/")
+URL_FILE = os.environ.get("URL_FILE", "http://localhost:5051/")
+
+DEFAULT_MIX = "signup=1,login=2,create=3,list=3,read=8,delete=1"
+
+local = threading.local()
+
+def session():
+    """
+    Devuelve la sesión HTTP del hilo actual; cada hilo mantiene abiertas sus conexiones.
+    """
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        local.session.mount("http://", adapter)
+        local.session.mount("https://", adapter)
+    return local.session
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def parse_mix(spec):
+    mix = {}
+    for item in spec.split(","):
+        name, weight = item.split("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Operaciones desconocidas: {', '.join(sorted(unknown))}")
+    return mix
+
+def file_content(rng, size):
+    # Texto con líneas para que read_file pueda paginar por líneas
+    words = ["libro", "capítulo", "página", "índice", "nota", "autor", "año", "edición"]
+    lines = []
+    total = 0
+    while total < size:
+        line = " ".join(rng.choice(words) for _ in range(8))
+        lines.append(line)
+        total += len(line.encode("utf-8")) + 1
+    return "\n".join(lines)[:size]
+
+class Dataset:
+    """
+    Usuarios y archivos sembrados. Los nombres dependen solo de la semilla, así que dos
+    ejecuciones con los mismos parámetros trabajan sobre los mismos datos.
+    """
+
+    def __init__(self, seed, users, files, file_size):
+        self.seed = seed
+        self.prefix = f"bench{seed}"
+        self.rng = random.Random(seed)
+        self.names = [f"{self.prefix}-u{i}" for i in range(users)]
+        self.files = [f"{self.prefix}-f{j}.txt" for j in range(files)]
+        self.contents = [file_content(self.rng, file_size) for _ in range(min(files, 16))]
+        self.password = f"pw-{seed}"
+        self.accounts = []  # (nombre, uid, token)
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.created = []  # (uid, token, archivo) creados durante la prueba, para borrarlos
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+def login(name, password):
+    response = session().post(URL_USER + f"get_user_uid/{name}", json={"password": password})
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    return data["uid"], data["token"]
+
+def seed(dataset, concurrency):
+    """
+    Crea (o reutiliza) los usuarios y sube sus archivos.
+    """
+    def seed_user(name):
+        response = session().post(URL_USER + f"create_user/{name}", json={"password": dataset.password})
+        if response.status_code == 200:
+            data = response.json()
+            uid, token = data["uid"], data["token"]
+        else:
+            account = login(name, dataset.password)
+            if account is None:
+                raise SystemExit(f"No se puede crear ni iniciar sesión con {name}: {response.text}")
+            uid, token = account
+        headers = {"Authorization": f"Bearer {token}"}
+        for j, filename in enumerate(dataset.files):
+            content = dataset.contents[j % len(dataset.contents)]
+            session().post(URL_FILE + f"create_file/{filename}", headers=headers,
+                           json={"uid": uid, "content": content}).raise_for_status()
+        return name, uid, token
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        dataset.accounts = list(pool.map(seed_user, dataset.names))
+
+# Operaciones de la mezcla: cada una recibe el conjunto de datos y un generador aleatorio
+# propio del hilo y devuelve la respuesta
+def op_signup(dataset, rng):
+    name = f"{dataset.prefix}-s{os.getpid()}-{dataset.next_id()}"
+    return session().post(URL_USER + f"create_user/{name}", json={"password": dataset.password})
+
+def op_login(dataset, rng):
+    name, _, _ = rng.choice(dataset.accounts)
+    return session().post(URL_USER + f"get_user_uid/{name}", json={"password": dataset.password})
+
+def op_create(dataset, rng):
+    _, uid, token = rng.choice(dataset.accounts)
+    filename = f"{dataset.prefix}-tmp{dataset.next_id()}.txt"
+    response = session().post(URL_FILE + f"create_file/{filename}", headers={"Authorization": f"Bearer {token}"},
+                              json={"uid": uid, "content": rng.choice(dataset.contents)})
+    if response.status_code == 200:
+        with dataset.lock:
+            dataset.created.append((uid, token, filename))
+    return response
+
+def op_list(dataset, rng):
+    _, uid, token = rng.choice(dataset.accounts)
+    return session().post(URL_FILE + "list_files", headers={"Authorization": f"Bearer {token}"},
+                          json={"uid": uid, "limit": 100})
+
+def op_read(dataset, rng):
+    _, uid, _ = rng.choice(dataset.accounts)
+    return session().post(URL_FILE + f"read_file/{rng.choice(dataset.files)}",
+                          json={"uid": uid, "offset": 0, "length": 4096})
+
+def op_delete(dataset, rng):
+    with dataset.lock:
+        target = dataset.created.pop() if dataset.created else None
+    if target is None:
+        return op_create(dataset, rng)
+    uid, token, filename = target
+    return session().post(URL_FILE + f"delete_file/{filename}", headers={"Authorization": f"Bearer {token}"},
+                          json={"uid": uid})
+
+OPERATIONS = {
+    "signup": op_signup,
+    "login": op_login,
+    "create": op_create,
+    "list": op_list,
+    "read": op_read,
+    "delete": op_delete,
+}
+
+def run(dataset, mix, concurrency, duration, requests_limit, seed_value):
+    """
+    Lanza la mezcla de operaciones durante `duration` segundos (o hasta `requests_limit` peticiones).
+
+    Returns:
+        dict: Latencias (segundos) y errores por operación, y la duración real.
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    issued = 0
+    issued_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        nonlocal issued
+        rng = random.Random(seed_value * 1000 + index)
+        while time.perf_counter() < deadline:
+            with issued_lock:
+                if requests_limit and issued >= requests_limit:
+                    return
+                issued += 1
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                response = OPERATIONS[name](dataset, rng)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with issued_lock:
+                latencies[name].append(elapsed)
+                if not ok:
+                    errors[name] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+def summarize(latencies, errors, elapsed):
+    operations = {}
+    total = 0
+    for name, values in latencies.items():
+        values.sort()
+        total += len(values)
+        operations[name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "throughput": len(values) / elapsed if elapsed else 0.0,
+            "p50_ms": None if not values else percentile(values, 0.50) * 1000,
+            "p95_ms": None if not values else percentile(values, 0.95) * 1000,
+            "p99_ms": None if not values else percentile(values, 0.99) * 1000,
+            "max_ms": None if not values else values[-1] * 1000,
+        }
+    every = sorted(v for values in latencies.values() for v in values)
+    return {
+        "requests": total,
+        "errors": sum(errors.values()),
+        "elapsed_s": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "p50_ms": None if not every else percentile(every, 0.50) * 1000,
+        "p95_ms": None if not every else percentile(every, 0.95) * 1000,
+        "p99_ms": None if not every else percentile(every, 0.99) * 1000,
+        "operations": operations,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def print_report(report, baseline=None):
+    print(f"{'operación':<10} {'peticiones':>10} {'errores':>8} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = list(report["operations"].items()) + [("total", report)]
+    for name, row in rows:
+        line = (f"{name:<10} {row['requests']:>10} {row['errors']:>8} {row['throughput']:>9.1f} "
+                + " ".join(f"{row[key]:>9.2f}" if row[key] is not None else f"{'-':>9}" for key in ("p50_ms", "p95_ms", "p99_ms")))
+        base = baseline and (baseline["results"] if name == "total" else baseline["results"]["operations"].get(name))
+        if base and base.get("p95_ms") and row["p95_ms"]:
+            line += f"   p95 {100 * (row['p95_ms'] / base['p95_ms'] - 1):+.1f}%  req/s {100 * (row['throughput'] / base['throughput'] - 1):+.1f}%"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de user.py y file.py")
+    parser.add_argument("--users", type=int, default=10, help="Usuarios sembrados")
+    parser.add_argument("--files", type=int, default=20, help="Archivos por usuario")
+    parser.add_argument("--file-size", type=int, default=4096, help="Tamaño de cada archivo en bytes")
+    parser.add_argument("--seed", type=int, default=1, help="Semilla del conjunto de datos y de la mezcla")
+    parser.add_argument("--concurrency", type=int, default=8, help="Hilos cliente simultáneos")
+    parser.add_argument("--duration", type=float, default=20, help="Segundos de prueba")
+    parser.add_argument("--requests", type=int, default=0, help="Máximo de peticiones (0 = sin límite)")
+    parser.add_argument("--warmup", type=float, default=2, help="Segundos de calentamiento sin medir")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Pesos de las operaciones")
+    parser.add_argument("--skip-seed", action="store_true", help="Reutilizar un conjunto ya sembrado")
+    parser.add_argument("--output", help="Fichero JSON con los resultados")
+    parser.add_argument("--compare", help="Resultados JSON de una versión anterior para comparar")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    dataset = Dataset(args.seed, args.users, args.files, args.file_size)
+
+    start = time.perf_counter()
+    if args.skip_seed:
+        dataset.accounts = [(name, *login(name, dataset.password)) for name in dataset.names]
+    else:
+        seed(dataset, args.concurrency)
+    print(f"Conjunto de datos: {args.users} usuarios x {args.files} archivos ({time.perf_counter() - start:.1f} s)")
+
+    if args.warmup > 0:
+        run(dataset, mix, args.concurrency, args.warmup, 0, args.seed + 1)
+
+    latencies, errors, elapsed = run(dataset, mix, args.concurrency, args.duration, args.requests, args.seed)
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "targets": {"user": URL_USER, "file": URL_FILE},
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": summarize(latencies, errors, elapsed),
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    print_report(report["results"], baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Resultados guardados en {args.output}")
+
+if __name__ == "__main__":
+    main()
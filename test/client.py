@@ -1,8 +1,5 @@
 import requests
 import json
-import uuid
-from hashlib import sha1
-import logging
 
 """
 client.py
@@ -10,14 +7,9 @@ Este script de pruebas automatiza la interacción con el servidor de usuarios y
 Limpia archivos previos, crea usuarios, actualiza contraseñas, realiza inicios de sesión y prueba operaciones con archivos.
 """
 
-SECRET_UUID = uuid.UUID('00010203-0405-0607-0809-0a0b0c0d0e0f')
 URL_USER = "http://localhost:5050/"
 URL_FILE = "http://localhost:5051/"
 
-def create_token(uid, secret):
-     token_hash = uuid.uuid5(secret, uid)
-     return f"{token_hash}"
-
 # Inicia la prueba de user.py
 print()
 print(" >>> EMPIEZA EL TEST DE user.py <<< ")
@@ -84,7 +76,7 @@ reponse = requests.post(url, headers=headers, data=json.dumps(data))
 if reponse.status_code == 200:
     print(" >>> [OK]: " + f"{reponse.json()}")
     UID = reponse.json()["uid"]
-    token = uuid.uuid5(SECRET_UUID, UID)
+    token = reponse.json()["token"]
 else:
     raise Exception(" >>> El test 4 debia devolver OK y devolvio [ERROR]: " + f"{reponse.json()} <<< ")
 
@@ -163,7 +155,7 @@ reponse = requests.post(url, headers=headers, data=json.dumps(data))
 if reponse.status_code == 200:
     print(" >>> [OK]: " + f"{reponse.json()}")
     UID = reponse.json()["uid"]
-    token = create_token(UID, SECRET_UUID)
+    token = reponse.json()["token"]
 else:
     raise Exception(" >>> El inicio de sesion de antonio debia ser OK y devolvio [ERROR]: " + f"{reponse.json()} <<< ")
 
@@ -193,7 +185,7 @@ data["uid"] = "89"
 data["content"] = "texto de prueba del fichero"
 reponse = requests.post(url, headers=headers, data=json.dumps(data))
 
-if reponse.status_code == 404:
+if reponse.status_code in (403, 404):
     print(" >>> [ERROR]: " + f"{reponse.json()} <<< ")
 else:
     raise Exception(" >>> El test 1 debia devolver ERROR y devolvio [OK]: " + f"{reponse.json()} <<< ")
@@ -334,7 +326,7 @@ data["uid"] = UID
 reponse = requests.get(url, headers=headers, data=json.dumps(data))
 
 if reponse.status_code == 200:
-    print(" >>> OK: " + f"{reponse.json()} <<< ")
+    print(" >>> OK: " + f"{reponse.content} <<< ")
 else:
     raise Exception(" >>> El test 8 debia devolver OK y devolvio [ERROR]: " + f"{reponse.json()} <<< ")
 
@@ -0,0 +1,76 @@
+import asyncio
+import importlib.util
+import itertools
+import os
+import sys
+
+import pytest
+
+"""
+conftest.py
+Utilidades de las pruebas de regresión: cada prueba importa user.py y file.py de nuevo
+sobre un árbol de datos vacío en su directorio temporal, como hace microbench.py.
+
+Uso:
+    python -m pytest -q test
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_PY = os.path.join(ROOT, "user_service", "user.py")
+FILE_PY = os.path.join(ROOT, "file_service", "file.py")
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)  # Paquete common
+
+loaded = itertools.count()
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def load_services(tmp_path, monkeypatch):
+    """
+    Devuelve una función que importa los dos servicios con las variables de entorno dadas.
+
+    Las dos aplicaciones usan rutas relativas (../user_service/users y ./libraries) y leen
+    la configuración al importarse, así que se cambia el directorio de trabajo y el entorno
+    antes de cada importación.
+    """
+    modules = []
+
+    def load(**env):
+        env.setdefault("TOKEN_KEYS", "test=clave-de-pruebas")  # Los servicios no arrancan sin claves
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        os.makedirs(tmp_path / "svc", exist_ok=True)
+        os.makedirs(tmp_path / "user_service" / "users", exist_ok=True)
+        monkeypatch.chdir(tmp_path / "svc")
+        n = next(loaded)
+        services = []
+        for name, path in (("user", USER_PY), ("file", FILE_PY)):
+            spec = importlib.util.spec_from_file_location(f"{name}_test_{n}", path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[spec.name] = module
+            spec.loader.exec_module(module)
+            services.append(module)
+        modules.extend(services)
+        return services
+
+    yield load
+
+    for module in modules:
+        for executor in ("io_executor", "job_executor", "store_executor", "hash_executor"):
+            if getattr(module, executor, None) is not None:
+                getattr(module, executor).shutdown(wait=True)
+        sys.modules.pop(module.__name__, None)
+
+async def create_account(user, name="ana", password="secreto"):
+    """
+    Da de alta un usuario en user_service.
+
+    Returns:
+        tuple: (uid, cabeceras con el token).
+    """
+    response = await user.app.test_client().post(f"/create_user/{name}", json={"password": password})
+    assert response.status_code == 200
+    data = await response.get_json()
+    return data["uid"], {"Authorization": f"Bearer {data['token']}"}
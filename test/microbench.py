@@ -0,0 +1,605 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+"""
+microbench.py
+Microbenchmarks de las funciones principales de user.py y file.py, ejecutadas en el mismo
+proceso (sin red) con el cliente de pruebas de Quart.
+
+Cada caso se mide con varios tamaños de datos sobre un árbol temporal propio (USER_DIR y
+LIBRARY_DIR se crean de cero para cada tamaño), de modo que el resultado es una curva de
+escalado. Con --baseline se compara cada mediana con la de una ejecución anterior y el
+programa termina con código 1 si alguna empeora más de --threshold.
+
+Uso:
+    python microbench.py --output base.json
+    python microbench.py --baseline base.json --threshold 0.25
+    python microbench.py --scale full --cases user_lookup,file_get_user
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_PY = os.path.join(ROOT, "user_service", "user.py")
+FILE_PY = os.path.join(ROOT, "file_service", "file.py")
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)  # Paquete common
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+# Tamaños de cada escala: 'quick' para el día a día, 'full' para los volúmenes reales
+SCALES = {
+    "quick": {
+        "users": [10, 100, 1000, 10000],
+        "file_sizes": [1 * KB, 64 * KB, 1 * MB, 16 * MB],
+        "file_counts": [10, 100, 1000],
+        "large_write": 32 * MB,
+    },
+    "full": {
+        "users": [10, 100, 1000, 10000, 100000, 1000000],
+        "file_sizes": [1 * KB, 64 * KB, 1 * MB, 16 * MB, 256 * MB, 1 * GB],
+        "file_counts": [10, 100, 1000, 10000, 100000],
+        "large_write": 512 * MB,
+    },
+}
+
+loaded = 0
+
+def load_services(workdir):
+    """
+    Importa user.py y file.py con un árbol de datos vacío en `workdir`.
+
+    Las dos aplicaciones usan rutas relativas (../user_service/users y ./libraries), así
+    que basta con cambiar el directorio de trabajo antes de importarlas.
+    """
+    global loaded
+    loaded += 1
+    os.makedirs(os.path.join(workdir, "svc"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "user_service", "users"), exist_ok=True)
+    os.chdir(os.path.join(workdir, "svc"))
+    os.environ.setdefault("TOKEN_KEYS", f"bench={uuid.uuid4().hex}")  # Los servicios no arrancan sin claves
+    modules = []
+    for name, path in (("user", USER_PY), ("file", FILE_PY)):
+        spec = importlib.util.spec_from_file_location(f"{name}_{loaded}", path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module  # Necesario para HASH_POOL=process
+        spec.loader.exec_module(module)
+        modules.append(module)
+    return modules
+
+def unload_services(user, file):
+    file.io_executor.shutdown(wait=True)
+    file.job_executor.shutdown(wait=True)
+    user.store_executor.shutdown(wait=True)
+    if user.hash_executor is not None:
+        user.hash_executor.shutdown(wait=True)
+    sys.modules.pop(user.__name__, None)
+    sys.modules.pop(file.__name__, None)
+
+def seed_users(user_dir, count, password_hash):
+    """
+    Escribe `count` usuarios directamente en disco (sin PBKDF2 por usuario).
+
+    Returns:
+        list: Los UID creados.
+    """
+    uids = []
+    for i in range(count):
+        uid = str(uuid.UUID(int=random.getrandbits(128), version=4))
+        with open(os.path.join(user_dir, f"u{i}.json"), "w") as f:
+            f.write(json.dumps({"name": f"u{i}", "password": password_hash, "uid": uid, "token": ""}))
+        uids.append(uid)
+    return uids
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "median_us": statistics.median(samples) * 1e6,
+        "p95_us": samples[min(int(0.95 * len(samples)), len(samples) - 1)] * 1e6,
+        "p99_us": samples[min(int(0.99 * len(samples)), len(samples) - 1)] * 1e6,
+        "min_us": samples[0] * 1e6,
+    }
+
+def measure(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+async def measure_async(func, iterations, setup=None):
+    # `setup` prepara fuera de la medida el argumento de cada llamada
+    samples = []
+    for i in range(iterations):
+        args = (setup(i),) if setup is not None else ()
+        start = time.perf_counter()
+        await func(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def iterations_for(size, budget=256 * MB, low=3, high=200):
+    # Menos repeticiones cuanto más grande es el archivo
+    return max(low, min(high, budget // max(size, 1)))
+
+# Casos: cada uno recibe los tamaños de la escala y devuelve {tamaño: resumen}
+
+def case_user_lookup(scale, workdir):
+    """
+    get_user_data (UID) y get_by_name (login) con distinto número de usuarios: deben ser O(1).
+    Se mide también la construcción del índice al arrancar.
+    """
+    results = {}
+    for count in scale["users"]:
+        tree = os.path.join(workdir, f"users{count}")
+        os.makedirs(os.path.join(tree, "user_service", "users"))
+        uids = seed_users(os.path.join(tree, "user_service", "users"), count, "0" * 64)
+        start = time.perf_counter()
+        user, file = load_services(tree)
+        startup = time.perf_counter() - start
+        rng = random.Random(count)
+        lookups = measure(lambda: user.get_user_data(rng.choice(uids)), 2000)
+        names = measure(lambda: user.user_store.get_by_name(f"u{rng.randrange(count)}"), 2000)
+        results[count] = {"get_user_data": summarize(lookups), "get_by_name": summarize(names),
+                          "startup_s": startup}
+        unload_services(user, file)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def case_file_get_user(scale, workdir):
+    """
+    get_user de file.py (caché de UID) con distinto número de usuarios, con y sin cambios
+    en el directorio compartido entre consultas.
+    """
+    results = {}
+    for count in scale["users"]:
+        tree = os.path.join(workdir, f"fusers{count}")
+        user_dir = os.path.join(tree, "user_service", "users")
+        os.makedirs(user_dir)
+        uids = seed_users(user_dir, count, "0" * 64)
+        user, file = load_services(tree)
+        rng = random.Random(count)
+
+        async def run():
+            warm = await measure_async(lambda: file.get_user(rng.choice(uids)), 2000)
+            changed = []
+            for i in range(20):
+                # Un alta en el volumen compartido obliga a sincronizar la caché
+                with open(os.path.join(user_dir, f"new{i}.json"), "w") as f:
+                    f.write(json.dumps({"name": f"new{i}", "password": "", "uid": f"new-{i}", "token": ""}))
+                changed += await measure_async(lambda: file.get_user(f"new-{i}"), 1)
+            return warm, changed
+
+        warm, changed = asyncio.run(run())
+        results[count] = {"warm": summarize(warm), "after_change": summarize(changed)}
+        unload_services(user, file)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def case_hash_and_tokens(scale, workdir):
+    """
+    hash_password (PBKDF2), el token heredado (create_token) y la emisión y validación de
+    tokens firmados en los dos servicios.
+    """
+    user, file = load_services(os.path.join(workdir, "tokens"))
+    uid = str(uuid.uuid4())
+    token = user.issue_token(uid)
+    results = {"-": {
+        "hash_password": summarize(measure(lambda: user.hash_password("contraseña"), 20)),
+        "create_token": summarize(measure(lambda: user.create_token(uid, user.SECRET_UUID), 5000)),
+        "issue_token": summarize(measure(lambda: user.issue_token(uid), 5000)),
+        "validate_token_user": summarize(measure(lambda: user.validate_token(uid, token), 5000)),
+        "validate_token_file": summarize(measure(lambda: file.validate_token(token, uid), 5000)),
+    }}
+    unload_services(user, file)
+    return results
+
+async def create_account(user):
+    client = user.app.test_client()
+    response = await client.post("/create_user/bench", json={"password": "x"})
+    data = await response.get_json()
+    return data["uid"], {"Authorization": f"Bearer {data['token']}"}
+
+def case_file_handlers(scale, workdir):
+    """
+    create_file (streaming), read_file (primera página), download_file (completo) y
+    download_file con un rango, para archivos de distintos tamaños.
+    """
+    results = {}
+    for size in scale["file_sizes"]:
+        tree = os.path.join(workdir, f"files{size}")
+        user, file = load_services(tree)
+        client = file.app.test_client()
+        rng = random.Random(size)
+        # Mitad texto repetitivo, mitad bytes aleatorios: ni todo comprimible ni nada
+        content = (b"linea de texto del libro\n" * (size // 50 + 1))[:size // 2] + rng.randbytes(size - size // 2)
+        iterations = iterations_for(size)
+
+        async def run():
+            uid, headers = await create_account(user)
+            upload_headers = {**headers, "Content-Type": "application/octet-stream"}
+
+            async def create(data):
+                response = await client.post(f"/create_file/bench.bin?uid={uid}", data=data, headers=upload_headers)
+                assert response.status_code == 200, await response.get_data()
+
+            def variant(i):
+                # Cada subida cambia los últimos bytes para que no se deduplique
+                return content[:-8] + i.to_bytes(8, "big")
+
+            async def read():
+                response = await client.post("/read_file/bench.bin", json={"uid": uid, "offset": 0, "length": 4096, "format": "raw"})
+                assert response.status_code == 200
+                await response.get_data()
+
+            async def download():
+                response = await client.get(f"/download_file/bench.bin?uid={uid}")
+                assert len(await response.get_data()) == size
+
+            async def download_range():
+                response = await client.get(f"/download_file/bench.bin?uid={uid}", headers={"Range": f"bytes={size // 2}-{size // 2 + 4095}"})
+                assert response.status_code == 206
+                await response.get_data()
+
+            return {
+                "create_file": summarize(await measure_async(create, iterations, variant)),
+                "read_file_page": summarize(await measure_async(read, max(iterations, 50))),
+                "download_file": summarize(await measure_async(download, iterations)),
+                "download_range": summarize(await measure_async(download_range, max(iterations, 50))),
+            }
+
+        results[size] = asyncio.run(run())
+        unload_services(user, file)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def case_list_files(scale, workdir):
+    """
+    list_files (primera página de 100) con bibliotecas de distinto tamaño.
+    """
+    results = {}
+    for count in scale["file_counts"]:
+        tree = os.path.join(workdir, f"list{count}")
+        user, file = load_services(tree)
+        client = file.app.test_client()
+
+        async def run():
+            uid, headers = await create_account(user)
+            library = os.path.join(file.LIBRARY_DIR, uid)
+            os.makedirs(library, exist_ok=True)
+            for i in range(count):
+                with open(os.path.join(library, f"f{i:07d}.txt"), "w") as f:
+                    f.write("x" * (i % 100))
+
+            async def listing(sort):
+                response = await client.post("/list_files", json={"uid": uid, "limit": 100, "sort": sort}, headers=headers)
+                assert response.status_code == 200
+
+            return {
+                "by_name": summarize(await measure_async(lambda: listing("name"), 50)),
+                "by_size": summarize(await measure_async(lambda: listing("size"), 50)),
+            }
+
+        results[count] = asyncio.run(run())
+        unload_services(user, file)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def case_search(scale, workdir):
+    """
+    /search (términos sueltos, varios términos y una frase) y la actualización del índice
+    al subir un archivo, con bibliotecas de distinto tamaño. Cada documento tiene 300
+    palabras de un vocabulario de 5000.
+    """
+    results = {}
+    vocabulary = [f"palabra{i}" for i in range(5000)]
+    for count in scale["file_counts"]:
+        tree = os.path.join(workdir, f"search{count}")
+        user, file = load_services(tree)
+        client = file.app.test_client()
+        rng = random.Random(count)
+
+        def document():
+            return " ".join(rng.choice(vocabulary) for _ in range(300))
+
+        async def run():
+            uid, headers = await create_account(user)
+            library = os.path.join(file.LIBRARY_DIR, uid)
+            os.makedirs(library, exist_ok=True)
+            for i in range(count):
+                with open(os.path.join(library, f"d{i:07d}.txt"), "w") as f:
+                    f.write(document())
+            # La primera búsqueda construye el índice
+            start = time.perf_counter()
+            await client.post("/search", json={"uid": uid, "q": "palabra0"}, headers=headers)
+            build = time.perf_counter() - start
+
+            async def search(query):
+                response = await client.post("/search", json={"uid": uid, "q": query}, headers=headers)
+                assert response.status_code == 200
+
+            async def create(i):
+                response = await client.post(f"/create_file/n{i}.txt", json={"uid": uid, "content": document()}, headers=headers)
+                assert response.status_code == 200
+
+            return {
+                "build_index": summarize([build]),
+                "term": summarize(await measure_async(lambda: search("palabra1"), 50)),
+                "three_terms": summarize(await measure_async(lambda: search("palabra1 palabra2 palabra3"), 50)),
+                "phrase": summarize(await measure_async(lambda: search('"palabra1 palabra2"'), 50)),
+                "create_file_indexed": summarize(await measure_async(create, 50, lambda i: i)),
+            }
+
+        results[count] = asyncio.run(run())
+        unload_services(user, file)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def case_read_during_large_write(scale, workdir):
+    """
+    Latencia de lecturas pequeñas mientras se sube un archivo grande: con la E/S en el pool
+    la p99 no debe dispararse respecto a las lecturas sin escritura en curso.
+    """
+    tree = os.path.join(workdir, "mixed")
+    user, file = load_services(tree)
+    client = file.app.test_client()
+    large = os.urandom(scale["large_write"])
+
+    async def run():
+        uid, headers = await create_account(user)
+        await client.post("/create_file/small.txt", json={"uid": uid, "content": "texto corto\n" * 100}, headers=headers)
+
+        async def read():
+            response = await client.post("/read_file/small.txt", json={"uid": uid, "offset": 0, "length": 512})
+            assert response.status_code == 200
+
+        idle = await measure_async(read, 300)
+
+        async def write():
+            await client.post(f"/create_file/large.bin?uid={uid}", data=large,
+                              headers={**headers, "Content-Type": "application/octet-stream"})
+
+        # Se repite la escritura hasta tener tantas lecturas como sin ella: con pocas la p99 no dice nada
+        busy = []
+        while len(busy) < len(idle):
+            writer = asyncio.create_task(write())
+            while not writer.done():
+                busy += await measure_async(read, 10)
+            await writer
+        return {"idle": summarize(idle), "during_write": summarize(busy)}
+
+    result = asyncio.run(run())
+    unload_services(user, file)
+    shutil.rmtree(tree, ignore_errors=True)
+    return {scale["large_write"]: result}
+
+def case_concurrent_writes(scale, workdir):
+    """
+    Escrituras concurrentes de 64 KB: todas sobre el mismo archivo (se ordenan con su lock)
+    frente a una por archivo de la misma biblioteca (no deben esperarse entre sí). Cada
+    muestra es el tiempo de una ráfaga de `writers` escrituras lanzadas a la vez.
+    """
+    tree = os.path.join(workdir, "contention")
+    user, file = load_services(tree)
+    client = file.app.test_client()
+    content = os.urandom(64 * KB)
+
+    async def run():
+        uid, headers = await create_account(user)
+        upload_headers = {**headers, "Content-Type": "application/octet-stream"}
+
+        async def create(name, i):
+            # Cada escritura cambia los últimos bytes para que no se deduplique
+            data = content[:-8] + i.to_bytes(8, "big")
+            response = await client.post(f"/create_file/{name}?uid={uid}", data=data, headers=upload_headers)
+            assert response.status_code == 200, await response.get_data()
+
+        results = {}
+        for writers in (1, 8, 32):
+            async def same_key():
+                await asyncio.gather(*[create("same.bin", random.getrandbits(48)) for _ in range(writers)])
+
+            async def distinct_keys():
+                await asyncio.gather(*[create(f"k{n}.bin", random.getrandbits(48)) for n in range(writers)])
+
+            results[writers] = {
+                "same_key": summarize(await measure_async(same_key, 20)),
+                "distinct_keys": summarize(await measure_async(distinct_keys, 20)),
+            }
+        return results
+
+    results = asyncio.run(run())
+    unload_services(user, file)
+    shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def case_durable_writes(scale, workdir):
+    """
+    Ráfagas de escrituras concurrentes de 4 KB (archivos distintos) y de altas de usuario
+    en el backend JSON con cada modo de WRITE_DURABILITY: sin fsync, un fsync por escritura
+    y fsync agrupados. Cada muestra es el tiempo de una ráfaga de `writers` escrituras.
+    """
+    results = {}
+    content = os.urandom(4 * KB)
+    for mode in ("none", "fsync", "group"):
+        tree = os.path.join(workdir, f"durable-{mode}")
+        os.environ["WRITE_DURABILITY"] = mode
+        try:
+            user, file = load_services(tree)
+        finally:
+            del os.environ["WRITE_DURABILITY"]
+        client = file.app.test_client()
+
+        async def run():
+            uid, headers = await create_account(user)
+            upload_headers = {**headers, "Content-Type": "application/octet-stream"}
+
+            async def create(name):
+                data = content[:-8] + random.getrandbits(64).to_bytes(8, "big")
+                response = await client.post(f"/create_file/{name}?uid={uid}", data=data, headers=upload_headers)
+                assert response.status_code == 200, await response.get_data()
+
+            async def save(n):
+                # Directamente contra el backend: el hash PBKDF2 de create_user taparía el fsync
+                name = f"u{uuid.uuid4().hex}"
+                await user.run_store("save", user.user_store.save,
+                                     {"name": name, "password": "x", "uid": name, "token": ""}, user.NEW_RECORD)
+
+            mode_results = {}
+            for writers in (1, 32):
+                async def files():
+                    await asyncio.gather(*[create(f"k{n}.bin") for n in range(writers)])
+
+                async def users():
+                    await asyncio.gather(*[save(n) for n in range(writers)])
+
+                mode_results[f"{mode}/{writers}"] = {
+                    "create_file": summarize(await measure_async(files, 20)),
+                    "save_user": summarize(await measure_async(users, 20)),
+                }
+            return mode_results
+
+        results.update(asyncio.run(run()))
+        unload_services(user, file)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def case_library_cleanup(scale, workdir):
+    """
+    Baja de un usuario con bibliotecas de distinto tamaño: delete_user solo encola el
+    borrado, y el trabajo delete_library (ejecutado aquí directamente) borra los archivos
+    y libera sus blobs. Cada tamaño se mide con 3 usuarios.
+    """
+    results = {}
+    for count in scale["file_counts"]:
+        tree = os.path.join(workdir, f"cleanup{count}")
+        user, file = load_services(tree)
+        client = user.app.test_client()
+
+        async def run():
+            deletes, jobs = [], []
+            for _ in range(3):
+                uid, headers = await create_account(user)
+                for i in range(count):
+                    file.store_content(uid, f"f{i:07d}.txt", f"{uid} {i}".encode())
+                start = time.perf_counter()
+                response = await client.post("/delete_user", json={"uid": uid}, headers=headers)
+                deletes.append(time.perf_counter() - start)
+                assert (await response.get_json())["cleanup_job"] is not None
+
+                start = time.perf_counter()
+                job = file.job_queue.claim("bench")
+                assert file.execute_job(job, "bench") == "done"
+                jobs.append(time.perf_counter() - start)
+            return {"delete_user": summarize(deletes), "delete_library_job": summarize(jobs)}
+
+        results[count] = asyncio.run(run())
+        unload_services(user, file)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+CASES = {
+    "user_lookup": case_user_lookup,
+    "file_get_user": case_file_get_user,
+    "hash_and_tokens": case_hash_and_tokens,
+    "file_handlers": case_file_handlers,
+    "list_files": case_list_files,
+    "search": case_search,
+    "read_during_large_write": case_read_during_large_write,
+    "concurrent_writes": case_concurrent_writes,
+    "durable_writes": case_durable_writes,
+    "library_cleanup": case_library_cleanup,
+}
+
+def flatten(results):
+    """
+    Convierte los resultados en {"caso/tamaño/medida": mediana en µs} para compararlos.
+    """
+    flat = {}
+    for case, sizes in results.items():
+        for size, metrics in sizes.items():
+            for metric, summary in metrics.items():
+                if isinstance(summary, dict):
+                    flat[f"{case}/{size}/{metric}"] = summary["median_us"]
+    return flat
+
+def print_results(results):
+    for case, sizes in results.items():
+        print(f"\n{case}")
+        for size, metrics in sizes.items():
+            cells = [f"{metric}={summary['median_us']:.1f}µs (p95 {summary['p95_us']:.1f}, p99 {summary['p99_us']:.1f})"
+                     for metric, summary in metrics.items() if isinstance(summary, dict)]
+            cells += [f"{metric}={value:.3f}s" for metric, value in metrics.items() if not isinstance(value, dict)]
+            print(f"  {size:>12}  " + "  ".join(cells))
+
+def compare(results, baseline, threshold):
+    """
+    Compara las medianas con las de la línea base.
+
+    Returns:
+        list: Las medidas que empeoran más de `threshold` (fracción), con su variación.
+    """
+    current = flatten(results)
+    previous = flatten(baseline["results"])
+    regressions = []
+    for key, value in sorted(current.items()):
+        if key in previous and previous[key] > 0:
+            change = value / previous[key] - 1
+            if change > threshold:
+                regressions.append((key, previous[key], value, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de user.py y file.py")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="quick")
+    parser.add_argument("--cases", default=",".join(CASES), help="Casos a ejecutar, separados por comas")
+    parser.add_argument("--output", help="Fichero JSON con los resultados")
+    parser.add_argument("--baseline", help="Resultados JSON anteriores con los que comparar")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Empeoramiento máximo admitido (0.25 = 25%%)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    scale = SCALES[args.scale]
+    workdir = tempfile.mkdtemp(prefix="microbench-")
+    cwd = os.getcwd()
+    results = {}
+    try:
+        for name in args.cases.split(","):
+            started = time.perf_counter()
+            results[name] = {str(size): value for size, value in CASES[name](scale, workdir).items()}
+            print(f"{name}: {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    report = {"scale": args.scale, "python": sys.version.split()[0],
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for key, before, after, change in regressions:
+            print(f"REGRESIÓN {key}: {before:.1f}µs -> {after:.1f}µs ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"Sin regresiones por encima del {args.threshold:.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,871 @@
+import asyncio
+import builtins
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from conftest import create_account, run
+
+"""
+test_file_service.py
+Pruebas de regresión de file_service (biblioteca de archivos).
+"""
+
+BAD_NAMES = ["../evil.txt", "../../../escaped.txt", "a/b.txt", "..", ".", ".manifests", ".hidden"]
+
+@pytest.mark.parametrize("filename", BAD_NAMES)
+def test_upload_session_rejects_path_traversal(load_services, filename):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        alice, _ = await create_account(user, "alice")
+        bob, headers = await create_account(user, "bob")
+        response = await client.post("/uploads", json={"uid": bob, "filename": filename}, headers=headers)
+        assert response.status_code == 400
+        response = await client.post("/uploads", json={"uid": bob, "filename": f"../{alice}/evil.txt"}, headers=headers)
+        assert response.status_code == 400
+        return alice
+
+    alice = run(scenario())
+    assert not os.path.exists(os.path.join(file.LIBRARY_DIR, alice))
+    assert not os.path.exists(os.path.join(os.path.dirname(file.LIBRARY_DIR), "escaped.txt"))
+
+def test_commit_rejects_session_with_traversal_name(load_services):
+    # Una sesión guardada antes de validar el nombre no debe escribir fuera de la biblioteca
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        alice, _ = await create_account(user, "alice")
+        bob, headers = await create_account(user, "bob")
+        response = await client.post("/uploads", json={"uid": bob, "filename": "ok.txt"}, headers=headers)
+        upload_id = (await response.get_json())["upload_id"]
+        session = file.load_session(upload_id)
+        session["filename"] = f"../{alice}/evil.txt"
+        file.save_session(upload_id, session)
+        await client.put(f"/uploads/{upload_id}/0", data=b"contenido de bob", headers=headers)
+        response = await client.post(f"/uploads/{upload_id}/commit", headers=headers,
+                                     json={"parts": 1, "sha256": hashlib.sha256(b"contenido de bob").hexdigest()})
+        assert response.status_code == 400
+        return alice
+
+    alice = run(scenario())
+    assert not os.path.exists(os.path.join(file.LIBRARY_DIR, alice, "evil.txt"))
+
+def test_unknown_uids_do_not_rescan_user_dir(load_services, monkeypatch):
+    user, file = load_services()
+    calls = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda *args: calls.append("listdir") or listdir(*args))
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        assert file.user_cache.contains(uid)
+        for i in range(50):
+            assert not file.user_cache.contains(f"nadie{i}")
+        response = await user.app.test_client().post("/delete_user", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+        assert not file.user_cache.contains(uid)
+
+    # Las altas y bajas llegan por el registro de cambios; los fallos no recorren USER_DIR
+    run(scenario())
+    assert calls == []
+    assert file.user_cache.stats()["refreshes"] == 1
+
+def test_store_blob_rejects_bad_names(load_services):
+    _, file = load_services()
+    for filename in BAD_NAMES:
+        with pytest.raises(ValueError):
+            file.store_content("uid", filename, b"x")
+    with pytest.raises(ValueError):
+        file.store_content("../other", "ok.txt", b"x")
+    assert os.listdir(file.UPLOAD_TMP_DIR) == []
+
+def test_create_file_rejects_hidden_name(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post("/create_file/..", json={"uid": uid, "content": "x"}, headers=headers)
+        assert response.status_code == 400
+        response = await client.post("/create_file/.manifests", json={"uid": uid, "content": "x"}, headers=headers)
+        assert response.status_code == 400
+
+    run(scenario())
+
+@pytest.mark.parametrize("encoding, status", [("hex", 400), ("base64", 400), ("rot13", 400), ("nope", 400),
+                                              ("latin-1", 200), ("utf-16", 200)])
+def test_read_page_accepts_only_text_encodings(load_services, encoding, status):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        content = "línea uno\n".encode(encoding if status == 200 else "utf-8")
+        response = await client.post(f"/create_file/notas.txt?uid={uid}", data=content,
+                                     headers={**headers, "Content-Type": "application/octet-stream"})
+        assert response.status_code == 200
+        response = await client.post("/read_file/notas.txt", json={"uid": uid, "offset": 0, "encoding": encoding},
+                                     headers=headers)
+        assert response.status_code == status
+        body = await response.get_json()
+        if status == 200:
+            assert body["content"] == "línea uno\n"
+        else:
+            assert "Error" in body
+
+    run(scenario())
+
+def test_read_page_does_not_load_whole_file(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+    content = "".join(f"línea {n}\n" for n in range(2000))
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post("/create_file/largo.txt", json={"uid": uid, "content": content}, headers=headers)
+        assert response.status_code == 200
+        response = await client.post("/read_file/largo.txt", json={"uid": uid, "start_line": 1000, "line_count": 2})
+        assert (await response.get_json())["content"] == "línea 1000\nlínea 1001\n"
+        response = await client.post("/read_file/largo.txt", json={"uid": uid, "offset": 0, "length": 9})
+        assert (await response.get_json())["content"] == "línea 0\n"
+        # Aunque el archivo cabe en la caché, las páginas no lo cargan entero
+        assert file.content_cache.stats()["resident_bytes"] == 0
+        response = await client.post("/read_file/largo.txt", json={"uid": uid})
+        assert response.status_code == 200
+        assert file.content_cache.stats()["resident_bytes"] == len(content.encode())
+
+    run(scenario())
+
+def test_range_of_gzip_file_uses_identity_etag(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+    content = b"texto que se comprime bien\n" * 200
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post(f"/create_file/largo.txt?uid={uid}", data=content,
+                                     headers={**headers, "Content-Type": "application/octet-stream"})
+        assert response.status_code == 200
+        assert file.stored_file(uid, "largo.txt")["codec"] == "gzip"
+        identity = f'"{hashlib.sha256(content).hexdigest()}"'
+
+        response = await client.get(f"/download_file/largo.txt?uid={uid}", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["ETag"] == identity[:-1] + '-gz"'
+
+        for ranges in ("bytes=0-99", "bytes=0-9,20-29"):
+            response = await client.get(f"/download_file/largo.txt?uid={uid}",
+                                        headers={"Accept-Encoding": "gzip", "Range": ranges})
+            assert response.status_code == 206
+            assert "Content-Encoding" not in response.headers
+            assert response.headers["ETag"] == identity
+        response = await client.get(f"/download_file/largo.txt?uid={uid}",
+                                    headers={"Accept-Encoding": "gzip", "Range": "bytes=0-99"})
+        assert await response.get_data() == content[:100]
+
+    run(scenario())
+
+def test_download_serves_single_and_multiple_ranges(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+    content = bytes(i % 251 for i in range(10000))  # Sin ningún \r\n que se confunda con los separadores
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post(f"/create_file/datos.bin?uid={uid}", data=content,
+                                     headers={**headers, "Content-Type": "application/octet-stream"})
+        assert response.status_code == 200
+        url = f"/download_file/datos.bin?uid={uid}"
+
+        response = await client.get(url, headers={"Range": "bytes=100-199"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 100-199/10000"
+        assert await response.get_data() == content[100:200]
+
+        response = await client.get(url, headers={"Range": "bytes=0-9,5000-5099,-5"})
+        assert response.status_code == 206
+        assert response.mimetype == "multipart/byteranges"
+        body = await response.get_data()
+        assert int(response.headers["Content-Length"]) == len(body)
+        boundary = response.mimetype_params["boundary"].encode()
+        assert body.endswith(b"\r\n--" + boundary + b"--\r\n")
+        parts = body.split(b"--" + boundary)[1:-1]
+        expected = [("0-9", content[:10]), ("5000-5099", content[5000:5100]), ("9995-9999", content[-5:])]
+        assert len(parts) == len(expected)
+        for part, (span, data) in zip(parts, expected):
+            head, payload = part.split(b"\r\n\r\n", 1)
+            assert f"Content-Range: bytes {span}/10000".encode() in head
+            assert payload.removesuffix(b"\r\n") == data
+
+        response = await client.get(url, headers={"Range": "bytes=20000-"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */10000"
+
+        # Con un If-Range que ya no coincide se envía el archivo completo
+        response = await client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"otra-version"'})
+        assert response.status_code == 200
+        assert await response.get_data() == content
+
+    run(scenario())
+
+def test_gzip_blobs_are_read_from_the_block_with_the_offset(load_services):
+    user, file = load_services(GZIP_BLOCK_SIZE=4096)
+    client = file.app.test_client()
+    content = "".join(f"registro {n:06d}\n" for n in range(5000)).encode()
+    digest = hashlib.sha256(content).hexdigest()
+    offset = 50000
+
+    async def read(uid):
+        response = await client.get(f"/download_file/largo.txt?uid={uid}", headers={"Range": f"bytes={offset}-{offset + 99}"})
+        assert response.status_code == 206
+        assert await response.get_data() == content[offset:offset + 100]
+        response = await client.post("/read_file/largo.txt", json={"uid": uid, "offset": offset, "length": 100})
+        assert (await response.get_json())["content"] == content[offset:offset + 100].decode()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        other, other_headers = await create_account(user, "otro")
+        for owner, owner_headers in ((uid, headers), (other, other_headers)):
+            response = await client.post(f"/create_file/largo.txt?uid={owner}", data=content,
+                                         headers={**owner_headers, "Content-Type": "application/octet-stream"})
+            assert response.status_code == 200
+        path = file.stored_file(uid, "largo.txt")["path"]
+        with open(path, 'rb') as f:
+            assert file.gzip.decompress(f.read()) == content
+        compressed_start, position = file.gzip_member_at(path, digest, offset)
+        assert compressed_start > 0 and position == offset // 4096 * 4096
+        await read(uid)
+
+        stats = (await (await client.get("/storage_stats")).get_json())
+        assert stats["blobs"] == 1
+        assert stats["unique_bytes"] == len(content)
+        assert stats["logical_bytes"] == 2 * len(content)
+        assert stats["dedup_ratio"] == 2
+        assert stats["physical_bytes"] < len(content)
+
+        # Sin índice (blobs anteriores) se descomprime desde el principio
+        os.remove(file.gzip_index_path(digest))
+        assert file.gzip_member_at(path, digest, offset) == (0, 0)
+        await read(uid)
+        file.write_gzip_index(digest, file.array('Q', [4096, len(content)] + [1] * 20))  # No corresponde al blob
+        assert file.gzip_member_at(path, digest, offset) == (0, 0)
+        await read(uid)
+
+        for owner, owner_headers in ((uid, headers), (other, other_headers)):
+            response = await client.post("/delete_file/largo.txt", json={"uid": owner}, headers=owner_headers)
+            assert response.status_code == 200
+        assert not os.path.exists(file.blob_path(digest, "gzip"))
+        assert not os.path.exists(file.gzip_index_path(digest))
+
+    run(scenario())
+
+def test_if_match_rejects_stale_writes(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def write(uid, headers, content, **conditions):
+        return await client.post("/create_file/notas.txt", json={"uid": uid, "content": content},
+                                 headers={**headers, **conditions})
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await write(uid, headers, "uno", **{"If-None-Match": "*"})
+        assert response.status_code == 200
+        first = (await response.get_json())["version"]
+        response = await write(uid, headers, "otro", **{"If-None-Match": "*"})
+        assert response.status_code == 412
+
+        response = await write(uid, headers, "dos", **{"If-Match": f'"{first}"'})
+        assert response.status_code == 200
+        second = (await response.get_json())["version"]
+        assert second != first
+        # Dos clientes que leyeron la misma versión: el segundo no pisa al primero
+        response = await write(uid, headers, "tres", **{"If-Match": f'"{first}"'})
+        assert response.status_code == 412
+        assert (await response.get_json())["version"] == second
+        assert file.stored_file(uid, "notas.txt")["version"] == second
+        response = await write(uid, headers, "tres", **{"If-Match": "v1"})
+        assert response.status_code == 400
+
+        response = await client.post("/delete_file/notas.txt", json={"uid": uid},
+                                     headers={**headers, "If-Match": f'"{first}"'})
+        assert response.status_code == 412
+        assert file.stored_file(uid, "notas.txt") is not None
+        response = await client.post("/delete_file/notas.txt", json={"uid": uid},
+                                     headers={**headers, "If-Match": f'"{second}"'})
+        assert response.status_code == 200
+        response = await write(uid, headers, "cuatro", **{"If-Match": "*"})
+        assert response.status_code == 412
+
+    run(scenario())
+
+def test_quota_limits_bytes_and_files(load_services):
+    user, file = load_services(QUOTA_BYTES=100, QUOTA_FILES=2)
+    client = file.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+
+        async def write(name, size, streaming=False):
+            if streaming:
+                return await client.post(f"/create_file/{name}?uid={uid}", data=b"x" * size,
+                                         headers={**headers, "Content-Type": "application/octet-stream"})
+            return await client.post(f"/create_file/{name}", json={"uid": uid, "content": "x" * size}, headers=headers)
+
+        async def usage():
+            response = await client.get(f"/usage?uid={uid}", headers=headers)
+            return (await response.get_json())["usage"]
+
+        assert (await write("a.txt", 60)).status_code == 200
+        response = await write("b.txt", 60)
+        assert response.status_code == 413
+        assert (await response.get_json())["usage"] == {"bytes": 60, "files": 1}
+        assert (await write("b.txt", 60, streaming=True)).status_code == 413
+        assert file.stored_file(uid, "b.txt") is None
+
+        # Sobrescribir solo cuenta la diferencia
+        assert (await write("a.txt", 90)).status_code == 200
+        assert (await write("b.txt", 10, streaming=True)).status_code == 200
+        assert await usage() == {"bytes": 100, "files": 2}
+        response = await write("c.txt", 1)
+        assert response.status_code == 413
+
+        response = await client.post("/delete_file/a.txt", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+        assert await usage() == {"bytes": 10, "files": 1}
+        assert (await write("c.txt", 1)).status_code == 200
+        return uid
+
+    uid = run(scenario())
+    assert file.compute_usage(uid) == {"bytes": 11, "files": 2}
+    assert os.listdir(file.UPLOAD_TMP_DIR) == []
+
+def test_only_streaming_routes_accept_large_bodies(load_services):
+    user, file = load_services(MAX_REQUEST_SIZE=1024, MAX_UPLOAD_SIZE=8192)
+    client = file.app.test_client()
+    content = os.urandom(4096)
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post("/create_file/notas.txt", json={"uid": uid, "content": "x" * 2048}, headers=headers)
+        assert response.status_code == 413
+        assert "Error" in await response.get_json()
+
+        response = await client.post(f"/create_file/datos.bin?uid={uid}", data=content,
+                                     headers={**headers, "Content-Type": "application/octet-stream"})
+        assert response.status_code == 200
+        response = await client.post(f"/create_file/grande.bin?uid={uid}", data=content * 3,
+                                     headers={**headers, "Content-Type": "application/octet-stream"})
+        assert response.status_code == 413
+
+        response = await client.post("/uploads", json={"uid": uid, "filename": "partes.bin"}, headers=headers)
+        upload_id = (await response.get_json())["upload_id"]
+        response = await client.put(f"/uploads/{upload_id}/0", data=content, headers=headers)
+        assert response.status_code == 200
+        response = await client.put(f"/uploads/{upload_id}/1", data=content * 3, headers=headers)
+        assert response.status_code == 413
+
+        response = await client.get(f"/download_file/datos.bin?uid={uid}")
+        assert await response.get_data() == content
+
+    run(scenario())
+
+def test_manifest_writes_of_different_users_do_not_wait(load_services, monkeypatch):
+    user, file = load_services()
+    busy, idle = "a" * 32, "b" * 32
+    file.store_content(busy, "a.txt", b"uno")
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with file.manifests.write(busy):
+            held.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    try:
+        assert held.wait(10)
+        # El recorrido de una biblioteca sin uso guardado nunca se hace con la transacción abierta
+        compute_usage = file.compute_usage
+
+        def checked_compute_usage(uid):
+            assert uid not in file.manifests._write_locks
+            return compute_usage(uid)
+
+        monkeypatch.setattr(file, "compute_usage", checked_compute_usage)
+        assert file.store_content(idle, "b.txt", b"dos") == 1
+        assert file.manifests.usage(idle) == {"bytes": 3, "files": 1}
+        assert not release.is_set()
+    finally:
+        release.set()
+        holder.join()
+    assert sorted(os.listdir(file.MANIFEST_DIR)) == sorted(f"{uid}.db{suffix}" for uid in (busy, idle)
+                                                           for suffix in ("", "-shm", "-wal"))
+
+    # Otro proceso borra la biblioteca mientras este tiene abierta su base de datos: la
+    # siguiente escritura lo detecta y abre una nueva en lugar de escribir en la borrada
+    for suffix in ("", "-wal", "-shm"):
+        os.remove(file.manifests.db_path(busy) + suffix)
+    assert file.store_content(busy, "c.txt", b"tres") == 1
+    assert os.path.exists(file.manifests.db_path(busy))
+    assert file.manifests.get(busy, "c.txt")["size"] == 4
+
+def test_upload_session_resumes_after_restart(load_services):
+    user, file = load_services()
+    parts = [os.urandom(3000), os.urandom(3000), os.urandom(1234)]
+    content = b"".join(parts)
+
+    async def start():
+        uid, headers = await create_account(user)
+        client = file.app.test_client()
+        response = await client.post("/uploads", json={"uid": uid, "filename": "datos.bin"}, headers=headers)
+        assert response.status_code == 200
+        upload_id = (await response.get_json())["upload_id"]
+        for index in (0, 2):
+            response = await client.put(f"/uploads/{upload_id}/{index}", data=parts[index], headers=headers)
+            assert response.status_code == 200
+        # Una parte corrupta se puede volver a enviar
+        response = await client.put(f"/uploads/{upload_id}/2", data=b"basura", headers=headers)
+        assert response.status_code == 200
+        response = await client.put(f"/uploads/{upload_id}/2", data=parts[2], headers=headers)
+        assert response.status_code == 200
+        response = await client.post(f"/uploads/{upload_id}/commit", headers=headers,
+                                     json={"parts": 3, "sha256": hashlib.sha256(content).hexdigest()})
+        assert response.status_code == 409
+        assert (await response.get_json())["missing"] == [1]
+        return uid, headers, upload_id
+
+    uid, headers, upload_id = run(start())
+    # Otro proceso (o el mismo tras reiniciar) retoma la sesión desde el disco
+    _, file = load_services()
+
+    async def resume():
+        client = file.app.test_client()
+        response = await client.get(f"/uploads/{upload_id}", headers=headers)
+        assert response.status_code == 200
+        assert (await response.get_json())["parts"] == {"0": len(parts[0]), "2": len(parts[2])}
+        response = await client.put(f"/uploads/{upload_id}/1", data=parts[1], headers=headers)
+        assert response.status_code == 200
+        response = await client.post(f"/uploads/{upload_id}/commit", headers=headers,
+                                     json={"parts": 3, "sha256": hashlib.sha256(content).hexdigest()})
+        assert response.status_code == 200
+        assert (await response.get_json())["size"] == len(content)
+        response = await client.get(f"/download_file/datos.bin?uid={uid}")
+        assert await response.get_data() == content
+        response = await client.get(f"/uploads/{upload_id}", headers=headers)
+        assert response.status_code == 404
+
+    run(resume())
+
+def test_concurrent_commits_of_one_session(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+    content = os.urandom(5000)
+    checksum = hashlib.sha256(content).hexdigest()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post("/uploads", json={"uid": uid, "filename": "datos.bin"}, headers=headers)
+        upload_id = (await response.get_json())["upload_id"]
+        response = await client.put(f"/uploads/{upload_id}/0", data=content, headers=headers)
+        assert response.status_code == 200
+
+        # Otro proceso está completando la sesión
+        os.mkdir(file.session_path(upload_id, "committing"))
+        response = await client.post(f"/uploads/{upload_id}/commit", headers=headers, json={"parts": 1, "sha256": checksum})
+        assert response.status_code == 409
+        os.rmdir(file.session_path(upload_id, "committing"))
+
+        responses = await asyncio.gather(*(client.post(f"/uploads/{upload_id}/commit", headers=headers,
+                                                       json={"parts": 1, "sha256": checksum}) for _ in range(2)))
+        assert sorted(response.status_code for response in responses) == [200, 404]
+        response = await client.get(f"/download_file/datos.bin?uid={uid}")
+        assert await response.get_data() == content
+
+    run(scenario())
+
+def test_handlers_keep_disk_io_off_the_event_loop(load_services, monkeypatch):
+    # Una operación de disco en el hilo del bucle de eventos detiene todas las peticiones en curso
+    user, file = load_services()
+    client = file.app.test_client()
+    loop_thread = threading.current_thread()
+    blocking = []
+    recording = False
+
+    def watch(name, func):
+        def call(*args, **kwargs):
+            if recording and threading.current_thread() is loop_thread:
+                blocking.append(name)
+            return func(*args, **kwargs)
+        return call
+
+    for name in ("open", "stat", "listdir", "scandir", "replace", "rename", "remove", "unlink", "link", "makedirs"):
+        monkeypatch.setattr(os, name, watch(f"os.{name}", getattr(os, name)))
+    monkeypatch.setattr(builtins, "open", watch("open", builtins.open))
+
+    async def scenario():
+        nonlocal recording
+        uid, headers = await create_account(user)
+        stream = {**headers, "Content-Type": "application/octet-stream"}
+        recording = True
+        await client.post("/create_file/a.txt", json={"uid": uid, "content": "hola mundo"}, headers=headers)
+        await client.post(f"/create_file/b.bin?uid={uid}", data=os.urandom(256 * 1024), headers=stream)
+        await client.post("/read_file/a.txt", json={"uid": uid, "offset": 0, "length": 4})
+        await client.get(f"/download_file/b.bin?uid={uid}", headers={"Range": "bytes=0-99"})
+        await client.post("/list_files", json={"uid": uid}, headers=headers)
+        await client.post("/search", json={"uid": uid, "q": "hola"}, headers=headers)
+        await client.get(f"/usage?uid={uid}", headers=headers)
+        response = await client.post("/uploads", json={"uid": uid, "filename": "c.bin"}, headers=headers)
+        upload_id = (await response.get_json())["upload_id"]
+        await client.put(f"/uploads/{upload_id}/0", data=b"abc", headers=headers)
+        await client.get(f"/uploads/{upload_id}", headers=headers)
+        response = await client.post(f"/uploads/{upload_id}/commit", headers=headers,
+                                     json={"parts": 1, "sha256": hashlib.sha256(b"abc").hexdigest()})
+        assert response.status_code == 200
+        response = await client.post("/delete_file/a.txt", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+        recording = False
+
+    run(scenario())
+    assert blocking == []
+
+def parse_metrics(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            samples[series] = float(value)
+    return samples
+
+def test_metrics_expose_requests_and_disk_timings(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        for _ in range(2):
+            response = await client.post("/create_file/notas.txt", json={"uid": uid, "content": "hola"}, headers=headers)
+            assert response.status_code == 200
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        return await response.get_data(as_text=True)
+
+    text = run(scenario())
+    assert "# TYPE http_requests_total counter" in text
+    assert "# TYPE file_io_duration_seconds histogram" in text
+    samples = parse_metrics(text)
+    labels = 'route="/create_file/<filename>",method="POST",status="200"'
+    assert samples[f"http_requests_total{{{labels}}}"] == 2
+    assert samples[f"http_request_duration_seconds_count{{{labels}}}"] == 2
+    assert samples['http_requests_in_flight{route="/create_file/<filename>"}'] == 0
+
+    # Histogramas acumulados: cada bucket incluye los anteriores y +Inf coincide con _count
+    io_ops = {series[series.index('op="') + 4:series.index('"', series.index('op="') + 4)]
+              for series in samples if series.startswith("file_io_duration_seconds_count")}
+    assert io_ops
+    for op in io_ops:
+        buckets = [value for series, value in samples.items()
+                   if series.startswith(f'file_io_duration_seconds_bucket{{op="{op}",')]
+        assert buckets == sorted(buckets)
+        assert buckets[-1] == samples[f'file_io_duration_seconds_count{{op="{op}"}}'] > 0
+        assert samples[f'file_io_duration_seconds_sum{{op="{op}"}}'] >= 0
+
+def test_metrics_directory_aggregates_workers(load_services, tmp_path):
+    from common.metrics import LATENCY_BUCKETS
+
+    user, file = load_services(METRICS_DIR=tmp_path / "metrics")
+    client = file.app.test_client()
+    labels = [["route", "/list_files"], ["method", "POST"], ["status", "200"]]
+    histogram = [0] * (len(LATENCY_BUCKETS) + 3)
+    histogram[0], histogram[-2], histogram[-1] = 3, 0.003, 3
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    # Otro worker vivo y uno ya terminado
+    for pid in (os.getppid(), dead.pid):
+        with open(tmp_path / "metrics" / f"{pid}.json", "w") as f:
+            json.dump({"values": [["http_requests_total", labels, 3],
+                                  ["http_requests_in_flight", [["route", "/list_files"]], 1]],
+                       "histograms": [["http_request_duration_seconds", labels, histogram]]}, f)
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post("/list_files", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+        return await (await client.get("/metrics")).get_data(as_text=True)
+
+    samples = parse_metrics(run(scenario()))
+    series = 'route="/list_files",method="POST",status="200"'
+    # Los contadores e histogramas se suman, también los de workers terminados
+    assert samples[f"http_requests_total{{{series}}}"] == 7
+    assert samples[f"http_request_duration_seconds_count{{{series}}}"] == 7
+    assert samples[f'http_request_duration_seconds_bucket{{{series},le="0.001"}}'] >= 6
+    # Los gauges se exponen por worker y solo los de procesos vivos
+    assert samples[f'http_requests_in_flight{{route="/list_files",worker="{os.getppid()}"}}'] == 1
+    assert not [name for name in samples if f'worker="{dead.pid}"' in name]
+    assert os.path.exists(tmp_path / "metrics" / f"{os.getpid()}.json")
+
+def test_profiling_settings_are_shared_between_workers(load_services):
+    _, file = load_services(PROFILE_TOKEN="perfil")
+    client = file.app.test_client()
+    other = file.Profiling(file.PROFILE_DIR, "perfil", 10, 0.005, "cprofile", 0.0, "")
+
+    async def scenario():
+        response = await client.post("/profiling", json={"mode": "sample", "sample_rate": 0.25, "route": "/search"},
+                                     headers={"X-Profile": "perfil"})
+        assert response.status_code == 200
+        return await response.get_json()
+
+    data = run(scenario())
+    assert data["dumps"] == []
+    # Otro worker aplica la configuración en su siguiente comprobación
+    other.load_settings()
+    assert other.settings == {"mode": "sample", "sample_rate": 0.25, "route": "/search"}
+
+def test_server_config_enables_keep_alive_and_http2(load_services, monkeypatch):
+    from common.server import server_config
+
+    _, file = load_services()
+    monkeypatch.setenv("SERVER_WORKERS", "4")
+    monkeypatch.setenv("SERVER_KEEP_ALIVE", "30")
+    config = server_config(file.__file__, 5051)
+    assert config.bind == ["0.0.0.0:5051"]
+    assert config.application_path == f"{os.path.abspath(file.__file__)}:app"
+    assert config.workers == 4
+    assert config.worker_class in ("uvloop", "asyncio")
+    assert config.keep_alive_timeout == 30
+    assert config.keep_alive_max_requests == 1000
+    assert "h2" in config.alpn_protocols
+    assert config.h2_max_concurrent_streams == 100
+    assert config.graceful_timeout == 30
+
+def test_list_files_pages_with_cursors(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        sizes = {f"f{i}.txt": 10 * ((i * 3) % 7) + 1 for i in range(7)}
+        for name, size in {**sizes, "otro.txt": 5}.items():
+            response = await client.post(f"/create_file/{name}", json={"uid": uid, "content": "x" * size}, headers=headers)
+            assert response.status_code == 200
+
+        async def pages(**options):
+            names, cursor = [], None
+            while True:
+                response = await client.post("/list_files", headers=headers,
+                                             json={"uid": uid, "limit": 3, "prefix": "f", "cursor": cursor, **options})
+                assert response.status_code == 200
+                data = await response.get_json()
+                assert len(data["files"]) <= 3
+                assert [entry["size"] for entry in data["entries"]] == [sizes[name] for name in data["files"]]
+                names += data["files"]
+                cursor = data["next_cursor"]
+                if cursor is None:
+                    return names
+
+        assert await pages() == sorted(sizes)
+        assert await pages(order="desc") == sorted(sizes, reverse=True)
+        assert await pages(sort="size", order="desc") == sorted(sizes, key=lambda name: (-sizes[name], name))
+
+        response = await client.post("/list_files", json={"uid": uid, "limit": 3}, headers=headers)
+        data = await response.get_json()
+        for options in ({"cursor": "no-es-un-cursor"}, {"cursor": data["next_cursor"], "sort": "size"}, {"limit": 0}):
+            response = await client.post("/list_files", json={"uid": uid, **options}, headers=headers)
+            assert response.status_code == 400
+
+        # Sin cambios en la biblioteca, el ETag evita recorrerla
+        response = await client.post("/list_files", json={"uid": uid, "limit": 3}, headers=headers)
+        etag = response.headers["ETag"]
+        response = await client.post("/list_files", json={"uid": uid, "limit": 3}, headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        await client.post("/create_file/a.txt", json={"uid": uid, "content": "nuevo"}, headers=headers)
+        response = await client.post("/list_files", json={"uid": uid, "limit": 3}, headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert (await response.get_json())["files"][0] == "a.txt"
+
+    run(scenario())
+
+def test_shared_blob_is_freed_with_its_last_reference(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+    content, other = os.urandom(4096), os.urandom(4096)
+    digest = hashlib.sha256(content).hexdigest()
+    stream = {"Content-Type": "application/octet-stream"}
+
+    async def scenario():
+        ana, ana_headers = await create_account(user, "ana")
+        bea, bea_headers = await create_account(user, "bea")
+        for uid, headers, name in ((ana, ana_headers, "a.bin"), (ana, ana_headers, "copia.bin"), (bea, bea_headers, "b.bin")):
+            response = await client.post(f"/create_file/{name}?uid={uid}", data=content, headers={**headers, **stream})
+            assert response.status_code == 200
+        # Un solo blob con un enlace por archivo
+        path, _ = file.find_blob(digest)
+        assert os.stat(path).st_nlink == 4
+        stats = file.blob_stats()
+        assert (stats["blobs"], stats["unique_bytes"], stats["logical_bytes"], stats["dedup_ratio"]) == (1, 4096, 3 * 4096, 3.0)
+
+        for uid, headers, name in ((ana, ana_headers, "a.bin"), (ana, ana_headers, "copia.bin")):
+            response = await client.post(f"/delete_file/{name}", json={"uid": uid}, headers=headers)
+            assert response.status_code == 200
+        assert os.stat(path).st_nlink == 2
+        response = await client.get(f"/download_file/b.bin?uid={bea}")
+        assert await response.get_data() == content
+
+        # Al sobrescribir el último archivo que lo usa, el blob se libera
+        response = await client.post(f"/create_file/b.bin?uid={bea}", data=other, headers={**bea_headers, **stream})
+        assert response.status_code == 200
+        assert file.find_blob(digest) is None
+        assert file.blob_stats()["blobs"] == 1
+
+    run(scenario())
+
+def test_content_cache_keeps_within_byte_limit(load_services):
+    user, file = load_services(CONTENT_CACHE_SIZE=3000, CONTENT_CACHE_MAX_ITEM=1500)
+    client = file.app.test_client()
+    contents = {name: os.urandom(size) for name, size in (("a.bin", 1000), ("b.bin", 1000), ("c.bin", 1000),
+                                                           ("d.bin", 1000), ("grande.bin", 2000))}
+    stream = {"Content-Type": "application/octet-stream"}
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        for name, content in contents.items():
+            response = await client.post(f"/create_file/{name}?uid={uid}", data=content, headers={**headers, **stream})
+            assert response.status_code == 200
+
+        async def download(name):
+            response = await client.get(f"/download_file/{name}?uid={uid}")
+            assert await response.get_data() == contents[name]
+
+        for name in ("a.bin", "b.bin", "c.bin", "a.bin", "d.bin", "grande.bin"):
+            await download(name)
+        cache = file.content_cache
+        # b.bin era la menos usada; el archivo grande no se cachea
+        assert [name for _, name in cache.entries] == ["c.bin", "a.bin", "d.bin"]
+        stats = cache.stats()
+        assert (stats["resident_bytes"], stats["evictions"], stats["hits"]) == (3000, 1, 1)
+
+        # Una versión nueva sustituye a la cacheada sin servir nunca la anterior
+        contents["a.bin"] = os.urandom(1200)
+        response = await client.post(f"/create_file/a.bin?uid={uid}", data=contents["a.bin"], headers={**headers, **stream})
+        assert response.status_code == 200
+        await download("a.bin")
+        assert cache.entries[(uid, "a.bin")][1] == contents["a.bin"]
+        assert cache.stats()["resident_bytes"] <= 3000
+
+    run(scenario())
+
+def test_search_ranks_filters_and_pages(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+    documents = {
+        "uno.txt": "En un lugar de la Mancha vivía un hidalgo",
+        "dos.txt": "hidalgo hidalgo hidalgo",
+        "tres.txt": "la mancha de aquel lugar",
+        "cuatro.txt": "nada que ver",
+    }
+    documents.update({f"eco{i}.txt": "eco " * (i + 1) + "relleno " * (10 - i) for i in range(5)})
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        for name, content in documents.items():
+            response = await client.post(f"/create_file/{name}", json={"uid": uid, "content": content}, headers=headers)
+            assert response.status_code == 200
+
+        async def search(q, **options):
+            response = await client.post("/search", json={"uid": uid, "q": q, **options}, headers=headers)
+            assert response.status_code == 200
+            return await response.get_json()
+
+        # Sin distinguir mayúsculas ni tildes; más apariciones en menos texto puntúan más
+        data = await search("HIDÁLGO")
+        assert [r["name"] for r in data["results"]] == ["dos.txt", "uno.txt"]
+        assert data["total"] == 2 and data["results"][0]["score"] > data["results"][1]["score"]
+        assert data["results"][0]["matches"] == 3
+        # Las frases exigen las palabras seguidas
+        assert [r["name"] for r in (await search('"lugar de la mancha"'))["results"]] == ["uno.txt"]
+        assert {r["name"] for r in (await search("lugar mancha"))["results"]} == {"uno.txt", "tres.txt"}
+
+        # Las páginas juntas dan el mismo orden que una sola consulta
+        full = [r["name"] for r in (await search("eco", limit=50))["results"]]
+        assert full == [f"eco{i}.txt" for i in reversed(range(5))]
+        names, cursor = [], None
+        while True:
+            data = await search("eco", limit=2, cursor=cursor)
+            assert data["total"] == 5 and len(data["results"]) <= 2
+            names += [r["name"] for r in data["results"]]
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        assert names == full
+
+        # El índice se actualiza al borrar y al sobrescribir
+        response = await client.post("/delete_file/dos.txt", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+        await client.post("/create_file/uno.txt", json={"uid": uid, "content": "ya no"}, headers=headers)
+        assert (await search("hidalgo"))["results"] == []
+
+        for options in ({"q": ""}, {"q": "eco", "cursor": "roto"}, {"q": "eco", "limit": 0}):
+            response = await client.post("/search", json={"uid": uid, **options}, headers=headers)
+            assert response.status_code == 400
+
+    run(scenario())
+
+def test_jobs_retry_with_backoff_and_resume_after_lease(load_services, monkeypatch):
+    _, file = load_services(JOB_LEASE=0.3, JOB_RETRY_DELAY=0.2, JOB_MAX_ATTEMPTS=2, JOB_MAX_RUNNING=1)
+    queue = file.job_queue
+    calls = []
+
+    def flaky(payload, progress):
+        calls.append(payload["n"])
+        progress(1, 1)
+        if len(calls) == 1:
+            raise RuntimeError("fallo temporal")
+        return "hecho"
+
+    monkeypatch.setitem(file.JOB_HANDLERS, "flaky", flaky)
+    monkeypatch.setitem(file.JOB_HANDLERS, "broken", lambda payload, progress: 1 / 0)
+
+    # Un fallo se reintenta tras la espera; la clave impide encolarlo dos veces
+    job_id, created = queue.enqueue("flaky", {"n": 1}, "flaky:1")
+    assert created and queue.enqueue("flaky", {"n": 1}, "flaky:1") == (job_id, False)
+    assert file.execute_job(queue.claim("w1"), "w1") == "retry"
+    assert queue.get(job_id)["error"] == "RuntimeError: fallo temporal"
+    assert queue.claim("w1") is None
+    time.sleep(0.4)
+    job = queue.claim("w1")
+    assert job["attempts"] == 2
+    assert file.execute_job(job, "w1") == "done"
+    assert queue.get(job_id)["status"] == "done" and calls == [1, 1]
+
+    # Un worker que deja caducar el lease pierde el trabajo y otro lo retoma
+    job_id, _ = queue.enqueue("flaky", {"n": 2})
+    assert queue.claim("w1")["id"] == job_id
+    assert queue.claim("w2") is None  # JOB_MAX_RUNNING=1
+    time.sleep(0.5)
+    job = queue.claim("w2")
+    assert (job["id"], job["attempts"]) == (job_id, 2)
+    assert not queue.report(job_id, "w1", 1)
+    assert not queue.finish(job_id, "w1")
+    # Sin intentos ya, un segundo lease caducado lo da por fallido
+    time.sleep(0.5)
+    assert queue.claim("w3") is None
+    assert queue.get(job_id)["status"] == "failed"
+
+    # Agotados los intentos queda fallido hasta que se reintenta a mano
+    job_id, _ = queue.enqueue("broken", {})
+    assert file.execute_job(queue.claim("w1"), "w1") == "retry"
+    time.sleep(0.4)
+    assert file.execute_job(queue.claim("w1"), "w1") == "failed"
+    assert queue.get(job_id)["error"].startswith("ZeroDivisionError")
+    assert queue.retry(job_id)
+    assert (queue.get(job_id)["status"], queue.get(job_id)["attempts"]) == ("queued", 0)
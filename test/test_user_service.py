@@ -0,0 +1,344 @@
+import asyncio
+import json
+import os
+import pstats
+import threading
+import time
+
+import pytest
+
+from conftest import create_account, run
+
+"""
+test_user_service.py
+Pruebas de regresión de user_service (usuarios y tokens).
+"""
+
+def test_index_sees_rewrite_within_same_mtime(load_services):
+    # Dos workers con su propio índice sobre el mismo directorio
+    user, _ = load_services()
+    writer = user.UserIndex(user.USER_DIR)
+    reader = user.UserIndex(user.USER_DIR)
+    writer.save({"name": "ana", "uid": "u1", "password": "a" * 16})
+    assert reader.get_by_name("ana")["password"] == "a" * 16
+
+    path = os.path.join(user.USER_DIR, "ana.json")
+    before = os.stat(path)
+    writer.save({"name": "ana", "uid": "u1", "password": "b" * 16})
+    # Mismo tamaño y mismo mtime: solo cambia el inodo
+    os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+    assert os.stat(path).st_size == before.st_size
+    assert reader.get_by_name("ana")["password"] == "b" * 16
+    assert reader.get_by_uid("u1")["password"] == "b" * 16
+
+def test_index_follows_other_workers_through_change_log(load_services, monkeypatch):
+    user, _ = load_services()
+    writer = user.UserIndex(user.USER_DIR)
+    reader = user.UserIndex(user.USER_DIR)
+    writer.save({"name": "ana", "uid": "u1", "password": "a" * 16})
+    assert reader.get_by_uid("u1")["password"] == "a" * 16
+    calls = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda *args: calls.append("listdir") or listdir(*args))
+
+    # Cambios de contraseña, altas y bajas de otro worker: se leen del registro, sin recorrer USER_DIR
+    writer.save({"name": "ana", "uid": "u1", "password": "b" * 16})
+    writer.save({"name": "bea", "uid": "u2", "password": "c" * 16})
+    assert reader.get_by_uid("u1")["password"] == "b" * 16
+    assert reader.get_by_uid("u2")["name"] == "bea"
+    writer.delete("ana")
+    assert reader.get_by_uid("u1") is None
+    assert reader.count() == 1
+    assert calls == []
+
+    # Al rotarse el registro, el lector recorre el directorio una sola vez
+    writer.change_log.max_bytes = 1
+    writer.save({"name": "eva", "uid": "u3", "password": "d" * 16})
+    assert os.path.getsize(writer.change_log.path) == 0
+    assert reader.get_by_uid("u3")["name"] == "eva"
+    assert reader.get_by_uid("u2")["name"] == "bea"
+    assert calls == ["listdir"]
+
+def test_revocation_list_sees_rewrite_within_same_mtime(load_services):
+    user, file = load_services()
+
+    async def scenario():
+        response = await user.app.test_client().post("/create_user/ana", json={"password": "secreto"})
+        return (await response.get_json())["uid"]
+
+    uid = run(scenario())
+    user.revoke_user("otro")
+    file.revocations.reload()
+    assert not file.revocations.is_revoked(uid)
+    before = os.stat(user.REVOCATION_FILE)
+    user.revoke_user(uid)
+    os.utime(user.REVOCATION_FILE, ns=(before.st_atime_ns, before.st_mtime_ns))
+    file.revocations.reload()
+    assert file.revocations.is_revoked(uid)
+
+def test_expired_or_forged_token_is_rejected(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        other, _ = await create_account(user, "otro")
+        kid = user.TOKEN_KEY_ID
+        exp = int(time.time()) - 1
+        expired = f"{kid}.{uid}.{exp}.{user.sign_token(user.TOKEN_KEYS, kid, uid, exp)}"
+        valid = headers["Authorization"].split(" ")[-1]
+        forged = valid[:-2] + ("AA" if not valid.endswith("AA") else "BB")
+        assert user.validate_token(uid, valid)
+        for token, target in ((expired, uid), (forged, uid), (valid, other)):
+            assert not user.validate_token(target, token)
+            response = await client.post("/list_files", json={"uid": target},
+                                         headers={"Authorization": f"Bearer {token}"})
+            assert response.status_code == 403
+        response = await client.post("/list_files", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+
+    run(scenario())
+
+def test_services_refuse_to_start_without_token_keys(load_services):
+    with pytest.raises(RuntimeError, match="TOKEN_KEYS"):
+        load_services(TOKEN_KEYS="")
+    user, file = load_services(TOKEN_KEYS="", ALLOW_DEV_TOKEN_KEY=1)
+    assert user.TOKEN_KEYS == file.TOKEN_KEYS == {"k1": user.SECRET_UUID.bytes}
+
+def test_deleted_user_token_is_revoked(load_services):
+    user, file = load_services()
+    client = file.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await user.app.test_client().post("/delete_user", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+        file.revocations.reload()
+        response = await client.post("/list_files", json={"uid": uid}, headers=headers)
+        assert response.status_code == 403
+
+    run(scenario())
+    # La lista de revocación no vive entre los ficheros de usuario de USER_DIR
+    assert not [name for name in os.listdir(user.USER_DIR) if name.startswith("revoked_tokens")]
+
+def test_legacy_revocation_file_is_moved(load_services, tmp_path):
+    users = tmp_path / "user_service" / "users"
+    users.mkdir(parents=True)
+    (users / "revoked_tokens").write_text(json.dumps({"u1": time.time() + 60}))
+    user, file = load_services()
+    assert not os.path.exists(users / "revoked_tokens")
+    file.revocations.reload()
+    assert file.revocations.is_revoked("u1")
+
+def test_update_password_rejects_stale_version(load_services):
+    user, _ = load_services()
+    client = user.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        version = user.get_user_data(uid)["version"]
+        response = await client.put("/update_password", json={"uid": uid, "password": "nueva"},
+                                    headers={**headers, "If-Match": f'"{version}"'})
+        assert response.status_code == 200
+        current = (await response.get_json())["version"]
+        assert current == version + 1
+        response = await client.put("/update_password", json={"uid": uid, "password": "pisada"},
+                                    headers={**headers, "If-Match": f'"{version}"'})
+        assert response.status_code == 412
+        assert (await response.get_json())["version"] == current
+        response = await client.post("/get_user_uid/ana", json={"password": "nueva"})
+        assert response.status_code == 200
+
+    run(scenario())
+
+def test_lookups_do_not_scan_user_dir(load_services, tmp_path, monkeypatch):
+    users = tmp_path / "user_service" / "users"
+    users.mkdir(parents=True)
+    for i in range(2000):
+        (users / f"u{i}.json").write_text(json.dumps({"name": f"u{i}", "password": "0" * 64, "uid": f"uid{i}"}))
+    user, _ = load_services()
+    calls = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda *args: calls.append("listdir") or listdir(*args))
+    monkeypatch.setattr(user, "open", lambda *args, **kwargs: calls.append("open") or open(*args, **kwargs), raising=False)
+
+    # Con el índice construido, una consulta cuesta un par de stat, tenga los usuarios que tenga
+    for i in range(0, 2000, 7):
+        assert user.get_user_data(f"uid{i}")["name"] == f"u{i}"
+        assert user.user_store.get_by_name(f"u{i}")["uid"] == f"uid{i}"
+    assert user.get_user_data("nadie") is None
+    assert calls == []
+
+    # Otro proceso reescribe un usuario en su sitio: se relee ese fichero y nada más
+    with open(users / "u5.json", "w") as f:
+        f.write(json.dumps({"name": "u5", "password": "1" * 64, "uid": "uid5"}))
+    assert user.get_user_data("uid5")["password"] == "1" * 64
+    assert calls == ["open"]
+
+def test_full_hash_pool_answers_503(load_services, monkeypatch):
+    user, _ = load_services(HASH_QUEUE_SIZE=1, HASH_WORKERS=1)
+    client = user.app.test_client()
+    started, release = threading.Event(), threading.Event()
+    hash_password = user.hash_password
+
+    def slow_hash(password):
+        started.set()
+        release.wait(10)
+        return hash_password(password)
+
+    async def scenario():
+        await create_account(user, "eva")
+        monkeypatch.setattr(user, "hash_password", slow_hash)
+        first = asyncio.create_task(client.post("/create_user/ana", json={"password": "secreto"}))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        # Con el pool ocupado se rechaza enseguida y el bucle de eventos sigue atendiendo
+        for path in ("/create_user/bea", "/get_user_uid/eva"):
+            response = await client.post(path, json={"password": "secreto"})
+            assert response.status_code == 503
+            assert await response.get_json() == {"Error": "Server busy, try again later"}
+        assert (await client.get("/metrics")).status_code == 200
+        release.set()
+        assert (await first).status_code == 200
+        response = await client.post("/create_user/bea", json={"password": "secreto"})
+        assert response.status_code == 200
+
+    run(scenario())
+    assert user.metrics.values[("user_hash_rejected_total", ())] == 2
+
+def test_sqlite_store_serves_both_services(load_services, tmp_path):
+    users = tmp_path / "user_service" / "users"
+    users.mkdir(parents=True)
+    (users / "vieja.json").write_text(json.dumps({"name": "vieja", "password": "0" * 64, "uid": "u-vieja", "token": "t"}))
+    user, file = load_services(USER_STORE="sqlite")
+    assert user.migrate_json_to_sqlite(user.USER_DIR, user.USER_DB) == 1
+    assert user.user_store.get_by_name("vieja")["uid"] == "u-vieja"
+    client = user.app.test_client()
+
+    async def scenario():
+        uid, headers = await create_account(user)
+        response = await client.post("/create_user/ana", json={"password": "otra"})
+        assert response.status_code == 409
+        assert await file.get_user(uid)
+        response = await client.put("/update_password", json={"uid": uid, "password": "nueva"},
+                                    headers={**headers, "If-Match": '"1"'})
+        assert response.status_code == 200
+        response = await client.put("/update_password", json={"uid": uid, "password": "pisada"},
+                                    headers={**headers, "If-Match": '"1"'})
+        assert response.status_code == 412
+        response = await client.post("/get_user_uid/ana", json={"password": "nueva"})
+        assert response.status_code == 200
+        response = await client.post("/delete_user", json={"uid": uid}, headers=headers)
+        assert response.status_code == 200
+        assert not await file.get_user(uid)
+
+    run(scenario())
+    assert isinstance(file.user_cache, file.SqliteUserCache)
+    assert user.user_store.count() == 1
+    assert not [name for name in os.listdir(user.USER_DIR) if name.endswith(".json") and name != "vieja.json"]
+
+def test_profiling_writes_and_rotates_dumps(load_services):
+    user, _ = load_services(PROFILE_TOKEN="perfil", PROFILE_MAX_DUMPS=2, PROFILE_SAMPLE_INTERVAL=0.001)
+    client = user.app.test_client()
+    token = {"X-Profile": "perfil"}
+
+    async def scenario():
+        await create_account(user)
+        # Con la cabecera se perfila la petición con cProfile
+        response = await client.post("/get_user_uid/ana", json={"password": "secreto"}, headers=token)
+        assert response.status_code == 200
+        dumps = (await (await client.get("/profiling", headers=token)).get_json())["dumps"]
+        assert len(dumps) == 1
+        assert "-get_user_uid__name-200-" in dumps[0] and dumps[0].endswith("ms.pstats")
+        response = await client.get(f"/profiling/{dumps[0]}", headers=token)
+        assert response.status_code == 200
+        path = os.path.join(user.PROFILE_DIR, dumps[0])
+        assert "login_user" in {function for _, _, function in pstats.Stats(path).stats}
+
+        # Muestreo de pilas para una ruta, sin cabecera
+        response = await client.post("/profiling", json={"mode": "sample", "route": "/get_user_uid/<name>"}, headers=token)
+        assert response.status_code == 200
+        for _ in range(2):
+            response = await client.post("/get_user_uid/ana", json={"password": "secreto"})
+            assert response.status_code == 200
+        dumps = (await (await client.get("/profiling", headers=token)).get_json())["dumps"]
+        # Solo se conservan los PROFILE_MAX_DUMPS más recientes
+        assert len(dumps) == 2 and all(name.endswith(".collapsed") for name in dumps)
+        body = await (await client.get(f"/profiling/{dumps[-1]}", headers=token)).get_data(as_text=True)
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in body.splitlines())
+
+        for headers in ({}, {"X-Profile": "otro"}):
+            assert (await client.get("/profiling", headers=headers)).status_code == 403
+        response = await client.post("/profiling", json={"sample_rate": 2}, headers=token)
+        assert response.status_code == 400
+        assert (await client.get("/profiling/no-existe.pstats", headers=token)).status_code == 404
+
+    run(scenario())
+
+def test_group_commit_batches_concurrent_syncs(load_services, monkeypatch):
+    from common import durability
+
+    user, _ = load_services()
+    batches, release = [], threading.Event()
+
+    def fake_fsync(paths):
+        batches.append(set(paths))
+        if len(batches) == 1:
+            release.wait(10)
+        if "roto" in paths:
+            raise OSError("fsync falló")
+
+    monkeypatch.setattr(durability, "fsync_paths", fake_fsync)
+    group = user.GroupCommit("group", 0, 64, user.metrics)
+
+    def sync_all(paths):
+        errors = []
+
+        def sync(path):
+            try:
+                group.sync(path)
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=sync, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        return threads, errors
+
+    # Mientras dura el fsync de "a", las demás escrituras forman un solo lote
+    first, _ = sync_all(["a"])
+    while not batches:
+        time.sleep(0.01)
+    rest, _ = sync_all(["b", "c", "d"])
+    while group._batch is None or group._batch["paths"] != {"b", "c", "d"}:
+        time.sleep(0.01)
+    release.set()
+    for thread in first + rest:
+        thread.join()
+    assert batches == [{"a"}, {"b", "c", "d"}]
+
+    # Un fallo del lote llega a todas las escrituras que incluía
+    batches.clear()
+    threads, errors = sync_all(["roto"])
+    for thread in threads:
+        thread.join()
+    assert batches == [{"roto"}] and len(errors) == 1
+
+    # Con una ventana, el lote sale en cuanto llega a max_batch rutas
+    windowed = user.GroupCommit("group", 10, 2, user.metrics)
+    batches.clear()
+    start = time.monotonic()
+    threads = [threading.Thread(target=windowed.sync, args=(path,)) for path in ("x", "y")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert batches == [{"x", "y"}] and time.monotonic() - start < 5
+
+    # 'fsync' sincroniza cada escritura por separado y 'none' ninguna
+    batches.clear()
+    user.GroupCommit("fsync", 0, 64, user.metrics).sync("p", "q")
+    user.GroupCommit("none", 0, 64, user.metrics).sync("r")
+    assert batches == [{"p", "q"}]
+    with pytest.raises(ValueError):
+        user.GroupCommit("siempre", 0, 64, user.metrics)
@@ -1,8 +1,26 @@
 import os
+import sys
 import json
+import sqlite3
+import threading
+import fcntl
 import uuid
+import time
+import asyncio
 import hashlib
-from quart import Quart, request, jsonify
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from quart import Quart, request, jsonify, Response
+
+# Código compartido con file_service (paquete common; ver README)
+from common.metrics import COUNT_BUCKETS, Metrics, install_request_metrics
+from common.profiling import Profiling
+from common.durability import GroupCommit
+from common.locks import KeyedLocks
+from common.tokens import SECRET_UUID, load_token_keys, sign_token, decode_token
+from common.jobs import JobQueue
+from common.changelog import ChangeLog
+from common.server import serve
 
 app = Quart(__name__)
 
@@ -14,9 +32,74 @@ if RUNNING_IN_DOCKER:
 else:
     USER_DIR = "../user_service/users/" # Si se ejecuta en local la ruta de usuarios se encuentra en la carpeta user_service
 
-SECRET_UUID = uuid.UUID('00010203-0405-0607-0809-0a0b0c0d0e0f')
+# Tokens firmados: claves HMAC por identificador ("kid1=secreto1,kid2=secreto2"), clave usada para firmar y validez
+ALLOW_DEV_TOKEN_KEY = os.environ.get('ALLOW_DEV_TOKEN_KEY', '') == '1'  # Sin TOKEN_KEYS, firmar con la clave pública de desarrollo
+TOKEN_KEYS = load_token_keys(os.environ.get('TOKEN_KEYS', ''), ALLOW_DEV_TOKEN_KEY)  # Sin claves no arranca
+TOKEN_KEY_ID = os.environ.get('TOKEN_KEY_ID', next(iter(TOKEN_KEYS)))
+TOKEN_TTL = int(os.environ.get('TOKEN_TTL', 24 * 3600))  # Segundos
+# UID borrados cuyos tokens aún no han caducado. Va en un subdirectorio con su lock y sus
+# temporales, fuera de los ficheros de usuario de USER_DIR
+REVOCATION_DIR = os.path.join(USER_DIR, ".revocations")
+REVOCATION_FILE = os.path.join(REVOCATION_DIR, "revoked_tokens")
+
+# Pool donde se calculan los hashes PBKDF2 para no bloquear el bucle de eventos
+HASH_POOL = os.environ.get('HASH_POOL', 'thread')  # 'thread' (hashlib libera el GIL) o 'process'
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 1))
+HASH_QUEUE_SIZE = int(os.environ.get('HASH_QUEUE_SIZE', 64))  # Hashes en curso o en espera como máximo
+
+# Backend donde se guardan los usuarios: 'json' (un fichero por usuario) o 'sqlite'
+USER_STORE = os.environ.get('USER_STORE', 'json')
+USER_DB = os.environ.get('USER_DB', os.path.join(USER_DIR, "users.db"))  # Base de datos del backend SQLite
+STORE_WORKERS = int(os.environ.get('STORE_WORKERS', 16))  # Hilos para las operaciones del backend
+# Registro de altas, cambios y bajas del backend JSON (USER_DIR/.changes/users.log), compartido por los workers y por file_service
+USER_CHANGE_LOG_MAX = int(os.environ.get('USER_CHANGE_LOG_MAX', 1024 * 1024))  # Bytes; al superarlos se vacía y los lectores recorren USER_DIR una vez
+
+# Durabilidad de las escrituras: 'none' (sin fsync), 'fsync' (uno por escritura) o 'group'
+# (los fsync de las escrituras concurrentes se agrupan en lotes)
+WRITE_DURABILITY = os.environ.get('WRITE_DURABILITY', 'none')
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW', 0))  # Espera extra (segundos) para juntar más escrituras
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))  # Rutas por lote; al llegar se sincroniza ya
+
+# Cola de trabajos compartida con file_service, que ejecuta los trabajos (borrado de bibliotecas...)
+JOB_DB = os.environ.get('JOB_DB', os.path.join(USER_DIR, ".jobs", "jobs.db"))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))  # Intentos antes de dar un trabajo por fallido
 
 os.makedirs(USER_DIR, exist_ok=True)
+os.makedirs(REVOCATION_DIR, exist_ok=True)
+os.makedirs(os.path.dirname(JOB_DB), exist_ok=True)
+if not os.path.exists(REVOCATION_FILE):
+    try:
+        # Las versiones anteriores guardaban la lista directamente en USER_DIR
+        os.rename(os.path.join(USER_DIR, "revoked_tokens"), REVOCATION_FILE)
+    except FileNotFoundError:
+        pass
+
+# Métricas en el formato de texto de Prometheus, expuestas en /metrics
+METRICS_DIR = os.environ.get('METRICS_DIR', '')  # Volcados por worker que /metrics agrega (vacío: métricas del worker que responde)
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5.0))  # Segundos entre volcados de cada worker
+metrics = Metrics(METRICS_DIR or None, METRICS_FLUSH_INTERVAL)
+metrics.describe("user_hash_duration_seconds", "histogram", "Tiempo de cada hash PBKDF2 en el pool, incluida la espera.")
+metrics.describe("user_hash_rejected_total", "counter", "Hashes rechazados por tener la cola del pool llena.")
+metrics.describe("user_store_duration_seconds", "histogram", "Tiempo de las operaciones del backend de usuarios.")
+metrics.describe("user_store_scan_duration_seconds", "histogram", "Tiempo de cada recorrido del directorio de usuarios.")
+metrics.describe("user_store_scan_files", "histogram", "Ficheros recorridos en cada lectura del directorio de usuarios.", COUNT_BUCKETS)
+metrics.describe("user_store_users", "gauge", "Usuarios conocidos por el backend.")
+
+install_request_metrics(app, metrics)
+
+# Perfilado de peticiones bajo demanda: se activa por configuración, con la cabecera
+# X-Profile (que debe contener PROFILE_TOKEN) o desde el endpoint /profiling
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')  # Directorio de los volcados
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')  # Secreto para la cabecera y el endpoint (vacío los desactiva)
+PROFILE_MAX_DUMPS = int(os.environ.get('PROFILE_MAX_DUMPS', 200))  # Se borran los volcados más antiguos
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))  # Segundos entre muestras (modo sample)
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')  # 'cprofile' (volcado pstats) o 'sample' (pilas colapsadas)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0))  # Fracción de peticiones perfiladas
+PROFILE_ROUTE = os.environ.get('PROFILE_ROUTE', '')  # Ruta que se perfila siempre, p. ej. /get_user_uid/<name>
+
+profiling = Profiling(PROFILE_DIR, PROFILE_TOKEN, PROFILE_MAX_DUMPS, PROFILE_SAMPLE_INTERVAL,
+                      PROFILE_MODE, PROFILE_SAMPLE_RATE, PROFILE_ROUTE)
+profiling.install(app)
 
 def hash_password(password):
     """
@@ -43,9 +126,89 @@ def verify_password(password, stored_password):
     hashed_password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
     return hashed_password.hex() == stored_password
 
+class HashPoolBusy(Exception):
+    """
+    Se lanza cuando la cola del pool de hashing está llena.
+    """
+
+hash_executor = None
+hash_slots = asyncio.Semaphore(HASH_QUEUE_SIZE)
+
+def get_hash_executor():
+    """
+    Crea (la primera vez) y devuelve el pool configurado para calcular hashes.
+    Returns:
+        Executor: Pool de hilos o de procesos según HASH_POOL.
+    """
+    global hash_executor
+    if hash_executor is None:
+        if HASH_POOL == 'process':
+            hash_executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        else:
+            hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hash')
+    return hash_executor
+
+async def run_hash(func, *args):
+    """
+    Ejecuta una función de hashing en el pool sin bloquear el bucle de eventos.
+    Args:
+        func (callable): hash_password o verify_password.
+        *args: Argumentos de la función.
+    Returns:
+        El resultado de la función.
+    Raises:
+        HashPoolBusy: Si ya hay HASH_QUEUE_SIZE hashes en curso o en espera.
+    """
+    if hash_slots.locked():
+        metrics.inc("user_hash_rejected_total")
+        raise HashPoolBusy()
+    async with hash_slots:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(get_hash_executor(), func, *args)
+        finally:
+            metrics.observe("user_hash_duration_seconds", (("op", func.__name__),), time.perf_counter() - start)
+
+@app.after_serving
+async def shutdown_hash_executor():
+    global hash_executor
+    if hash_executor is not None:
+        hash_executor.shutdown(wait=False, cancel_futures=True)
+        hash_executor = None
+
+@app.errorhandler(HashPoolBusy)
+async def hash_pool_busy(error):
+    return jsonify({"Error": "Server busy, try again later"}), 503
+
+durable_writes = GroupCommit(WRITE_DURABILITY, GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH, metrics)
+
+# Las operaciones del backend (consultas, escrituras y su fsync) se hacen en hilos para que
+# las peticiones concurrentes compartan lote y el bucle de eventos no se detenga mientras tanto
+store_executor = ThreadPoolExecutor(max_workers=STORE_WORKERS, thread_name_prefix='store')
+
+async def run_store(op, func, *args):
+    """
+    Ejecuta una operación del backend de usuarios en store_executor.
+    Args:
+        op (str): Nombre de la operación para las métricas.
+        func (callable): La función bloqueante.
+        *args: Argumentos de la función.
+    Returns:
+        El resultado de la función.
+    """
+    loop = asyncio.get_running_loop()
+    with metrics.timer("user_store_duration_seconds", (("op", op),)):
+        return await loop.run_in_executor(store_executor, func, *args)
+
+@app.after_serving
+async def shutdown_store_executor():
+    store_executor.shutdown(wait=True)
+
 def create_token(uid, secret):
     """
-    Genera un token único para el usuario basado en su UID y un UUID secreto.
+    Genera el identificador uuid5 que se guarda en el registro del usuario.
+    Se conserva por compatibilidad; la autenticación usa los tokens de issue_token.
     Args:
         uid (str): El ID único del usuario.
         secret (UUID): El UUID secreto para generar el token.
@@ -55,37 +218,584 @@ def create_token(uid, secret):
     token_hash = uuid.uuid5(secret, uid)
     return f"{token_hash}"
 
+def issue_token(uid):
+    """
+    Emite un token firmado "<kid>.<uid>.<exp>.<firma>" que caduca en TOKEN_TTL segundos.
+    Args:
+        uid (str): El ID único del usuario.
+    Returns:
+        str: El token generado.
+    """
+    exp = int(time.time()) + TOKEN_TTL
+    return f"{TOKEN_KEY_ID}.{uid}.{exp}.{sign_token(TOKEN_KEYS, TOKEN_KEY_ID, uid, exp)}"
+
 # Funcion para validar token de usuario
-def validate_token(uid, token, secret):
+def validate_token(uid, token):
     """
-    Valida si el token proporcionado coincide con el token esperado.
+    Valida si el token proporcionado es un token vigente emitido para el usuario.
     Args:
         uid (str): El ID único del usuario.
         token (str): El token proporcionado.
-        secret (UUID): El UUID secreto para verificar el token.
     Returns:
         bool: True si el token es válido, False si no lo es.
     """
-    expected_token = create_token(uid, secret)
-    return token == expected_token
+    return decode_token(TOKEN_KEYS, token) == uid
+
+def revoke_user(uid):
+    """
+    Añade un usuario borrado a la lista de revocación compartida con file_service.
+    Cada entrada se mantiene hasta que caducan todos los tokens emitidos para ese UID.
+    Args:
+        uid (str): El ID único del usuario.
+    """
+    # La lista nueva se escribe y pasa por fsync sin lock; con varios workers el flock solo
+    # cubre el rename, y si otra baja ha cambiado la lista entretanto se vuelve a leer
+    tmp_file = f"{REVOCATION_FILE}.{uuid.uuid4().hex}.tmp"
+    try:
+        while True:
+            identity = revocation_identity()
+            now = time.time()
+            try:
+                with open(REVOCATION_FILE, 'r') as f:
+                    revoked = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                revoked = {}
+            revoked = {k: v for k, v in revoked.items() if v > now}
+            revoked[uid] = now + TOKEN_TTL
+            with open(tmp_file, 'w') as f:
+                f.write(json.dumps(revoked))
+            durable_writes.sync(tmp_file)
+            with file_lock(f"{REVOCATION_FILE}.lock"):
+                if revocation_identity() == identity:
+                    os.replace(tmp_file, REVOCATION_FILE)
+                    break
+    finally:
+        try:
+            os.remove(tmp_file)
+        except FileNotFoundError:
+            pass
+    durable_writes.sync(REVOCATION_DIR)
+
+def revocation_identity():
+    # Cada versión de la lista es un inodo nuevo (tmp + rename)
+    try:
+        st = os.stat(REVOCATION_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+# Aquí solo se encolan trabajos; los reclama y ejecuta file_service con la misma JobQueue
+job_queue = JobQueue(JOB_DB, JOB_MAX_ATTEMPTS)
+
+def schedule_library_cleanup(uid):
+    """
+    Encola el borrado de la biblioteca de un usuario dado de baja. Si falla, el barrido
+    periódico de bibliotecas huérfanas de file_service la borrará más tarde.
+    Args:
+        uid (str): El ID único del usuario.
+    Returns:
+        int: El ID del trabajo, o None si no se ha podido encolar.
+    """
+    try:
+        job_id, _ = job_queue.enqueue("delete_library", {"uid": uid}, f"delete_library:{uid}")
+    except sqlite3.Error:
+        return None
+    # Con WRITE_DURABILITY el trabajo es duradero al volver, como el resto de escrituras
+    durable_writes.sync(job_queue.wal_path)
+    return job_id
+
+class UserExists(Exception):
+    """
+    Se lanza al guardar un usuario cuyo nombre ya pertenece a otro UID.
+    """
+
+# Versiones de los registros de usuario: cada escritura incrementa la versión y los clientes
+# pueden condicionar una modificación a la versión que leyeron (If-Match)
+NEW_RECORD = 0  # Versión esperada de un registro que aún no debe existir
+
+class VersionConflict(Exception):
+    """
+    Se lanza cuando la versión guardada no es la que exige la escritura.
+    """
+
+    def __init__(self, current):
+        super().__init__(current)
+        self.current = current  # Versión actual, None si el registro no existe
+
+def check_version(current, expected):
+    """
+    Comprueba una condición de versión antes de escribir.
+    Args:
+        current (int): Versión guardada, None si el registro no existe.
+        expected (int): None (sin condición), NEW_RECORD (no debe existir) o la versión exacta.
+    Raises:
+        VersionConflict: Si la condición no se cumple.
+    """
+    if expected is None:
+        return
+    if expected == NEW_RECORD and current is None:
+        return
+    if expected != NEW_RECORD and current == expected:
+        return
+    raise VersionConflict(current)
+
+user_locks = KeyedLocks("user", metrics)
+
+def requested_version():
+    """
+    Lee la versión que exige la cabecera If-Match.
+    Returns:
+        int: La versión, o None si no hay cabecera o es "*" (basta con que el usuario exista).
+    Raises:
+        ValueError: Si la cabecera no es un número de versión.
+    """
+    if_match = request.headers.get('If-Match', '').strip()
+    if not if_match or if_match == '*':
+        return None
+    version = int(if_match.removeprefix('W/').strip('"'))
+    if version < 1:
+        raise ValueError(if_match)
+    return version
+
+@app.errorhandler(VersionConflict)
+async def version_conflict(error):
+    if error.current is None:
+        return jsonify({"Error": "User not found"}), 404
+    return jsonify({"Error": "Version mismatch", "version": error.current}), 412
+
+@contextmanager
+def file_lock(path):
+    """
+    Lock exclusivo entre procesos (flock) sobre `path`, para los workers que comparten disco.
+    Args:
+        path (str): Fichero de lock (se crea si no existe).
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class UserIndex:
+    """
+    Backend JSON: un fichero USER_DIR/<nombre>.json por usuario, con un índice en memoria
+    (uid -> datos y nombre -> uid).
+
+    Se construye una sola vez al arrancar. Cada escritura añade {op, uid, name} al registro
+    de cambios (ChangeLog) después del rename, y los demás procesos del volumen compartido
+    releen solo los ficheros que aparecen en él; el directorio se recorre entero únicamente
+    al arrancar y cuando el registro se rota. Además se compara el (inodo, mtime, tamaño) de
+    cada fichero consultado, que detecta las reescrituras que no pasan por el registro.
+    """
+
+    def __init__(self, user_dir):
+        self.user_dir = user_dir
+        self.lock_dir = os.path.join(user_dir, ".locks")  # Un fichero por usuario para el flock
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.change_log = ChangeLog(os.path.join(user_dir, ".changes", "users.log"), USER_CHANGE_LOG_MAX)
+        self.by_uid = {}    # uid -> datos del usuario
+        self.by_name = {}   # nombre -> uid
+        self._stats = {}    # nombre -> (inodo, mtime_ns, size) del fichero cuando se leyó
+        self._index_lock = threading.RLock()  # Las consultas y escrituras llegan desde store_executor
+        # Lo que se escriba en el registro mientras se recorre el directorio se lee después
+        self.change_log.mark()
+        self.refresh()
+
+    def _path(self, name):
+        return os.path.join(self.user_dir, f"{name}.json")
+
+    def _file_stat(self, path):
+        # save() siempre crea un inodo nuevo (tmp + rename): con el inodo se detectan también
+        # las escrituras de otros workers que caen en el mismo tick del mtime y no cambian el tamaño
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _forget(self, name):
+        with self._index_lock:
+            uid = self.by_name.pop(name, None)
+            if uid is not None and self.by_uid.get(uid, {}).get('name') == name:
+                del self.by_uid[uid]
+            self._stats.pop(name, None)
+
+    def _remember(self, name, user_data, stat):
+        with self._index_lock:
+            self._forget(name)
+            self.by_name[name] = user_data['uid']
+            self.by_uid[user_data['uid']] = user_data
+            self._stats[name] = stat
+
+    def _load(self, name, stat):
+        """
+        Lee de disco el fichero de un usuario y lo incorpora al índice.
+        Returns:
+            dict: Los datos del usuario, None si el fichero no existe o no es válido.
+        """
+        try:
+            with open(self._path(name), 'r') as f:
+                user_data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._forget(name)
+            return None
+        self._remember(name, user_data, stat)
+        return user_data
+
+    def refresh(self):
+        """
+        Sincroniza el índice con el directorio, leyendo solo los ficheros nuevos o modificados.
+        """
+        start = time.perf_counter()
+        present = set()
+        filenames = os.listdir(self.user_dir)
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            name = filename[:-len(".json")]
+            present.add(name)
+            stat = self._file_stat(self._path(name))
+            if stat is None:
+                continue
+            if self._stats.get(name) != stat:
+                self._load(name, stat)
+        for name in list(self._stats):
+            if name not in present:
+                self._forget(name)
+        metrics.observe("user_store_scan_duration_seconds", (), time.perf_counter() - start)
+        metrics.observe("user_store_scan_files", (), len(filenames))
+
+    def _sync(self):
+        # Un stat del registro; si otro proceso ha escrito, se releen solo esos usuarios
+        changes = self.change_log.changes()
+        if changes is None:
+            self.refresh()
+            return
+        for change in changes:
+            self._fresh(change['name'])
+
+    def _fresh(self, name):
+        # Comprueba que el fichero no ha cambiado desde que se leyó (una llamada a stat)
+        stat = self._file_stat(self._path(name))
+        if stat is None:
+            self._forget(name)
+            return None
+        if self._stats.get(name) != stat:
+            return self._load(name, stat)
+        return self.by_uid.get(self.by_name.get(name))
+
+    def get_by_uid(self, uid):
+        """
+        Busca un usuario por su UID en O(1).
+        Args:
+            uid (str): El ID único del usuario.
+        Returns:
+            dict: Copia de los datos del usuario si se encuentra, None si no.
+        """
+        self._sync()
+        user_data = self.by_uid.get(uid)
+        if user_data is None:
+            return None
+        user_data = self._fresh(user_data['name'])
+        if user_data is None or user_data['uid'] != uid:
+            return None
+        return dict(user_data)
+
+    def get_by_name(self, name):
+        """
+        Busca un usuario por su nombre en O(1).
+        Args:
+            name (str): El nombre del usuario.
+        Returns:
+            dict: Copia de los datos del usuario si se encuentra, None si no.
+        """
+        self._sync()
+        if name not in self.by_name and not os.path.exists(self._path(name)):
+            return None
+        user_data = self._fresh(name)
+        return dict(user_data) if user_data is not None else None
+
+    def _stored_version(self, name):
+        # Versión del fichero en disco (no la del índice): la condición se evalúa bajo el flock
+        try:
+            with open(self._path(name), 'r') as f:
+                return json.load(f).get('version', 1)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, user_data, expected_version=None):
+        """
+        Escribe los datos de un usuario en disco y actualiza el índice.
+        El fichero se escribe en un temporal y se renombra, así que un lector nunca ve un
+        fichero a medias; con WRITE_DURABILITY el temporal y el directorio pasan por fsync.
+        Args:
+            user_data (dict): Los datos del usuario (debe incluir 'name' y 'uid').
+            expected_version (int): Condición de versión (ver check_version).
+        Returns:
+            int: La nueva versión del registro.
+        Raises:
+            UserExists: Si expected_version es NEW_RECORD y el nombre ya existe.
+            VersionConflict: Si la versión guardada no es la esperada.
+        """
+        self._sync()
+        name = user_data['name']
+        path = self._path(name)
+        tmp_file = os.path.join(self.lock_dir, f"{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            while True:
+                # El temporal se escribe y pasa por fsync antes de tomar el flock, con la
+                # versión leída sin él; si otra escritura la cambia entretanto, se repite
+                current = self._stored_version(name)
+                if expected_version == NEW_RECORD and current is not None:
+                    raise UserExists(name)
+                check_version(current, expected_version)
+                record = dict(user_data, version=(current or 0) + 1)
+                with open(tmp_file, "w") as f:
+                    f.write(json.dumps(record))
+                durable_writes.sync(tmp_file)
+                with file_lock(os.path.join(self.lock_dir, f"{name}.lock")):
+                    if self._stored_version(name) == current:
+                        os.replace(tmp_file, path)
+                        self.change_log.append("save", record['uid'], name)
+                        break
+        finally:
+            try:
+                os.remove(tmp_file)
+            except FileNotFoundError:
+                pass
+        user_data = record
+        # El rename se hace duradero fuera del flock, junto con el resto del lote
+        durable_writes.sync(self.user_dir)
+        self._remember(name, user_data, self._file_stat(path))
+        return user_data['version']
+
+    def delete(self, name, expected_version=None):
+        """
+        Elimina el fichero de un usuario y su entrada en el índice.
+        Args:
+            name (str): El nombre del usuario.
+            expected_version (int): Versión que debe tener el registro, o None.
+        Returns:
+            bool: True si se ha borrado el fichero, False si no existía.
+        Raises:
+            VersionConflict: Si la versión guardada no es la esperada.
+        """
+        self._sync()
+        with file_lock(os.path.join(self.lock_dir, f"{name}.lock")):
+            if expected_version is not None:
+                check_version(self._stored_version(name), expected_version)
+            uid = self.by_name.get(name)
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                self._forget(name)
+                return False
+            self.change_log.append("delete", uid, name)
+        durable_writes.sync(self.user_dir)
+        self._forget(name)
+        return True
+
+    def count(self):
+        """
+        Cuenta los usuarios del índice.
+        Returns:
+            int: Número de usuarios.
+        """
+        self._sync()
+        return len(self.by_uid)
+
+class SqliteUserStore:
+    """
+    Backend SQLite: una tabla `users` con índices únicos sobre `uid` y `name`.
+
+    La base de datos usa el modo WAL, de modo que varios procesos (user_service y
+    file_service a través del volumen compartido) pueden leer mientras otro escribe.
+    Con synchronous=NORMAL un commit no hace fsync: con WRITE_DURABILITY se sincroniza el
+    fichero WAL después de cada escritura, y en modo 'group' un solo fsync del WAL hace
+    duraderas todas las transacciones del lote. Ofrece la misma interfaz que UserIndex.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.wal_path = f"{db_path}-wal"
+        self.conn = connect_user_db(db_path)
+        self._lock = threading.Lock()
+
+    def _row_to_user(self, row):
+        if row is None:
+            return None
+        return {"name": row[0], "password": row[1], "uid": row[2], "token": row[3], "version": row[4]}
+
+    def get_by_uid(self, uid):
+        """
+        Busca un usuario por su UID.
+        Args:
+            uid (str): El ID único del usuario.
+        Returns:
+            dict: Los datos del usuario si se encuentra, None si no.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT name, password, uid, token, version FROM users WHERE uid = ?", (uid,)).fetchone()
+        return self._row_to_user(row)
+
+    def get_by_name(self, name):
+        """
+        Busca un usuario por su nombre.
+        Args:
+            name (str): El nombre del usuario.
+        Returns:
+            dict: Los datos del usuario si se encuentra, None si no.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT name, password, uid, token, version FROM users WHERE name = ?", (name,)).fetchone()
+        return self._row_to_user(row)
+
+    def _version(self, column, value):
+        row = self.conn.execute(f"SELECT version FROM users WHERE {column} = ?", (value,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, user_data, expected_version=None):
+        """
+        Inserta o actualiza (por UID) los datos de un usuario en una única transacción.
+        Con expected_version la actualización solo se aplica si la versión coincide.
+        Args:
+            user_data (dict): Los datos del usuario (name, password, uid, token).
+            expected_version (int): Condición de versión (ver check_version).
+        Returns:
+            int: La nueva versión del registro.
+        Raises:
+            UserExists: Si el nombre ya pertenece a otro usuario.
+            VersionConflict: Si la versión guardada no es la esperada.
+        """
+        values = (user_data['uid'], user_data['name'], user_data['password'], user_data['token'])
+        try:
+            with self._lock, self.conn:
+                if expected_version == NEW_RECORD:
+                    self.conn.execute(
+                        "INSERT INTO users (uid, name, password, token, version) VALUES (?, ?, ?, ?, 1)", values)
+                elif expected_version is not None:
+                    cursor = self.conn.execute(
+                        "UPDATE users SET name = ?, password = ?, token = ?, version = version + 1 "
+                        "WHERE uid = ? AND version = ?", values[1:] + (values[0], expected_version))
+                    if cursor.rowcount == 0:
+                        raise VersionConflict(self._version("uid", user_data['uid']))
+                else:
+                    self.conn.execute(
+                        "INSERT INTO users (uid, name, password, token, version) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(uid) DO UPDATE SET name = excluded.name, "
+                        "password = excluded.password, token = excluded.token, version = users.version + 1",
+                        values + (user_data.get('version', 1),))
+                version = self._version("uid", user_data['uid'])
+        except sqlite3.IntegrityError:
+            raise UserExists(user_data['name'])
+        durable_writes.sync(self.wal_path)
+        return version
+
+    def delete(self, name, expected_version=None):
+        """
+        Elimina un usuario.
+        Args:
+            name (str): El nombre del usuario.
+            expected_version (int): Versión que debe tener el registro, o None.
+        Returns:
+            bool: True si se ha borrado, False si no existía.
+        Raises:
+            VersionConflict: Si la versión guardada no es la esperada.
+        """
+        with self._lock, self.conn:
+            if expected_version is None:
+                cursor = self.conn.execute("DELETE FROM users WHERE name = ?", (name,))
+            else:
+                cursor = self.conn.execute("DELETE FROM users WHERE name = ? AND version = ?", (name, expected_version))
+                if cursor.rowcount == 0:
+                    current = self._version("name", name)
+                    if current is not None:
+                        raise VersionConflict(current)
+        durable_writes.sync(self.wal_path)
+        return cursor.rowcount > 0
+
+    def count(self):
+        """
+        Cuenta los usuarios registrados.
+        Returns:
+            int: Número de usuarios.
+        """
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+def connect_user_db(db_path):
+    """
+    Abre la base de datos de usuarios en modo WAL y crea el esquema si no existe.
+    Args:
+        db_path (str): Ruta del fichero SQLite.
+    Returns:
+        sqlite3.Connection: La conexión abierta.
+    """
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "uid TEXT PRIMARY KEY, name TEXT NOT NULL, password TEXT NOT NULL, token TEXT NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 1)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_name ON users (name)")
+        # Bases de datos creadas antes de versionar los registros
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        if "version" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    return conn
+
+def make_user_store():
+    """
+    Crea el backend de usuarios configurado en USER_STORE.
+    Returns:
+        UserIndex | SqliteUserStore: El backend de usuarios.
+    """
+    if USER_STORE == 'sqlite':
+        return SqliteUserStore(USER_DB)
+    return UserIndex(USER_DIR)
+
+def migrate_json_to_sqlite(user_dir, db_path):
+    """
+    Importa en la base de datos SQLite los usuarios guardados como ficheros JSON.
+    Los usuarios que ya existen (mismo UID) se actualizan; los ficheros JSON no se borran.
+    Args:
+        user_dir (str): Directorio con los ficheros <nombre>.json.
+        db_path (str): Ruta de la base de datos SQLite.
+    Returns:
+        int: Número de usuarios importados.
+    """
+    store = SqliteUserStore(db_path)
+    imported = 0
+    for filename in sorted(os.listdir(user_dir)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(user_dir, filename), 'r') as f:
+            user_data = json.load(f)
+        try:
+            store.save(user_data)
+            imported += 1
+        except UserExists:
+            print(f"Skipping {filename}: name already used by another uid")
+    store.conn.close()
+    return imported
+
+user_store = make_user_store()
 
 # Funcion para obtener datos de usuario
 def get_user_data(uid):
     """
-    Busca los datos de un usuario basado en su UID.
+    Busca los datos de un usuario basado en su UID (bloqueante: los endpoints la ejecutan con run_store).
     Args:
         uid (str): El ID único del usuario.
     Returns:
         dict: Los datos del usuario si se encuentra, None si no.
     """
-    for filename in os.listdir(USER_DIR):
-        if filename.endswith(".json"):
-            user_file = os.path.join(USER_DIR, filename)
-            with open(user_file, 'r') as f:
-                user_data = json.load(f)
-                if user_data['uid'] == uid:
-                    return user_data
-    return None
+    return user_store.get_by_uid(uid)
 
 # Creación de usuario
 @app.post('/create_user/<name>')
@@ -105,27 +815,28 @@ async def create_user(name):
     if not name or not password:
         return jsonify({"Error": "Name and password required"}), 400
     
-    user_file = f"{USER_DIR}/{name}.json"
-    if os.path.exists(user_file):
+    existing = await run_store("get_by_name", user_store.get_by_name, name)
+    if existing:
         return jsonify({"Error": "User already exists"}), 409
     
     # Comprueba si el usuario ya existe
     uid = str(uuid.uuid4())
-    token = create_token(uid, SECRET_UUID)
-    hashed_password = hash_password(password)
+    hashed_password = await run_hash(hash_password, password)
 
     # Guarda los datos del usuario 
     user_data = {
         "name": name,
         "password": hashed_password,
         "uid": uid,
-        "token": token
+        "token": create_token(uid, SECRET_UUID)
     }
 
-    with open(f"{USER_DIR}/{name}.json", "w") as f:
-        f.write(json.dumps(user_data))
+    try:
+        version = await run_store("save", user_store.save, user_data, NEW_RECORD)
+    except UserExists:
+        return jsonify({"Error": "User already exists"}), 409
     
-    return jsonify({"message": "User succesfuly created","uid": uid, "token": token}), 200
+    return jsonify({"message": "User succesfuly created","uid": uid, "token": issue_token(uid), "version": version}), 200
 
 # Delete de usuario
 @app.post('/delete_user')
@@ -134,10 +845,12 @@ async def delete_user():
     Endpoint para eliminar un usuario basado en su UID.
     Request Headers:
         - Authorization: Bearer <token>
+        - If-Match (opcional): versión del usuario; si ya no es la actual se responde 412.
     Request JSON:
         - uid (str): El ID único del usuario.
     Returns:
-        JSON: Mensaje de éxito o error si no se encuentra el usuario.
+        JSON: Mensaje de éxito con el ID del trabajo que borra su biblioteca (cleanup_job),
+        o error si no se encuentra el usuario.
     """
     if request.headers.get('Authorization', '').split(' ')[0] == 'Bearer':
         token = request.headers.get('Authorization', '').split(' ')[-1]
@@ -146,21 +859,29 @@ async def delete_user():
 
     data = await request.get_json()
     uid = data.get('uid')
+    try:
+        expected_version = requested_version()
+    except ValueError:
+        return jsonify({"Error": "Invalid If-Match header"}), 400
     
-    user_data = get_user_data(uid)
-    if not user_data:
-        return jsonify({"Error": "User not found"}), 404
-    
-    if not validate_token(uid, token, SECRET_UUID):
-        return jsonify({"Error": "Unvalid token"}), 403
-    
-    user_file = f"{USER_DIR}/{user_data['name']}.json"
-    if os.path.exists(user_file):
-        os.remove(user_file)
-    else:
-        return jsonify({"Error": f"File {user_file} not found"}), 404
-    
-    return jsonify({"Success": f"User {user_data['name']} deleted"}), 200
+    # Las bajas y los cambios de contraseña de un mismo usuario no se solapan
+    async with user_locks.lock(uid):
+        user_data = await run_store("get_by_uid", get_user_data, uid)
+        if not user_data:
+            return jsonify({"Error": "User not found"}), 404
+        
+        if not validate_token(uid, token):
+            return jsonify({"Error": "Unvalid token"}), 403
+        
+        deleted = await run_store("delete", user_store.delete, user_data['name'], expected_version)
+        if not deleted:
+            user_file = f"{USER_DIR}/{user_data['name']}.json"
+            return jsonify({"Error": f"File {user_file} not found"}), 404
+        await run_store("revoke", revoke_user, uid)
+
+    # La biblioteca del usuario la borra file_service en segundo plano
+    cleanup_job = await run_store("enqueue", schedule_library_cleanup, uid)
+    return jsonify({"Success": f"User {user_data['name']} deleted", "cleanup_job": cleanup_job}), 200
     
 
 # Modificacion de contraseña
@@ -170,6 +891,7 @@ async def update_paswd():
     Endpoint para actualizar la contraseña de un usuario.
     Request Headers:
         - Authorization: Bearer <token>
+        - If-Match (opcional): versión del usuario; si ya no es la actual se responde 412.
     Request JSON:
         - uid (str): El ID único del usuario.
         - password (str): La nueva contraseña.
@@ -187,25 +909,35 @@ async def update_paswd():
     
     if not password or not uid:
         return jsonify({"Error": "Password and UID required"}), 400
-    
-    user_data = get_user_data(uid)
-    if not user_data:
-        return jsonify({"Error": "User not found"}), 404
-    
-    if not validate_token(uid, token, SECRET_UUID):
-        return jsonify({"Error": "Unvalid token"}), 403
-    
-    stored_password = user_data['password']
-    
     try:
-        user_file = f"{USER_DIR}/{user_data['name']}.json"
-        user_data['password'] = hash_password(password)
-        with open(user_file, 'w') as f:
-            f.write(json.dumps(user_data))
+        expected_version = requested_version()
+    except ValueError:
+        return jsonify({"Error": "Invalid If-Match header"}), 400
+    
+    async with user_locks.lock(uid):
+        user_data = await run_store("get_by_uid", get_user_data, uid)
+        if not user_data:
+            return jsonify({"Error": "User not found"}), 404
+        
+        if not validate_token(uid, token):
+            return jsonify({"Error": "Unvalid token"}), 403
         
-        return jsonify({"Success": f"Password updated"}), 200
-    except Exception as e:
-        return jsonify({"Error": str(e)}), 500
+        # Sin If-Match se exige la versión leída: si otro worker borra o modifica el usuario
+        # entretanto, la escritura no lo resucita ni pisa el cambio
+        if expected_version is None:
+            expected_version = user_data.get('version', 1)
+        check_version(user_data.get('version', 1), expected_version)
+        
+        hashed_password = await run_hash(hash_password, password)
+        try:
+            user_data['password'] = hashed_password
+            version = await run_store("save", user_store.save, user_data, expected_version)
+            
+            return jsonify({"Success": f"Password updated", "version": version}), 200
+        except VersionConflict:
+            raise
+        except Exception as e:
+            return jsonify({"Error": str(e)}), 500
     
 
 # Log in de usuario
@@ -227,26 +959,48 @@ async def login_user(name):
         return jsonify({"Error": "Name and password required"}), 400
 
     #Comprueba si el usuario existe
-    user_file = f"{USER_DIR}/{name}.json"
-    if not os.path.exists(user_file):
+    user_data = await run_store("get_by_name", user_store.get_by_name, name)
+    if not user_data:
         return jsonify({"Error": "Invalid name"}), 404
     
-    with open(user_file, "r") as f:
-        user_data = json.loads(f.read())
-    
 
-    if user_data['name'] == name and verify_password(password, user_data['password']):
-        return jsonify({"uid": user_data["uid"], "token": user_data["token"]}), 200
+    if user_data['name'] == name and await run_hash(verify_password, password, user_data['password']):
+        return jsonify({"uid": user_data["uid"], "token": issue_token(user_data["uid"]),
+                        "version": user_data.get("version", 1)}), 200
     else:
         return jsonify({"Error": f"Invalid password"}), 401
    
+# Métricas del servicio
+@app.get('/metrics')
+async def get_metrics():
+    """
+    Endpoint con las métricas del servicio en el formato de texto de Prometheus.
+    Returns:
+        Response: Las métricas (text/plain).
+    """
+    metrics.set("user_store_users", (), await run_store("count", user_store.count))
+    # Con METRICS_DIR se leen los volcados de todos los workers: fuera del bucle de eventos
+    body = await asyncio.get_running_loop().run_in_executor(store_executor, metrics.render)
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5050)
+    if sys.argv[1:] == ["migrate"]:
+        # Migración de los ficheros JSON al backend SQLite
+        count = migrate_json_to_sqlite(USER_DIR, USER_DB)
+        print(f"Imported {count} users into {USER_DB}")
+    elif sys.argv[1:] == ["dev"]:
+        # Servidor de desarrollo de Quart (un solo proceso)
+        app.run(host="0.0.0.0", port=5050)
+    else:
+        if METRICS_DIR:
+            metrics.clear_directory()
+        sys.exit(serve(__file__, 5050))
 
 '''
 Comprobacion:
 
-python3 user.py
+python3 user.py          (Hypercorn; SERVER_WORKERS=4 para varios procesos)
+python3 user.py dev      (servidor de desarrollo de Quart)
 
 Creacion de usuario:
 curl -X POST http://0.0.0.0:5050/create_user/Blanca -H 'Content-Type: application/json' -d '{"password": "Prueba123"}'
@@ -257,7 +1011,17 @@ curl -X POST http://0.0.0.0:5050/get_user_uid/Blanca -H 'Content-Type: applicati
 Borrar usuario:
 curl -X POST http://0.0.0.0:5050/delete_user -H 'Content-Type: application/json' --H 'Authorization: Bearer ' -d '{"uid": ""}'
 
+Migrar los usuarios JSON a SQLite (después arrancar con USER_STORE=sqlite):
+python3 user.py migrate
+
 Actualizar contraseña:
 curl -X PUT http://0.0.0.0:5050/update_password -H 'Content-Type: application/json' -H 'Authorization: Bearer ' -d '{"uid": "", "password": "123456"}'
 
+Métricas (formato Prometheus):
+curl http://0.0.0.0:5050/metrics
+
+Perfilar una petición (arrancando con PROFILE_TOKEN=secreto) y activar el muestreo:
+curl -X POST http://0.0.0.0:5050/get_user_uid/Blanca -H 'X-Profile: secreto' -H 'Content-Type: application/json' -d '{"password": "Prueba123"}'
+curl -X POST http://0.0.0.0:5050/profiling -H 'X-Profile: secreto' -H 'Content-Type: application/json' -d '{"mode": "sample", "sample_rate": 0.01}'
+
 '''
\ No newline at end of file